@@ -4,8 +4,12 @@ import os
 import base64
 import re
 import io
+import math
 import magic
 import time
+import asyncio
+import hashlib
+import tempfile
 import warnings
 
 from PIL import Image
@@ -21,8 +25,14 @@ load_dotenv()  # noqa: E402
 import model.inference as inference  # noqa: E402
 import storage.datastore_storage_api as datastore  # noqa: E402
 from model.model_exceptions import ModelAPIError  # noqa: E402
-from model import request_function  # noqa: E402
+from model import request_function, http_client, image_slicing, torch_ensemble, deadline  # noqa: E402
+from model.admission import inference_admission, AdmissionRejectedError  # noqa: E402
+from model.jobs import JobQueue, JobQueueFullError  # noqa: E402
+from model.image import SourceImage  # noqa: E402
+from model.pipeline import PipelineGraph  # noqa: E402
 from datastore import azure_storage  # noqa: E402
+from storage.cache import LRUCache, ResultCache, TieredCache  # noqa: E402
+from storage.executor import datastore_executor  # noqa: E402
 from auth.cookie import decode_vouch_cookie  # noqa: E402
 
 
@@ -117,6 +127,28 @@ except (TypeError, ValueError):
         MaxContentLengthWarning,
     )
 
+INFERENCE_CACHE_SIZE = int(os.getenv("NACHET_INFERENCE_CACHE_SIZE", 128))
+INFERENCE_CACHE_DIR = os.getenv("NACHET_INFERENCE_CACHE_DIR")
+INFERENCE_CACHE_DISK_MEGABYTES = int(os.getenv("NACHET_INFERENCE_CACHE_DISK_MEGABYTES", 512))
+VALIDATOR_CACHE_SIZE = int(os.getenv("NACHET_VALIDATOR_CACHE_SIZE", 10000))
+VALIDATOR_TTL = float(os.getenv("NACHET_VALIDATOR_TTL", 3600))
+IMAGE_CACHE_MEGABYTES = int(os.getenv("NACHET_IMAGE_CACHE_MEGABYTES", 256))
+IMAGE_CACHE_DIR = os.getenv(
+    "NACHET_IMAGE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "nachet-images")
+)
+IMAGE_CACHE_DISK_MEGABYTES = int(os.getenv("NACHET_IMAGE_CACHE_DISK_MEGABYTES", 2048))
+
+# Header of the inference results returned once the budget of the request is
+# spent
+DEGRADED_HEADER = "X-Inference-Degraded"
+
+# Inference requests submitted to /inf-jobs, run in the background
+INFERENCE_JOBS = JobQueue()
+# Pictures of a picture set classified at once by /batch-inference
+BATCH_INFERENCE_CONCURRENCY = int(os.getenv("NACHET_BATCH_INFERENCE_CONCURRENCY", 4))
+# Times a picture rejected by a saturated worker is tried again
+BATCH_INFERENCE_RETRIES = int(os.getenv("NACHET_BATCH_INFERENCE_RETRIES", 5))
+
 
 Model = namedtuple(
     "Model",
@@ -128,15 +160,36 @@ Model = namedtuple(
         "api_key",
         "content_type",
         "deployment_platform",
+        "settings",
     ],
 )
 
-CACHE = {"seeds": None, "endpoints": None, "pipelines": {}, "validators": []}
+# Validator of the validated images -> SHA-256 of the image, forgotten after
+# NACHET_VALIDATOR_TTL seconds
+VALIDATORS = LRUCache(VALIDATOR_CACHE_SIZE, ttl=VALIDATOR_TTL)
+
+# Validator -> bytes of the validated image, so /inf can be called with the
+# validator only, forgotten with the validator
+VALIDATED_IMAGES = TieredCache(
+    VALIDATOR_CACHE_SIZE,
+    IMAGE_CACHE_MEGABYTES * 1024 * 1024,
+    IMAGE_CACHE_DIR,
+    IMAGE_CACHE_DISK_MEGABYTES * 1024 * 1024,
+    ttl=VALIDATOR_TTL,
+)
+
+CACHE = {"seeds": None, "endpoints": None, "pipelines": {}, "pipeline_graphs": {}, "pipeline_versions": {}, "pipeline_limits": {}, "validators": VALIDATORS}
+
+# Results of the models, keyed by (image sha256, pipeline name, pipeline version)
+INFERENCE_RESULTS = ResultCache(
+    INFERENCE_CACHE_SIZE, INFERENCE_CACHE_DIR, INFERENCE_CACHE_DISK_MEGABYTES * 1024 * 1024
+)
 
 cors_settings = {
     "allow_origin": ALLOWED_URL,
     "allow_methods": ["GET", "POST", "OPTIONS"],
     "allow_credentials": True,
+    "expose_headers": [DEGRADED_HEADER],
     "max_age": 86400
 }
 
@@ -172,10 +225,16 @@ async def before_serving():
         if not bool(re.match(pipeline_version_regex, PIPELINE_VERSION)):
             raise ServerError("Incorrect environment variable: PIPELINE_VERSION")
 
+        # Fork the slicing processes before the datastore threads start
+        image_slicing.start()
+        await datastore.connection_pool.open()
+
         # Store the seeds names and ml structure in CACHE
         CACHE["seeds"] = await datastore.get_all_seeds()
         CACHE["endpoints"] = await get_pipelines()
 
+        INFERENCE_JOBS.start()
+
         print(
             f"""Server start with current configuration:\n
                 date: {date.today()}
@@ -189,6 +248,19 @@ async def before_serving():
         raise
 
 
+@app.after_serving
+async def after_serving():
+    # Release the keep-alive connections to the model endpoints and the
+    # idle database connections
+    await INFERENCE_JOBS.stop()
+    await http_client.close_clients()
+    datastore.connection_pool.close()
+    datastore_executor.shutdown()
+    image_slicing.shutdown()
+    # Remove the validated images spilled to disk
+    VALIDATED_IMAGES.clear()
+
+
 @app.post("/get-user-id")
 async def get_user_id():
     """
@@ -210,7 +282,7 @@ async def get_user_id():
             email = "example@gmail.com"
             # raise MissingArgumentsError("Missing email")
 
-        user_id = datastore.get_user_id(email)
+        user_id = await datastore.get_user_id(email)
 
         return jsonify({"user_id": user_id}), 200
 
@@ -249,8 +321,8 @@ async def delete_directory():
         container_name = data.get("container_name")
         folder_name = data.get("folder_name")
         if container_name and folder_name:
-            container_client = await azure_storage.mount_container(
-                CONNECTION_STRING, container_name, create_container=True
+            container_client = await datastore.mount_container(
+                CONNECTION_STRING, container_name
             )
             if container_client:
                 folder_uuid = await azure_storage.get_folder_uuid(
@@ -292,15 +364,10 @@ async def delete_request():
         user_id = data.get("container_name")
         picture_set_id = data.get("folder_uuid")
         if user_id and picture_set_id:
-            # Open db connection
-            connection = datastore.get_connection()
-            cursor = datastore.get_cursor(connection)
-
-            response = await datastore.delete_directory_request(
-                cursor, str(user_id), str(picture_set_id)
-            )
-            # Close connection
-            datastore.end_query(connection, cursor)
+            async with datastore.pooled_cursor() as cursor:
+                response = await datastore.delete_directory_request(
+                    cursor, str(user_id), str(picture_set_id)
+                )
 
             return jsonify(response), 200
         else:
@@ -339,18 +406,13 @@ async def delete_permanently():
         user_id = container_name
         picture_set_id = data.get("folder_uuid")
         if user_id and picture_set_id:
-            container_client = await azure_storage.mount_container(
-                CONNECTION_STRING, container_name, create_container=True
-            )
-            # Open db connection
-            connection = datastore.get_connection()
-            cursor = datastore.get_cursor(connection)
-
-            response = await datastore.delete_directory_permanently(
-                cursor, str(user_id), str(picture_set_id), container_client
+            container_client = await datastore.mount_container(
+                CONNECTION_STRING, container_name
             )
-            # Close connection
-            datastore.end_query(connection, cursor)
+            async with datastore.pooled_cursor() as cursor:
+                response = await datastore.delete_directory_permanently(
+                    cursor, str(user_id), str(picture_set_id), container_client
+                )
 
             return jsonify(response), 200
         else:
@@ -378,18 +440,13 @@ async def delete_with_archive():
         user_id = container_name
         picture_set_id = data.get("folder_uuid")
         if user_id and picture_set_id:
-            container_client = await azure_storage.mount_container(
-                CONNECTION_STRING, container_name, create_container=True
-            )
-            # Open db connection
-            connection = datastore.get_connection()
-            cursor = datastore.get_cursor(connection)
-
-            response = await datastore.delete_directory_with_archive(
-                cursor, str(user_id), str(picture_set_id), container_client
+            container_client = await datastore.mount_container(
+                CONNECTION_STRING, container_name
             )
-            # Close connection
-            datastore.end_query(connection, cursor)
+            async with datastore.pooled_cursor() as cursor:
+                response = await datastore.delete_directory_with_archive(
+                    cursor, str(user_id), str(picture_set_id), container_client
+                )
 
             if response:
                 return jsonify(True), 200
@@ -417,13 +474,8 @@ async def list_directories():
         data = await request.get_json()
         user_id = data.get("container_name")
         if user_id:
-            # Open db connection
-            connection = datastore.get_connection()
-            cursor = datastore.get_cursor(connection)
-
-            directories = await datastore.get_directories(cursor, str(user_id))
-            # Close connection
-            datastore.end_query(connection, cursor)
+            async with datastore.pooled_cursor() as cursor:
+                directories = await datastore.get_directories(cursor, str(user_id))
             return jsonify(directories)
         else:
             raise MissingArgumentsError("Missing container name")
@@ -451,14 +503,8 @@ async def get_directories():
         data = await request.get_json()
         user_id = data.get("container_name")
         if user_id:
-            # Open db connection
-            connection = datastore.get_connection()
-            cursor = datastore.get_cursor(connection)
-
-            directories_list = await datastore.get_directories(cursor, str(user_id))
-
-            # Close connection
-            datastore.end_query(connection, cursor)
+            async with datastore.pooled_cursor() as cursor:
+                directories_list = await datastore.get_directories(cursor, str(user_id))
 
             result = {"folders": directories_list}
             return jsonify(result)
@@ -491,29 +537,24 @@ async def get_picture():
         picture_id = data.get("picture_id")
 
         if user_id and picture_id:
-            container_client = await azure_storage.mount_container(
-                CONNECTION_STRING, container_name, create_container=True
+            container_client = await datastore.mount_container(
+                CONNECTION_STRING, container_name
             )
-            # Open db connection
-            connection = datastore.get_connection()
-            cursor = datastore.get_cursor(connection)
-
             picture = {}
             picture["picture_id"] = picture_id
 
-            inference = await datastore.get_inference(
-                cursor, str(user_id), str(picture_id)
-            )
-            picture["inference"] = inference
+            async with datastore.pooled_cursor() as cursor:
+                inference = await datastore.get_inference(
+                    cursor, str(user_id), str(picture_id)
+                )
+                picture["inference"] = inference
 
-            blob = await datastore.get_picture_blob(
-                cursor, str(user_id), container_client, str(picture_id)
-            )
+                blob = await datastore.get_picture_blob(
+                    cursor, str(user_id), container_client, str(picture_id)
+                )
             image_base64 = base64.b64encode(blob)
             picture["image"] = "data:image/tiff;base64," + image_base64.decode("utf-8")
 
-            # Close connection
-            datastore.end_query(connection, cursor)
             return jsonify(picture)
         else:
             raise MissingArgumentsError("Missing container name")
@@ -540,18 +581,13 @@ async def create_directory():
         user_id = container_name
         folder_name = data.get("folder_name")
         if container_name and folder_name:
-            container_client = await azure_storage.mount_container(
-                CONNECTION_STRING, container_name, create_container=True
+            container_client = await datastore.mount_container(
+                CONNECTION_STRING, container_name
             )
-            # Open db connection
-            connection = datastore.get_connection()
-            cursor = datastore.get_cursor(connection)
-
-            response = await datastore.create_picture_set(
-                cursor, container_client, user_id, 0, folder_name
-            )
-            # Close connection
-            datastore.end_query(connection, cursor)
+            async with datastore.pooled_cursor() as cursor:
+                response = await datastore.create_picture_set(
+                    cursor, container_client, user_id, 0, folder_name
+                )
             if response:
                 return jsonify([response]), 200
             else:
@@ -623,7 +659,9 @@ async def image_validation():
             raise ImageValidationError(f"invalid file header: {header}")
 
         validator = await azure_storage.generate_hash(image_bytes)
-        CACHE["validators"].append(validator)
+        # Keep the image so it does not have to be sent again to /inf
+        CACHE["validators"].set(validator, hashlib.sha256(image_bytes).hexdigest())
+        VALIDATED_IMAGES.set(validator, image_bytes)
 
         return jsonify([validator]), 200
 
@@ -643,14 +681,70 @@ async def inference_request():
     """
     Performs inference on an image, and returns the results.
     The image and inference results are uploaded to a folder in the user's container.
+
+    The image is either sent as a base64 data URL in a JSON body, as the
+    "image" file of a multipart/form-data body or as the raw body of the
+    request with the other arguments in the query string. It can be omitted
+    when the validator returned by /image-validation is given, the validated
+    image is used instead.
+
+    The time budget of the request is the X-Request-Budget header in seconds,
+    bounded by NACHET_INFERENCE_BUDGET_SECONDS. Once it is spent, the result
+    of the models that completed is returned without being saved, and the
+    X-Inference-Degraded header lists what was left out.
+
+    The requests running at once are limited globally and per pipeline, the
+    others wait in a bounded queue and a 503 with a Retry-After header is
+    returned once it is full.
+    """
+    try:
+        data, image_bytes = await get_image_request(("imageDims", "area_ratio"))
+    except APIError as error:
+        print(error)
+        return jsonify([f"API Error during classification : {str(error)}"]), 400
+    except Exception as error:
+        print(error)
+        return jsonify(["Unhandled API error : Error during classification"]), 400
+
+    result, status, headers = await run_inference(
+        data, image_bytes, request.headers.get(deadline.BUDGET_HEADER)
+    )
+    return jsonify(result), status, headers
+
+
+async def run_inference(
+        data: dict,
+        image_bytes: bytes = None,
+        budget_header: str = None,
+        picture_id: str = None,
+) -> tuple:
     """
+    Runs the inference requested by /inf or by an inference job.
+
+    Parameters:
+    - data (dict): The arguments of the request.
+    - image_bytes (bytes): The image, None if it is in data or validated.
+    - budget_header (str): The X-Request-Budget header of the request.
+    - picture_id (str): The id of the picture if it is already stored, it is
+      then not uploaded again.
 
+    Returns:
+    - tuple: The result (JSON serializable), the status code and the headers
+      of the response.
+    """
     seconds = time.perf_counter()  # TODO: transform into logging
+    admitted_at = None
     try:
         print(
             f"{date.today()} Entering inference request"
         )  # TODO: Transform into logging
-        data = await request.get_json()
+        # The deadline is kept in the context of the task serving the request
+        # and follows it into the models called for it
+        try:
+            deadline.start(deadline.request_budget(budget_header))
+        except ValueError as error:
+            raise InferenceRequestError(str(error)) from error
+        degraded = []
         pipeline_name = data.get("model_name")
         validator = data.get("validator")
         folder_name = data.get("folder_name")
@@ -666,7 +760,7 @@ async def inference_request():
         pipelines_endpoints = CACHE.get("pipelines")
         validators = CACHE.get("validators")
 
-        if not (folder_name and container_name and imageDims and image_base64):
+        if not (folder_name and container_name and imageDims and (image_base64 or image_bytes or validator)):
             raise MissingArgumentsError(
                 "missing request arguments: either folder_name, container_name, imageDims or image is missing"
             )
@@ -674,55 +768,94 @@ async def inference_request():
         if not pipelines_endpoints.get(pipeline_name):
             raise InferenceRequestError(f"model {pipeline_name} not found")
 
-        _, encoded_data = image_base64.split(",", 1)
+        queue_wait = await inference_admission.acquire(
+            pipeline_name, CACHE["pipeline_limits"].get(pipeline_name)
+        )
+        admitted_at = time.perf_counter()
+        print(f"Time in the inference queue: {queue_wait} seconds")  # TODO: Transform into logging
+
+        if image_base64 or image_bytes:
+            if picture_id is None and (validator is None or validators.get(validator) is None):
+                warnings.warn("this picture was not validate", ImageWarning)
+                # TODO: implement logic when frontend start returning validators
 
-        if validator not in validators:
-            warnings.warn("this picture was not validate", ImageWarning)
-            # TODO: implement logic when frontend start returning validators
+            if image_bytes is None:
+                _, encoded_data = image_base64.split(",", 1)
+                source_image = SourceImage.from_base64(encoded_data)
+            else:
+                source_image = SourceImage(image_bytes)
+            image_hash = hashlib.sha256(source_image.data).hexdigest()
+        else:
+            image_hash = validators.get(validator)
+            image_bytes = VALIDATED_IMAGES.get(validator)
+            if image_hash is None or image_bytes is None:
+                raise InferenceRequestError(
+                    f"no validated image found for validator {validator}, the image must be sent again"
+                )
+            source_image = SourceImage(image_bytes)
 
-        # Keep track of every output given by the models
-        # TODO: add it to CACHE variable
-        cache_json_result = [encoded_data]
-        image_bytes = base64.b64decode(encoded_data)
+        # The image is decoded once and shared by the models and the storage.
 
         print(f"Mounting containerb {container_name}")  # TODO: Transform into logging
         mount_container_time = time.perf_counter()
-        container_client = await azure_storage.mount_container(
-            CONNECTION_STRING, container_name, create_container=True
+        container_client = await within_budget(
+            datastore.mount_container(CONNECTION_STRING, container_name)
         )
         print(f"Time mount_container: {time.perf_counter() - mount_container_time} seconds")
 
-        # Open db connection
-        connection = datastore.get_connection()
-        cursor = datastore.get_cursor(connection)
+        # The connection goes back to the pool before the models are called
+        if picture_id is None:
+            print("Get picture id")  # TODO: Transform into logging
+            get_picture_id_time = time.perf_counter()
 
-        print("Get picture id")  # TODO: Transform into logging
-        get_picture_id_time = time.perf_counter()
-        picture_id = await datastore.get_picture_id(
-            cursor, user_id, image_bytes, container_client
-        )
-        print(f"Time get_picture_id: {time.perf_counter() - get_picture_id_time} seconds")
-        
-        # Close connection
-        datastore.end_query(connection, cursor)
+            async def upload_picture():
+                async with datastore.pooled_cursor() as cursor:
+                    return await datastore.get_picture_id(
+                        cursor, user_id, source_image.data, container_client
+                    )
+
+            picture_id = await within_budget(upload_picture())
+            print(f"Time get_picture_id: {time.perf_counter() - get_picture_id_time} seconds")
 
         pipeline = pipelines_endpoints.get(pipeline_name)
 
-        
-        for idx, model in enumerate(pipeline):
-            model_time = time.perf_counter()
-            print(
-                f"Entering {model.name.upper()} model"
-            )  
-            print(f"Request function: {model.request_function}")  # TODO: Transform into logging
-            result_json = await model.request_function(model, cache_json_result[idx])
-            cache_json_result.append(result_json)
-            print(f"Time {model.name}: {time.perf_counter() - model_time} seconds")
-        print("End of inference request")  # TODO: Transform into logging
-        
+        # A picture already seen by the same version of the pipeline is not
+        # sent to the models again
+        result_key = (
+            image_hash,
+            pipeline_name,
+            CACHE["pipeline_versions"].get(pipeline_name),
+        )
+        result_json = INFERENCE_RESULTS.get(result_key)
+
+        if result_json is None:
+            # The models that do not depend on each other are called
+            # concurrently
+            graph = CACHE["pipeline_graphs"].get(pipeline_name)
+            if graph is None:
+                graph = PipelineGraph(pipeline)
+                CACHE["pipeline_graphs"][pipeline_name] = graph
+            # Fail at once if a model endpoint is known to be down
+            for model in pipeline:
+                http_client.check_circuit(model)
+            pipeline_run = await graph.run(source_image)
+            result_json = pipeline_run.result
+            print(f"Time per model: {pipeline_run.timings}")  # TODO: Transform into logging
+            print("End of inference request")  # TODO: Transform into logging
+            if pipeline_run.partial:
+                degraded.append("partial-result")
+                # The models followed by another one also return the crops
+                # sent to it
+                if isinstance(result_json, dict):
+                    result_json = result_json["result_json"]
+            else:
+                INFERENCE_RESULTS.set(result_key, result_json)
+        else:
+            print("Inference result found in cache")  # TODO: Transform into logging
+
         print("Process results")  # TODO: Transform into logging
         processed_result_json = await inference.process_inference_results(
-            cache_json_result[-1], imageDims, area_ratio, color_format
+            result_json, imageDims, area_ratio, color_format
         )
 
         print("Record model")  # TODO: Transform into logging
@@ -730,35 +863,106 @@ async def inference_request():
         await record_model(pipeline, processed_result_json)
         print(f"Time record_model: {time.perf_counter() - record_model_time} seconds")
 
-        # Open db connection
-        connection = datastore.get_connection()
-        cursor = datastore.get_cursor(connection)
+        if degraded or deadline.expired():
+            # The budget is spent, the result is returned without waiting on
+            # the datastore
+            degraded.append("not-saved")
+            print(f"Degraded inference result: {degraded}")  # TODO: Transform into logging
+            return processed_result_json[0], 200, {DEGRADED_HEADER: ",".join(degraded)}
 
         print("Save inference result")  # TODO: Transform into logging
         save_inference_time = time.perf_counter()
-        saved_result_json = await datastore.save_inference_result(
-            cursor, user_id, processed_result_json[0], picture_id, pipeline_name, 1
-        )
-        print(f"Time save_inference_result: {time.perf_counter() - save_inference_time} seconds")
 
-        # Close connection
-        datastore.end_query(connection, cursor)
+        async def save_inference_result():
+            async with datastore.pooled_cursor() as cursor:
+                return await datastore.save_inference_result(
+                    cursor, user_id, processed_result_json[0], picture_id, pipeline_name, 1
+                )
+
+        try:
+            saved_result_json = await within_budget(save_inference_result())
+        except deadline.DeadlineExceededError:
+            # The save goes on in the background, the result is returned
+            # without the ids given by the datastore
+            degraded.append("save-deferred")
+            print(f"Degraded inference result: {degraded}")  # TODO: Transform into logging
+            return processed_result_json[0], 200, {DEGRADED_HEADER: ",".join(degraded)}
+        print(f"Time save_inference_result: {time.perf_counter() - save_inference_time} seconds")
 
         # return the inference results to the client
         print(
             f"Took: {'{:10.4f}'.format(time.perf_counter() - seconds)} seconds"
         )  # TODO: Transform into logging
-        return jsonify(saved_result_json), 200
+        return saved_result_json, 200, {}
 
+    except AdmissionRejectedError as error:
+        print(error)
+        return (
+            [f"Too many inference requests : {str(error)}"],
+            503,
+            {"Retry-After": str(math.ceil(error.retry_after))},
+        )
     except datastore.DatastoreError as error:
         print(error)
-        return jsonify([f"Datastore Error during classification : {str(error)}"]), 400
+        return [f"Datastore Error during classification : {str(error)}"], 400, {}
     except (KeyError, TypeError, APIError, ModelAPIError) as error:
         print(error)
-        return jsonify([f"API Error during classification : {str(error)}"]), 400
+        if deadline.is_deadline_error(error):
+            return [f"Budget spent during classification : {str(error)}"], 504, {}
+        circuit_open_error = http_client.find_circuit_open_error(error)
+        if circuit_open_error is not None:
+            return (
+                [f"Model unavailable during classification : {str(circuit_open_error)}"],
+                503,
+                {"Retry-After": str(math.ceil(circuit_open_error.retry_after))},
+            )
+        return [f"API Error during classification : {str(error)}"], 400, {}
     except Exception as error:
         print(error)
-        return jsonify(["Unhandled API error : Error during classification"]), 400
+        return ["Unhandled API error : Error during classification"], 400, {}
+    finally:
+        if admitted_at is not None:
+            inference_admission.release(pipeline_name, time.perf_counter() - admitted_at)
+
+
+@app.post("/inf-jobs")
+async def submit_inference_job():
+    """
+    Submits an inference, with the same arguments as /inf, and returns its
+    job id at once. The inference runs in the background and its result is
+    polled with /inf-jobs/<job_id>.
+    """
+    try:
+        data, image_bytes = await get_image_request(("imageDims", "area_ratio"))
+        job = INFERENCE_JOBS.submit(
+            run_inference, data, image_bytes, request.headers.get(deadline.BUDGET_HEADER)
+        )
+        return jsonify(job), 202, {"Location": f"/inf-jobs/{job['job_id']}"}
+    except JobQueueFullError as error:
+        print(error)
+        return (
+            jsonify([f"Too many inference jobs : {str(error)}"]),
+            503,
+            {"Retry-After": str(math.ceil(error.retry_after))},
+        )
+    except APIError as error:
+        print(error)
+        return jsonify([f"API Error submitting the inference job : {str(error)}"]), 400
+    except Exception as error:
+        print(error)
+        return jsonify(["Unhandled API error : Error submitting the inference job"]), 400
+
+
+@app.get("/inf-jobs/<job_id>")
+async def get_inference_job(job_id):
+    """
+    Returns the status of an inference job and, once it is finished, the
+    status code and the result /inf would have returned
+    """
+    job = INFERENCE_JOBS.get(job_id)
+    if job is None:
+        return jsonify([f"No inference job found for {job_id}, it may have expired"]), 404
+    return jsonify(job), 200
 
 
 @app.get("/seed-data/<seed_name>")
@@ -847,15 +1051,13 @@ async def feedback_positive():
         boxes_id = [box["boxId"] for box in data["boxes"]]
 
         if inference_id and user_id and boxes_id:
-            connection = datastore.get_connection()
-            cursor = datastore.get_cursor(connection)
-            await datastore.save_perfect_feedback(
-                cursor, inference_id, user_id, boxes_id
-            )
-            inference = await datastore.get_inference(
-                cursor, str(user_id), None, inference_id=str(inference_id)
-            )
-            datastore.end_query(connection, cursor)
+            async with datastore.pooled_cursor() as cursor:
+                await datastore.save_perfect_feedback(
+                    cursor, inference_id, user_id, boxes_id
+                )
+                inference = await datastore.get_inference(
+                    cursor, str(user_id), None, inference_id=str(inference_id)
+                )
             return jsonify(inference), 200
         else:
             raise MissingArgumentsError("missing argument(s)")
@@ -908,13 +1110,11 @@ async def feedback_negative():
                     "missing request arguments: either boxId, label, box or classId is missing in boxes"
                 )
 
-        connection = datastore.get_connection()
-        cursor = datastore.get_cursor(connection)
-        await datastore.save_annoted_feedback(cursor, data)
-        inference = await datastore.get_inference(
-            cursor, str(user_id), None, inference_id=str(inference_id)
-        )
-        datastore.end_query(connection, cursor)
+        async with datastore.pooled_cursor() as cursor:
+            await datastore.save_annoted_feedback(cursor, data)
+            inference = await datastore.get_inference(
+                cursor, str(user_id), None, inference_id=str(inference_id)
+            )
         return jsonify(inference), 200
 
     except datastore.DatastoreError as error:
@@ -956,16 +1156,14 @@ async def new_batch_import():
                 "wrong request arguments: either container_name or nb_pictures is wrong"
             )
 
-        container_client = await azure_storage.mount_container(
-            CONNECTION_STRING, container_name, create_container=True
+        container_client = await datastore.mount_container(
+            CONNECTION_STRING, container_name
         )
 
-        connection = datastore.get_connection()
-        cursor = datastore.get_cursor(connection)
-        picture_set_id = await datastore.create_picture_set(
-            cursor, container_client, user_id, nb_pictures, folder_name
-        )
-        datastore.end_query(connection, cursor)
+        async with datastore.pooled_cursor() as cursor:
+            picture_set_id = await datastore.create_picture_set(
+                cursor, container_client, user_id, nb_pictures, folder_name
+            )
         if picture_set_id:
             return jsonify({"session_id": picture_set_id}), 200
         else:
@@ -986,9 +1184,13 @@ async def new_batch_import():
 async def upload_picture():
     """
     Uploads pictures to the user's container
+
+    The picture is either sent as a base64 data URL in a JSON body, as the
+    "image" file of a multipart/form-data body or as the raw body of the
+    request with the other arguments in the query string.
     """
     try:
-        data = await request.get_json()
+        data, image_bytes = await get_image_request(("zoom_level", "nb_seeds"))
 
         container_name = data.get("container_name")
         user_id = container_name
@@ -1002,35 +1204,34 @@ async def upload_picture():
         if not (
             container_name
             and (seed_name or seed_id)
-            and image_base64
+            and (image_base64 or image_bytes)
             and picture_set_id
         ):
             raise MissingArgumentsError(
                 "missing request arguments: either seed_name, session_id, container_name or image is missing"
             )
 
-        container_client = await azure_storage.mount_container(
-            CONNECTION_STRING, container_name, create_container=True
+        container_client = await datastore.mount_container(
+            CONNECTION_STRING, container_name
         )
 
-        _, encoded_data = image_base64.split(",", 1)
-
-        image_bytes = base64.b64decode(encoded_data)
-
-        connection = datastore.get_connection()
-        cursor = datastore.get_cursor(connection)
-        response = await datastore.upload_pictures(
-            cursor,
-            user_id,
-            picture_set_id,
-            container_client,
-            [image_bytes],
-            seed_name,
-            seed_id,
-            zoom_level,
-            nb_seeds,
-        )
-        datastore.end_query(connection, cursor)
+        if image_bytes is None:
+            _, encoded_data = image_base64.split(",", 1)
+
+            image_bytes = base64.b64decode(encoded_data)
+
+        async with datastore.pooled_cursor() as cursor:
+            response = await datastore.upload_pictures(
+                cursor,
+                user_id,
+                picture_set_id,
+                container_client,
+                [image_bytes],
+                seed_name,
+                seed_id,
+                zoom_level,
+                nb_seeds,
+            )
 
         if response:
             return jsonify([True]), 200
@@ -1048,11 +1249,155 @@ async def upload_picture():
         return jsonify(["Unhandled API error : Error uploading picture"]), 400
 
 
+@app.post("/batch-inference")
+async def batch_inference():
+    """
+    Runs a pipeline over every picture of a picture set already uploaded with
+    /new-batch-import and /upload-picture, without sending the pictures again.
+    The pictures are read from the storage and classified in the background,
+    the job id is returned at once and the progress and results are polled
+    with /inf-jobs/<job_id>.
+    """
+    try:
+        data = await request.get_json()
+        container_name = data.get("container_name")
+        picture_set_id = data.get("session_id")
+        pipeline_name = data.get("model_name")
+
+        if not (container_name and picture_set_id and pipeline_name):
+            raise MissingArgumentsError(
+                "missing request arguments: either container_name, session_id or model_name is missing"
+            )
+        if not CACHE["pipelines"].get(pipeline_name):
+            raise InferenceRequestError(f"model {pipeline_name} not found")
+
+        progress = {"total": None, "done": 0, "failed": 0}
+        job = INFERENCE_JOBS.submit(run_batch_inference, data, progress, progress=progress)
+        return jsonify(job), 202, {"Location": f"/inf-jobs/{job['job_id']}"}
+
+    except JobQueueFullError as error:
+        print(error)
+        return (
+            jsonify([f"Too many inference jobs : {str(error)}"]),
+            503,
+            {"Retry-After": str(math.ceil(error.retry_after))},
+        )
+    except (KeyError, TypeError, APIError) as error:
+        print(error)
+        return jsonify([f"API Error starting batch inference : {str(error)}"]), 400
+    except Exception as error:
+        print(error)
+        return jsonify(["Unhandled API error : Error starting batch inference"]), 400
+
+
+async def run_batch_inference(data: dict, progress: dict) -> tuple:
+    """
+    Classifies every picture of the picture set, BATCH_INFERENCE_CONCURRENCY
+    pictures at once, and counts the pictures done and failed in progress.
+
+    Returns:
+    - tuple: The result of every picture, the status code and the headers of
+      the response.
+    """
+    try:
+        container_name = data.get("container_name")
+        user_id = container_name
+        picture_set_id = data.get("session_id")
+
+        container_client = await datastore.mount_container(
+            CONNECTION_STRING, container_name
+        )
+        async with datastore.pooled_cursor() as cursor:
+            picture_sets = await datastore.get_directories(cursor, str(user_id))
+        picture_set = next(
+            (
+                picture_set for picture_set in picture_sets
+                if str(picture_set.get("picture_set_id")) == str(picture_set_id)
+            ),
+            None,
+        )
+        if picture_set is None:
+            raise InferenceRequestError(f"picture set {picture_set_id} not found")
+
+        picture_ids = [picture["picture_id"] for picture in picture_set.get("pictures", [])]
+        progress["total"] = len(picture_ids)
+        semaphore = asyncio.Semaphore(BATCH_INFERENCE_CONCURRENCY)
+
+        async def classify(picture_id):
+            async with semaphore:
+                try:
+                    async with datastore.pooled_cursor() as cursor:
+                        blob = await datastore.get_picture_blob(
+                            cursor, str(user_id), container_client, str(picture_id)
+                        )
+                    image_dims = data.get("imageDims")
+                    if not image_dims:
+                        # The boxes are scaled to the picture itself
+                        image = await asyncio.to_thread(SourceImage(blob).open)
+                        image_dims = list(image.size)
+                    picture_data = {
+                        **data,
+                        "folder_name": picture_set.get("folder_name") or str(picture_set_id),
+                        "imageDims": image_dims,
+                    }
+                    for attempt in range(BATCH_INFERENCE_RETRIES + 1):
+                        result, status_code, headers = await run_inference(
+                            picture_data, blob, picture_id=str(picture_id)
+                        )
+                        retry_after = headers.get("Retry-After")
+                        if status_code != 503 or retry_after is None or attempt == BATCH_INFERENCE_RETRIES:
+                            break
+                        # The inference queue is full or a model is down, the
+                        # picture waits to be tried again instead of failing
+                        await asyncio.sleep(float(retry_after))
+                except Exception as error:
+                    print(error)
+                    result, status_code = [f"Error reading the picture : {str(error)}"], 400
+
+            progress["done" if status_code < 400 else "failed"] += 1
+            return {"picture_id": picture_id, "status_code": status_code, "result": result}
+
+        results = await asyncio.gather(*(classify(picture_id) for picture_id in picture_ids))
+        return {"picture_set_id": picture_set_id, "results": results}, 200, {}
+
+    except datastore.DatastoreError as error:
+        print(error)
+        return [f"Datastore Error during batch inference : {str(error)}"], 400, {}
+    except (KeyError, TypeError, APIError) as error:
+        print(error)
+        return [f"API Error during batch inference : {str(error)}"], 400, {}
+
+
 @app.get("/health")
 async def health():
     return "ok", 200
 
 
+@app.get("/metrics")
+async def metrics():
+    """
+    Returns the usage statistics of the database connection pool, of the
+    datastore thread pool, of the caches, of the model batchers and circuit
+    breakers, of the inference queue and jobs and the time taken by the models
+    of every pipeline
+    """
+    return jsonify({
+        "connection_pool": datastore.connection_pool.stats(),
+        "datastore_executor": datastore_executor.stats(),
+        "container_clients": datastore.container_clients.stats(),
+        "inference_results": INFERENCE_RESULTS.stats(),
+        "validators": CACHE["validators"].stats(),
+        "validated_images": VALIDATED_IMAGES.stats(),
+        "model_batchers": http_client.batchers_stats(),
+        "model_circuits": http_client.breakers_stats(),
+        "inference_admission": inference_admission.stats(),
+        "inference_jobs": INFERENCE_JOBS.stats(),
+        "pipelines": {
+            name: graph.stats() for name, graph in CACHE["pipeline_graphs"].items()
+        },
+    }), 200
+
+
 @app.get("/test")
 async def test():
     # Build test pipeline
@@ -1066,19 +1411,84 @@ async def test():
         "test_api_key",
         "application/json",
         "test_platform",
+        {},
     )
 
     CACHE["pipelines"]["test_pipeline"] = (m,)
+    CACHE["pipeline_graphs"]["test_pipeline"] = PipelineGraph((m,))
 
     return CACHE["endpoints"], 200
 
 
+async def get_image_request(json_fields: tuple = ()) -> tuple:
+    """
+    Reads the arguments and the image of a request sending a picture.
+
+    JSON bodies keep the image as a base64 data URL in their "image" key and
+    are returned as is. The image of a multipart/form-data body is its
+    "image" file, and the other arguments are the form fields. Any other
+    content type (image/*, application/octet-stream) is the raw image and the
+    arguments are in the query string. The form fields and query string
+    arguments listed in json_fields are parsed as JSON (e.g. imageDims=[720,540]).
+
+    Returns:
+    - tuple: The arguments (dict) and the image bytes, None for JSON bodies.
+    """
+    if request.is_json:
+        return await request.get_json(), None
+
+    if request.mimetype in ("multipart/form-data", "application/x-www-form-urlencoded"):
+        arguments = (await request.form).to_dict()
+        image = (await request.files).get("image")
+        image_bytes = image.read() if image else None
+    else:
+        arguments = request.args.to_dict()
+        # Read the body as it arrives instead of letting it be buffered whole
+        # and copied
+        buffer = bytearray()
+        async for chunk in request.body:
+            buffer.extend(chunk)
+        image_bytes = bytes(buffer) if buffer else None
+
+    for key in json_fields:
+        if key in arguments:
+            try:
+                arguments[key] = json.loads(arguments[key])
+            except json.JSONDecodeError:
+                raise APIError(f"invalid value for {key}: {arguments[key]}")
+    return arguments, image_bytes
+
+
 async def record_model(pipeline: namedtuple, result: list):
     new_entry = [{"name": model.name, "version": model.version} for model in pipeline]
     result[0]["models"] = new_entry
     return json.dumps(result, indent=4)
 
 
+async def within_budget(coroutine):
+    """
+    Waits for a datastore call until the deadline of the request. The call
+    runs in its own task and is not cancelled when the budget is spent: the
+    thread running it cannot be interrupted and its connection must go back
+    to the pool, so it completes in the background.
+
+    Raises:
+    - DeadlineExceededError: If the deadline passes before the call completes.
+    """
+    task = asyncio.ensure_future(coroutine)
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), deadline.remaining())
+    except asyncio.TimeoutError:
+        def report_error(task):
+            if not task.cancelled() and task.exception() is not None:
+                print(task.exception())  # TODO: Transform into logging
+
+        task.add_done_callback(report_error)
+        raise deadline.DeadlineExceededError(
+            "The budget of the request is spent before the datastore answered"
+        ) from None
+
+
 async def fetch_json(repo_URL, key, file_path):
     """
     Fetches JSON document from a GitHub repository.
@@ -1111,6 +1521,13 @@ async def get_pipelines():
 
     models = ()
     for model in result_json.get("models"):
+        endpoint = model.get("endpoint")
+        settings = model.get("settings") or {}
+        if isinstance(endpoint, list):
+            # The model is deployed on several replicas, the calls go to the
+            # fastest one
+            settings = {**settings, "replicas": endpoint}
+            endpoint = endpoint[0]
         m = Model(
             request_function.get(model.get("model_name")),
             model.get("model_name"),
@@ -1121,19 +1538,32 @@ async def get_pipelines():
             # data.
             # cipher_suite.decrypt(model.get("endpoint").encode()).decode(),
             # cipher_suite.decrypt(model.get("api_key").encode()).decode(),
-            model.get("endpoint"),
+            endpoint,
             model.get("api_key"),
             model.get("content_type"),
             model.get("deployment_platform"),
+            # Optional tuning of how the backend calls the model
+            settings,
         )
         # if the model is not already in the tuple
         if m not in models:
             models += (m,)
-    # Build the pipeline to call the models in order in the inference request
+    # Build the pipeline to call the models in the inference request, in
+    # order or following the dependencies declared by the pipeline
     for pipeline in result_json.get("pipelines"):
-        CACHE["pipelines"][pipeline.get("pipeline_name")] = tuple(
-            [m for m in models if m.name in pipeline.get("models")]
+        pipeline_models = tuple([m for m in models if m.name in pipeline.get("models")])
+        if pipeline.get("routes"):
+            # The seeds re-classified by ensemble B go to their specialist
+            pipeline_models = tuple(
+                torch_ensemble.with_routes(m, pipeline.get("routes"), models)
+                for m in pipeline_models
+            )
+        CACHE["pipelines"][pipeline.get("pipeline_name")] = pipeline_models
+        CACHE["pipeline_graphs"][pipeline.get("pipeline_name")] = PipelineGraph.from_definition(
+            CACHE["pipelines"][pipeline.get("pipeline_name")], pipeline
         )
+        CACHE["pipeline_versions"][pipeline.get("pipeline_name")] = pipeline.get("version")
+        CACHE["pipeline_limits"][pipeline.get("pipeline_name")] = pipeline.get("max_concurrency")
 
     return result_json.get("pipelines")
 
@@ -0,0 +1,106 @@
+"""
+Compares the time and the peak memory needed to read the image of an
+/inf or /upload-picture request sent as a base64 data URL in a JSON body,
+as a multipart/form-data file and as a raw binary body.
+
+Run from the root of the repository, with the environment variables needed
+by app.py:
+
+    python -m benchmarks.upload_formats --megabytes 8 --repeat 5
+"""
+
+import os
+import json
+import time
+import base64
+import asyncio
+import argparse
+import tracemalloc
+
+from app import app, get_image_request
+
+
+def build_requests(image_bytes: bytes) -> dict:
+    arguments = {
+        "imageDims": "[720,540]",
+        "folder_name": "benchmark",
+        "container_name": "benchmark",
+        "model_name": "test_pipeline",
+    }
+    json_body = json.dumps(
+        dict(
+            arguments,
+            imageDims=[720, 540],
+            image="data:image/png;base64," + base64.b64encode(image_bytes).decode("utf-8"),
+        )
+    ).encode("utf-8")
+
+    boundary = "nachetbenchmarkboundary"
+    multipart_body = b"".join(
+        [
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n{value}\r\n'.encode("utf-8")
+            for key, value in arguments.items()
+        ]
+        + [
+            f'--{boundary}\r\nContent-Disposition: form-data; name="image"; filename="image.png"\r\n'
+            "Content-Type: image/png\r\n\r\n".encode("utf-8"),
+            image_bytes,
+            f"\r\n--{boundary}--\r\n".encode("utf-8"),
+        ]
+    )
+
+    return {
+        "json": dict(
+            headers={"Content-Type": "application/json"},
+            data=json_body,
+        ),
+        "multipart": dict(
+            headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+            data=multipart_body,
+        ),
+        "raw": dict(
+            headers={"Content-Type": "image/png"},
+            query_string=arguments,
+            data=image_bytes,
+        ),
+    }
+
+
+async def read_image(request_format: str, request_kwargs: dict) -> bytes:
+    async with app.test_request_context("/inf", method="POST", **request_kwargs):
+        data, image_bytes = await get_image_request(("imageDims",))
+        if request_format == "json":
+            _, encoded_data = data["image"].split(",", 1)
+            image_bytes = base64.b64decode(encoded_data)
+        return image_bytes
+
+
+async def benchmark(megabytes: int, repeat: int):
+    image_bytes = os.urandom(megabytes * 1024 * 1024)
+    app.config["MAX_CONTENT_LENGTH"] = None
+
+    print(f"{'format':<10} {'body (MB)':>10} {'time (ms)':>10} {'peak (MB)':>10}")
+    for request_format, request_kwargs in build_requests(image_bytes).items():
+        times = []
+        peaks = []
+        for _ in range(repeat):
+            tracemalloc.start()
+            start = time.perf_counter()
+            result = await read_image(request_format, request_kwargs)
+            times.append(time.perf_counter() - start)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            assert result == image_bytes
+
+        body_size = len(request_kwargs["data"]) / 1024 / 1024
+        print(
+            f"{request_format:<10} {body_size:>10.1f} {min(times) * 1000:>10.1f} {min(peaks) / 1024 / 1024:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--megabytes", type=int, default=8, help="size of the image")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each format")
+    args = parser.parse_args()
+    asyncio.run(benchmark(args.megabytes, args.repeat))
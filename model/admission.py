@@ -0,0 +1,204 @@
+"""
+This file contains the admission control of the inference requests.
+
+At most NACHET_INFERENCE_MAX_CONCURRENCY inference requests run at once, and
+at most the "max_concurrency" of a pipeline (or
+NACHET_PIPELINE_MAX_CONCURRENCY) for the same pipeline. The other requests
+wait in a bounded queue, in order of arrival, for at most
+NACHET_INFERENCE_QUEUE_TIMEOUT seconds. A request that finds the queue full or
+waits too long is rejected at once with an estimate of when to retry, instead
+of overloading the worker and the model endpoints.
+"""
+
+import os
+import time
+import asyncio
+
+from collections import deque
+from model import deadline
+from model.model_exceptions import ModelAPIError
+
+MAX_CONCURRENCY = int(os.getenv("NACHET_INFERENCE_MAX_CONCURRENCY", 32))
+# Requests of one pipeline running at once, 0 to only apply the global limit
+PIPELINE_MAX_CONCURRENCY = int(os.getenv("NACHET_PIPELINE_MAX_CONCURRENCY", 0))
+QUEUE_SIZE = int(os.getenv("NACHET_INFERENCE_QUEUE_SIZE", 64))
+QUEUE_TIMEOUT = float(os.getenv("NACHET_INFERENCE_QUEUE_TIMEOUT", 10))
+# Number of recent queue wait times kept to compute the percentiles
+WAIT_TIME_WINDOW = 1000
+# Weight of the last request in the moving average of the time a request runs
+SERVICE_TIME_SMOOTHING = 0.2
+
+
+class AdmissionRejectedError(ModelAPIError):
+    """
+    Raised instead of running an inference request when the worker is
+    saturated.
+    """
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Global and per pipeline concurrency limits of the inference requests,
+    with a bounded wait queue.
+    """
+    def __init__(
+        self,
+        max_concurrency: int = MAX_CONCURRENCY,
+        pipeline_max_concurrency: int = PIPELINE_MAX_CONCURRENCY,
+        queue_size: int = QUEUE_SIZE,
+        queue_timeout: float = QUEUE_TIMEOUT,
+    ):
+        self.max_concurrency = max(1, max_concurrency)
+        self.pipeline_max_concurrency = max(0, pipeline_max_concurrency)
+        self.queue_size = max(0, queue_size)
+        self.queue_timeout = queue_timeout
+        # pipeline name -> requests running
+        self._running = {}
+        # (pipeline name, limit, future), in order of arrival
+        self._waiters = deque()
+        self._admitted = 0
+        self._rejected = 0
+        self._timed_out = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._waits = deque(maxlen=WAIT_TIME_WINDOW)
+        self._service_time = None
+
+    def _limit(self, limit: int) -> int:
+        return limit if limit else self.pipeline_max_concurrency
+
+    def _has_capacity(self, pipeline: str, limit: int) -> bool:
+        if sum(self._running.values()) >= self.max_concurrency:
+            return False
+        limit = self._limit(limit)
+        return not limit or self._running.get(pipeline, 0) < limit
+
+    def _start(self, pipeline: str, wait: float):
+        self._running[pipeline] = self._running.get(pipeline, 0) + 1
+        self._admitted += 1
+        self._total_wait += wait
+        self._max_wait = max(self._max_wait, wait)
+        self._waits.append(wait)
+
+    def retry_after(self) -> float:
+        """
+        Estimate the seconds until the requests waiting now are served.
+        """
+        service_time = self._service_time or 1.0
+        return max(1.0, service_time * (len(self._waiters) + 1) / self.max_concurrency)
+
+    def _reject(self, message: str) -> AdmissionRejectedError:
+        self._rejected += 1
+        return AdmissionRejectedError(message, self.retry_after())
+
+    async def acquire(self, pipeline: str, limit: int = None) -> float:
+        """
+        Wait until the request can run and return the time it waited. Every
+        acquire that returns must be followed by release.
+
+        Args:
+            pipeline (str): The name of the pipeline of the request.
+            limit (int): The "max_concurrency" of the pipeline, if defined.
+
+        Raises:
+            AdmissionRejectedError: If the queue is full or the request waited
+            for queue_timeout seconds or until its deadline.
+        """
+        submitted_at = time.perf_counter()
+        # release admits the waiting requests as soon as they fit, so a new
+        # request that fits does not pass any of them
+        if self._has_capacity(pipeline, limit):
+            self._start(pipeline, 0.0)
+            return 0.0
+        if len(self._waiters) >= self.queue_size:
+            raise self._reject("The inference queue is full")
+
+        waiter = (pipeline, limit, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(
+                asyncio.shield(waiter[2]), deadline.bound(self.queue_timeout)
+            )
+        except asyncio.TimeoutError:
+            if not waiter[2].done():
+                self._timed_out += 1
+                raise self._reject(
+                    "The inference request waited too long in the queue"
+                ) from None
+        except BaseException:
+            if waiter[2].done() and not waiter[2].cancelled():
+                # Admitted while being cancelled
+                self.release(pipeline)
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+        wait = time.perf_counter() - submitted_at
+        self._waits.append(wait)
+        self._total_wait += wait
+        self._max_wait = max(self._max_wait, wait)
+        return wait
+
+    def release(self, pipeline: str, service_time: float = None):
+        """
+        End a request admitted by acquire and admit the next waiting ones.
+        """
+        self._running[pipeline] -= 1
+        if service_time is not None:
+            if self._service_time is None:
+                self._service_time = service_time
+            else:
+                self._service_time += SERVICE_TIME_SMOOTHING * (service_time - self._service_time)
+
+        for waiter in list(self._waiters):
+            name, limit, future = waiter
+            if future.done():
+                continue
+            if self._has_capacity(name, limit):
+                # The wait time is recorded by the request itself
+                self._running[name] = self._running.get(name, 0) + 1
+                self._admitted += 1
+                self._waiters.remove(waiter)
+                future.set_result(None)
+            elif sum(self._running.values()) >= self.max_concurrency:
+                break
+
+    def stats(self) -> dict:
+        waits = sorted(self._waits)
+
+        def percentile(ratio):
+            if not waits:
+                return 0.0
+            return waits[min(len(waits) - 1, int(ratio * len(waits)))]
+
+        queued = {}
+        for name, _, _ in self._waiters:
+            queued[name] = queued.get(name, 0) + 1
+
+        return {
+            "max_concurrency": self.max_concurrency,
+            "queue_size": self.queue_size,
+            "running": sum(self._running.values()),
+            "queued": len(self._waiters),
+            "admitted": self._admitted,
+            "rejected": self._rejected,
+            "timed_out": self._timed_out,
+            "service_time": self._service_time or 0.0,
+            "wait_time": {
+                "mean": self._total_wait / self._admitted if self._admitted else 0.0,
+                "p50": percentile(0.5),
+                "p95": percentile(0.95),
+                "max": self._max_wait,
+            },
+            "pipelines": {
+                name: {"running": self._running.get(name, 0), "queued": queued.get(name, 0)}
+                for name in set(self._running) | set(queued)
+            },
+        }
+
+
+inference_admission = AdmissionController()
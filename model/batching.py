@@ -0,0 +1,165 @@
+"""
+This file contains the scheduler that gathers the crops sent to the same
+classification model by concurrent inference requests into batched calls.
+
+A model whose settings define a "batch_size" greater than 1 receives batches
+in the same format as the seed detector requests:
+
+    {"input_data": {"columns": ["image"], "index": [0, 1], "data": [crop0, crop1]}}
+
+and must answer with a JSON list holding the result of every input, in the
+order of the inputs. Each caller gets back the result of its own input,
+encoded as if the model had been called with this input alone.
+"""
+
+import json
+import time
+import asyncio
+import contextvars
+
+from collections import namedtuple
+from model import deadline
+from model.model_exceptions import ModelAPIError
+
+
+class BatchError(ModelAPIError):
+    pass
+
+
+def encode_batch(bodies: list) -> bytes:
+    data = {
+        "input_data": {
+            "columns": ["image"],
+            "index": list(range(len(bodies))),
+            "data": [
+                body.decode("ascii") if isinstance(body, bytes) else body
+                for body in bodies
+            ],
+        }
+    }
+    return str.encode(json.dumps(data))
+
+
+def decode_batch(response: bytes, size: int) -> list:
+    results = json.loads(response.decode("utf8"))
+    if not isinstance(results, list) or len(results) != size:
+        raise BatchError(
+            f"Expected a list of {size} results from the batched request, got {type(results).__name__}"
+            + (f" of length {len(results)}" if isinstance(results, list) else "")
+        )
+    return [str.encode(json.dumps(result)) for result in results]
+
+
+class MicroBatcher:
+    """
+    Gathers the inputs submitted for a model until max_batch_size inputs are
+    waiting or the oldest input waited max_wait seconds, then sends them in
+    one request. At most max_in_flight batches are sent at once.
+    """
+    def __init__(self, model: namedtuple, send, max_batch_size: int, max_wait: float, max_in_flight: int):
+        self.model = model
+        # send(model, body) -> bytes, posts a batch to the endpoint
+        self.send = send
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait)
+        self._semaphore = asyncio.Semaphore(max(1, max_in_flight))
+        # (body, future, submitted_at)
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+        self._batches = 0
+        self._inputs = 0
+        self._failed = 0
+        self._total_wait = 0.0
+
+    async def submit(self, body: bytes) -> bytes:
+        """
+        Add the input to the next batch and return its own result.
+
+        Raises:
+            DeadlineExceededError: If the deadline of the request passes first.
+            The input is then dropped from the batch if it is not sent yet.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        entry = (body, future, time.perf_counter())
+        self._pending.append(entry)
+        while len(self._pending) >= self.max_batch_size:
+            self._send_batch()
+        if not self._pending and self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        elif self._pending and self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        try:
+            # The batch is sent without the deadline of the request, so the
+            # request stops waiting for it when its budget is spent
+            return await asyncio.wait_for(future, deadline.remaining())
+        except asyncio.TimeoutError:
+            raise deadline.DeadlineExceededError(
+                f"The budget of the request is spent waiting for the batch of {self.model.name}"
+            ) from None
+        finally:
+            if entry in self._pending:
+                self._pending.remove(entry)
+                if not self._pending and self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+
+    def _flush(self):
+        # The oldest input waited max_wait, every pending input is sent
+        self._timer = None
+        while self._pending:
+            self._send_batch()
+
+    def _send_batch(self):
+        batch = self._pending[:self.max_batch_size]
+        del self._pending[:self.max_batch_size]
+        # The inputs of the requests cancelled while waiting are dropped
+        batch = [entry for entry in batch if not entry[1].done()]
+        if batch:
+            # A batch holds the inputs of several requests, it is not bound by
+            # the deadline of the request that filled it
+            task = asyncio.get_running_loop().create_task(
+                self._send(batch), context=contextvars.Context()
+            )
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: list):
+        async with self._semaphore:
+            # The requests may have given up while the batch waited its turn
+            batch = [entry for entry in batch if not entry[1].done()]
+            if not batch:
+                return
+            sent_at = time.perf_counter()
+            self._batches += 1
+            self._inputs += len(batch)
+            self._total_wait += sum(sent_at - submitted_at for _, _, submitted_at in batch)
+            try:
+                response = await self.send(self.model, encode_batch([body for body, _, _ in batch]))
+                results = decode_batch(response, len(batch))
+            except Exception as error:
+                print(error)
+                self._failed += 1
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                return
+
+        for (_, future, _), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait": self.max_wait,
+            "pending": len(self._pending),
+            "in_flight": len(self._tasks),
+            "batches": self._batches,
+            "inputs": self._inputs,
+            "failed": self._failed,
+            "mean_batch_size": self._inputs / self._batches if self._batches else 0.0,
+            "mean_wait": self._total_wait / self._inputs if self._inputs else 0.0,
+        }
@@ -0,0 +1,172 @@
+"""
+This file contains the circuit breaker kept for every model endpoint.
+
+A breaker opens after consecutive failures of its endpoint: the calls then
+fail at once instead of waiting on an endpoint that is down. Once open for
+NACHET_MODEL_CIRCUIT_OPEN_SECONDS, one probing call is let through (half
+open state). It closes the circuit if it succeeds and opens it again if it
+fails.
+
+The timeout of the calls follows the latency observed for the endpoint: a
+multiple of the 99th percentile of the recent successful calls, kept between
+a minimum and a maximum.
+"""
+
+import os
+import time
+
+from collections import deque
+
+FAILURE_THRESHOLD = int(os.getenv("NACHET_MODEL_CIRCUIT_FAILURES", 5))
+OPEN_SECONDS = float(os.getenv("NACHET_MODEL_CIRCUIT_OPEN_SECONDS", 30))
+MIN_TIMEOUT = float(os.getenv("NACHET_MODEL_MIN_TIMEOUT", 10))
+MAX_TIMEOUT = float(os.getenv("NACHET_MODEL_MAX_TIMEOUT", 120))
+TIMEOUT_MULTIPLIER = float(os.getenv("NACHET_MODEL_TIMEOUT_MULTIPLIER", 3))
+# Number of recent latencies kept, and needed before the timeout adapts
+LATENCY_WINDOW = 200
+MIN_LATENCY_SAMPLES = 20
+# Weight of the last call in the moving average of the latency
+LATENCY_SMOOTHING = 0.2
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Calls let through by before_call
+CALL = "call"
+PROBE = "probe"
+
+
+class CircuitBreaker:
+    """
+    State of the calls to one model endpoint.
+    """
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = FAILURE_THRESHOLD,
+        open_seconds: float = OPEN_SECONDS,
+        min_timeout: float = MIN_TIMEOUT,
+        max_timeout: float = MAX_TIMEOUT,
+        timeout_multiplier: float = TIMEOUT_MULTIPLIER,
+    ):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.open_seconds = open_seconds
+        self.min_timeout = min_timeout
+        self.max_timeout = max(min_timeout, max_timeout)
+        self.timeout_multiplier = timeout_multiplier
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._failures = 0
+        self._probing = False
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._average_latency = None
+        self._calls = 0
+        self._total_failures = 0
+        self._rejected = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+        return self._state
+
+    def retry_after(self) -> float:
+        return max(0.0, self.open_seconds - (time.monotonic() - self._opened_at))
+
+    def is_open(self) -> bool:
+        """
+        Return True if the endpoint must not be called now.
+        """
+        state = self.state
+        return state == OPEN or (state == HALF_OPEN and self._probing)
+
+    def before_call(self):
+        """
+        Return False if the call must fail at once, otherwise let it through
+        and return PROBE for the probing call when the circuit is half open,
+        CALL for the others. Every call let through must be followed by
+        record_success, record_failure or release.
+        """
+        if self.is_open():
+            self._rejected += 1
+            return False
+        self._calls += 1
+        if self._state == HALF_OPEN:
+            self._probing = True
+            return PROBE
+        return CALL
+
+    def percentile(self, ratio: float) -> float:
+        """
+        Return the percentile of the recent latencies, or None until enough
+        calls were measured.
+        """
+        if len(self._latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(ratio * len(latencies)))]
+
+    @property
+    def average_latency(self) -> float:
+        """
+        Moving average of the latency, 0 for an endpoint not called yet so it
+        is tried first.
+        """
+        return self._average_latency or 0.0
+
+    def timeout(self) -> float:
+        p99 = self.percentile(0.99)
+        if p99 is None:
+            return self.max_timeout
+        return min(self.max_timeout, max(self.min_timeout, p99 * self.timeout_multiplier))
+
+    def record_success(self, latency: float):
+        self._latencies.append(latency)
+        if self._average_latency is None:
+            self._average_latency = latency
+        else:
+            self._average_latency += LATENCY_SMOOTHING * (latency - self._average_latency)
+        self._failures = 0
+        self._probing = False
+        self._state = CLOSED
+
+    def record_failure(self):
+        self._failures += 1
+        self._total_failures += 1
+        if self._probing or self._failures >= self.failure_threshold:
+            self._state = OPEN
+            self._opened_at = time.monotonic()
+        self._probing = False
+
+    def release(self, call: str):
+        """
+        End a call that neither succeeded nor failed, such as a cancelled call.
+        Only the probing call lets another probe through.
+        """
+        if call == PROBE:
+            self._probing = False
+
+    def stats(self) -> dict:
+        latencies = sorted(self._latencies)
+
+        def percentile(ratio):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(ratio * len(latencies)))]
+
+        return {
+            "state": self.state,
+            "consecutive_failures": self._failures,
+            "calls": self._calls,
+            "failures": self._total_failures,
+            "rejected": self._rejected,
+            "timeout": self.timeout(),
+            "latency": {
+                "average": self.average_latency,
+                "p50": percentile(0.5),
+                "p95": percentile(0.95),
+                "p99": percentile(0.99),
+            },
+        }
@@ -0,0 +1,88 @@
+"""
+This file contains the deadline of the request being served.
+
+The deadline is set once by /inf, from the X-Request-Budget header or
+NACHET_INFERENCE_BUDGET_SECONDS, and is kept in a context variable so it
+follows the request into every pipeline model and model call, including the
+tasks they start. The calls to the model endpoints time out when the budget
+is spent and the pipeline then returns the result of the models that
+completed.
+"""
+
+import os
+import time
+
+from contextvars import ContextVar
+from model.model_exceptions import ModelAPIError
+
+# Time budget in seconds of an inference request, 0 for no budget
+DEFAULT_BUDGET = float(os.getenv("NACHET_INFERENCE_BUDGET_SECONDS", 0))
+BUDGET_HEADER = "X-Request-Budget"
+
+# time.monotonic() value after which the request must answer
+_deadline = ContextVar("deadline", default=None)
+
+
+class DeadlineExceededError(ModelAPIError):
+    pass
+
+
+def request_budget(header: str = None) -> float:
+    """
+    Return the budget of a request in seconds, or None if it has none. The
+    budget of the header can only shorten the configured budget.
+
+    Raises:
+        ValueError: If the header is not a positive number of seconds.
+    """
+    budgets = [DEFAULT_BUDGET] if DEFAULT_BUDGET > 0 else []
+    if header is not None:
+        budget = float(header)
+        if not budget > 0:
+            raise ValueError(f"{BUDGET_HEADER} must be a positive number of seconds")
+        budgets.append(budget)
+    return min(budgets) if budgets else None
+
+
+def start(budget: float):
+    """
+    Set the deadline of the current request to budget seconds from now, or
+    clear it if budget is None.
+    """
+    _deadline.set(None if budget is None else time.monotonic() + budget)
+
+
+def remaining() -> float:
+    """
+    Return the seconds left before the deadline, or None without deadline.
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def expired() -> bool:
+    return remaining() == 0.0
+
+
+def bound(timeout: float) -> float:
+    """
+    Return the timeout shortened to the time left before the deadline.
+    """
+    left = remaining()
+    if left is None:
+        return timeout
+    return left if timeout is None else min(timeout, left)
+
+
+def is_deadline_error(error: BaseException) -> bool:
+    """
+    Return True if the error was caused by the deadline. The request
+    functions raise their own error from the errors of the endpoint.
+    """
+    while error is not None:
+        if isinstance(error, DeadlineExceededError):
+            return True
+        error = error.__cause__
+    return False
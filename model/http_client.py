@@ -0,0 +1,413 @@
+"""
+This file contains the shared asynchronous HTTP client used by the request
+functions to call the model endpoints.
+
+One httpx.AsyncClient is kept per endpoint origin so the connections to a
+model endpoint are pooled and kept alive between calls instead of being
+reopened for every request, and so the event loop is never blocked while
+waiting on a model.
+"""
+
+import os
+import time
+import asyncio
+
+import httpx
+
+from collections import namedtuple
+from urllib.parse import urlsplit
+from model import deadline
+from model.batching import MicroBatcher
+from model.circuit_breaker import CircuitBreaker
+from model.deadline import DeadlineExceededError
+from model.image_slicing import CropStream
+from model.model_exceptions import ModelAPIError
+
+
+class ModelEndpointError(ModelAPIError):
+    pass
+
+
+class CircuitOpenError(ModelEndpointError):
+    """
+    Raised instead of calling a model endpoint whose circuit is open.
+    """
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def find_circuit_open_error(error: BaseException) -> CircuitOpenError:
+    """
+    Return the CircuitOpenError that caused the error, if any. The request
+    functions raise their own error from the errors of the endpoint.
+    """
+    while error is not None:
+        if isinstance(error, CircuitOpenError):
+            return error
+        error = error.__cause__
+    return None
+
+
+MAX_CONNECTIONS = int(os.getenv("NACHET_MODEL_MAX_CONNECTIONS", 100))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("NACHET_MODEL_MAX_KEEPALIVE_CONNECTIONS", 20))
+KEEPALIVE_EXPIRY = float(os.getenv("NACHET_MODEL_KEEPALIVE_EXPIRY", 30))
+# Requests sent at once to a model by post_many, unless the model settings
+# define their own "max_concurrency"
+DEFAULT_MAX_CONCURRENCY = int(os.getenv("NACHET_MODEL_MAX_CONCURRENCY", 8))
+# Time the first input of a batch waits for other inputs, unless the model
+# settings define their own "batch_wait_ms"
+DEFAULT_BATCH_WAIT_MS = float(os.getenv("NACHET_MODEL_BATCH_WAIT_MS", 10))
+# Latency percentile of a replica after which a request is also sent to
+# another replica, unless the model settings define their own
+# "hedge_percentile". 0 disables hedging.
+DEFAULT_HEDGE_PERCENTILE = float(os.getenv("NACHET_MODEL_HEDGE_PERCENTILE", 95))
+
+# origin -> (event loop, client). A client can only be used from the loop
+# that created its connections.
+_clients = {}
+# (model name, endpoint) -> (event loop, batcher)
+_batchers = {}
+# (model name, endpoint) -> circuit breaker
+_breakers = {}
+
+
+def get_client(endpoint: str) -> httpx.AsyncClient:
+    """
+    Return the pooled client for the origin (scheme, host and port) of the
+    endpoint, creating it on first use.
+    """
+    loop = asyncio.get_running_loop()
+    url = urlsplit(endpoint)
+    origin = f"{url.scheme}://{url.netloc}"
+
+    loop_client = _clients.get(origin)
+    if loop_client is not None:
+        client_loop, client = loop_client
+        if client_loop is loop and not client.is_closed:
+            return client
+
+    client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=MAX_CONNECTIONS,
+            max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        ),
+        # Inference can be slow, the endpoints were previously called without
+        # any timeout.
+        timeout=httpx.Timeout(None),
+    )
+    _clients[origin] = (loop, client)
+    return client
+
+
+def build_headers(model: namedtuple) -> dict:
+    return {
+        "Content-Type": model.content_type,
+        "Authorization": ("Bearer " + model.api_key),
+        model.deployment_platform: model.name,
+    }
+
+
+def endpoints(model: namedtuple) -> list:
+    """
+    Return the replica endpoints of the model, or its only endpoint.
+    """
+    return model.settings.get("replicas") or [model.endpoint]
+
+
+def get_breaker(model: namedtuple, endpoint: str = None) -> CircuitBreaker:
+    endpoint = endpoint or model.endpoint
+    key = (model.name, endpoint)
+    breaker = _breakers.get(key)
+    if breaker is None:
+        breaker = CircuitBreaker(model.name)
+        _breakers[key] = breaker
+    return breaker
+
+
+def circuit_open_error(model: namedtuple) -> CircuitOpenError:
+    retry_after = min(get_breaker(model, endpoint).retry_after() for endpoint in endpoints(model))
+    return CircuitOpenError(
+        f"{model.name} is unavailable, its circuit is open", retry_after
+    )
+
+
+def check_circuit(model: namedtuple):
+    """
+    Raise CircuitOpenError if the circuits of every endpoint of the model are
+    open.
+    """
+    if all(get_breaker(model, endpoint).is_open() for endpoint in endpoints(model)):
+        raise circuit_open_error(model)
+
+
+def is_endpoint_failure(error: httpx.HTTPError) -> bool:
+    # The client errors other than throttling do not mean the endpoint is down
+    if isinstance(error, httpx.HTTPStatusError):
+        status_code = error.response.status_code
+        return status_code >= 500 or status_code == 429
+    return True
+
+
+def breakers_stats() -> dict:
+    stats = {}
+    for (name, endpoint), breaker in _breakers.items():
+        stats.setdefault(name, {})[endpoint] = breaker.stats()
+    return stats
+
+
+def rank_endpoints(model: namedtuple) -> list:
+    """
+    Return the endpoints of the model whose circuit is not open, from the
+    lowest to the highest recent latency.
+    """
+    available = [
+        endpoint for endpoint in endpoints(model)
+        if not get_breaker(model, endpoint).is_open()
+    ]
+    return sorted(available, key=lambda endpoint: get_breaker(model, endpoint).average_latency)
+
+
+def hedge_delay(model: namedtuple, endpoint: str) -> float:
+    """
+    Return the time after which a request to the endpoint is sent again to
+    another replica: the "hedge_percentile" of its recent latency. None
+    disables hedging, until enough requests were measured or when the
+    percentile is 0.
+    """
+    percentile = float(model.settings.get("hedge_percentile", DEFAULT_HEDGE_PERCENTILE))
+    if percentile <= 0:
+        return None
+    return get_breaker(model, endpoint).percentile(percentile / 100)
+
+
+async def post_to_endpoint(model: namedtuple, endpoint: str, body: bytes) -> bytes:
+    """
+    Send the body to one endpoint of the model and return the raw response.
+    The call times out after the adaptive timeout of the endpoint circuit
+    breaker, or earlier at the deadline of the request.
+    """
+    if deadline.expired():
+        raise DeadlineExceededError(
+            f"The budget of the request is spent, {model.name} is not called"
+        )
+    breaker = get_breaker(model, endpoint)
+    call = breaker.before_call()
+    if not call:
+        raise CircuitOpenError(
+            f"{model.name} is unavailable, its circuit is open", breaker.retry_after()
+        )
+
+    recorded = False
+    timeout = breaker.timeout()
+    bounded_timeout = deadline.bound(timeout)
+    try:
+        client = get_client(endpoint)
+        start = time.perf_counter()
+        response = await client.post(
+            endpoint,
+            content=body,
+            headers=build_headers(model),
+            timeout=bounded_timeout,
+        )
+        response.raise_for_status()
+        breaker.record_success(time.perf_counter() - start)
+        recorded = True
+        return response.content
+    except httpx.TimeoutException as error:
+        if bounded_timeout < timeout:
+            # The budget of the request is spent, the endpoint is not at fault
+            raise DeadlineExceededError(
+                f"The budget of the request is spent while requesting {model.name}"
+            ) from error
+        breaker.record_failure()
+        recorded = True
+        raise ModelEndpointError(
+            f"Error while requesting {model.name} : {str(error)}"
+        ) from error
+    except httpx.HTTPError as error:
+        if is_endpoint_failure(error):
+            breaker.record_failure()
+            recorded = True
+        raise ModelEndpointError(
+            f"Error while requesting {model.name} : {str(error)}"
+        ) from error
+    finally:
+        if not recorded:
+            breaker.release(call)
+
+
+async def post(model: namedtuple, body: bytes) -> bytes:
+    """
+    Send the body to the model and return the raw response.
+
+    The body is sent to the replica of the model with the lowest recent
+    latency. If it does not answer within the hedge_delay of that replica,
+    the body is also sent to the next replica: the first success is returned
+    and the other request is cancelled.
+
+    Args:
+        model (namedtuple): The model to call.
+        body (bytes): The request body.
+
+    Returns:
+        bytes: The content of the response.
+
+    Raises:
+        CircuitOpenError: If the circuits of every endpoint of the model are
+        open, without calling them.
+        ModelEndpointError: If the endpoint can't be reached or does not
+        answer with a success status code in time.
+        DeadlineExceededError: If the budget of the request is spent.
+    """
+    ranked = rank_endpoints(model)
+    if not ranked:
+        raise circuit_open_error(model)
+    delay = hedge_delay(model, ranked[0]) if len(ranked) > 1 else None
+    if delay is None:
+        return await post_to_endpoint(model, ranked[0], body)
+
+    first = asyncio.ensure_future(post_to_endpoint(model, ranked[0], body))
+    tasks = [first]
+    try:
+        await asyncio.wait(tasks, timeout=delay)
+        error = None
+        if first.done():
+            if first.cancelled():
+                raise asyncio.CancelledError()
+            error = first.exception()
+            if error is None:
+                return first.result()
+            if deadline.is_deadline_error(error):
+                # The budget is spent, the next replica would not answer in
+                # time either
+                raise error
+
+        # The first replica is slow or failed, the body is also sent to the
+        # next one and the first success wins
+        print(f"Hedging the request to {model.name} on {ranked[1]}")  # TODO: Transform into logging
+        tasks.append(asyncio.ensure_future(post_to_endpoint(model, ranked[1], body)))
+        pending = {task for task in tasks if not task.done()}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.cancelled():
+                    raise asyncio.CancelledError()
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+                if deadline.is_deadline_error(error):
+                    raise error
+        raise error
+    finally:
+        # The slower request is cancelled
+        for task in tasks:
+            task.cancel()
+
+
+def max_concurrency(model: namedtuple) -> int:
+    return max(1, int(model.settings.get("max_concurrency", DEFAULT_MAX_CONCURRENCY)))
+
+
+def get_batcher(model: namedtuple) -> MicroBatcher:
+    """
+    Return the batcher shared by the requests to the model, or None if the
+    model settings do not enable batching with a "batch_size" greater than 1.
+    """
+    batch_size = int(model.settings.get("batch_size", 1))
+    if batch_size <= 1:
+        return None
+
+    loop = asyncio.get_running_loop()
+    key = (model.name, model.endpoint)
+    loop_batcher = _batchers.get(key)
+    if loop_batcher is not None and loop_batcher[0] is loop:
+        return loop_batcher[1]
+
+    batcher = MicroBatcher(
+        model,
+        post,
+        batch_size,
+        float(model.settings.get("batch_wait_ms", DEFAULT_BATCH_WAIT_MS)) / 1000,
+        max_concurrency(model),
+    )
+    _batchers[key] = (loop, batcher)
+    return batcher
+
+
+async def post_input(model: namedtuple, body: bytes) -> bytes:
+    """
+    Send one input to the model, batched with the inputs of the concurrent
+    requests if the model settings enable batching.
+    """
+    batcher = get_batcher(model)
+    if batcher is not None:
+        return await batcher.submit(body)
+    return await post(model, body)
+
+
+def batchers_stats() -> dict:
+    return {name: batcher.stats() for (name, _), (_, batcher) in _batchers.items()}
+
+
+async def post_many(model: namedtuple, bodies: list) -> list:
+    """
+    Send every body to the model endpoint concurrently, with at most
+    max_concurrency(model) requests in flight. The bodies of a CropStream
+    are sent as soon as they are sliced. If the model settings enable
+    batching, the bodies are batched with the ones of the concurrent
+    requests instead.
+
+    Args:
+        model (namedtuple): The model to call.
+        bodies (list[bytes] or CropStream): The request bodies.
+
+    Returns:
+        list[bytes]: The content of the responses, in the order of the bodies.
+
+    Raises:
+        ModelEndpointError: If one of the requests fails. The requests still
+        in flight are cancelled.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency(model))
+    batcher = get_batcher(model)
+
+    async def bounded_post(body):
+        if batcher is not None:
+            # The batcher bounds the batches in flight
+            return await batcher.submit(body)
+        async with semaphore:
+            return await post(model, body)
+
+    tasks = []
+    try:
+        if isinstance(bodies, CropStream):
+            tasks = [None] * len(bodies)
+            async for i, body in bodies.as_completed():
+                tasks[i] = asyncio.ensure_future(bounded_post(body))
+        else:
+            tasks = [asyncio.ensure_future(bounded_post(body)) for body in bodies]
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            if task is not None:
+                task.cancel()
+        if isinstance(bodies, CropStream):
+            bodies.cancel()
+        raise
+
+
+async def close_clients():
+    """
+    Close every pooled client and drop every batcher that belongs to the
+    running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    for origin, (client_loop, client) in list(_clients.items()):
+        if client_loop is loop:
+            await client.aclose()
+            del _clients[origin]
+    for key, (batcher_loop, _) in list(_batchers.items()):
+        if batcher_loop is loop:
+            del _batchers[key]
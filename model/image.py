@@ -0,0 +1,60 @@
+"""
+This file contains the image passed to the first model of a pipeline.
+
+The picture of an inference request is decoded once in app.py and the same
+bytes and PIL image are then shared by the models, the image slicing and the
+storage. The base64 form is only built when a model endpoint requires it.
+"""
+
+import io
+import base64
+
+from PIL import Image
+
+
+class SourceImage:
+    """
+    The picture of an inference request.
+
+    Attributes:
+        data (bytes): The encoded image file (PNG, TIFF, ...).
+    """
+    def __init__(self, data: bytes, base64_data: str = None):
+        self.data = data
+        self._base64 = base64_data
+        self._image = None
+
+    @classmethod
+    def from_base64(cls, base64_data: str) -> "SourceImage":
+        return cls(base64.b64decode(base64_data), base64_data)
+
+    @classmethod
+    def coerce(cls, image) -> "SourceImage":
+        """
+        Return the image as a SourceImage, decoding it if it is still the
+        base64 string used before the image was shared between the models.
+        """
+        if isinstance(image, cls):
+            return image
+        return cls.from_base64(image)
+
+    @property
+    def base64(self) -> str:
+        """
+        The image encoded in base64, as sent to the model endpoints. It is
+        only encoded the first time it is needed.
+        """
+        if self._base64 is None:
+            self._base64 = base64.b64encode(self.data).decode("ascii")
+        return self._base64
+
+    def open(self) -> Image.Image:
+        """
+        Return the PIL image, opened the first time it is needed.
+        """
+        if self._image is None:
+            self._image = Image.open(io.BytesIO(self.data))
+        return self._image
+
+    def __len__(self) -> int:
+        return len(self.data)
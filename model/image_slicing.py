@@ -0,0 +1,378 @@
+"""
+This file contains the slicing of the source image into one cropped image per
+box found by the seed detector.
+
+Cropping and encoding dozens of seeds is CPU bound, so it is done by a pool of
+processes instead of the event loop. The decoded pixels of the source image
+are written once to shared memory, and every task only receives the name of
+the shared memory block and the box to crop. The crops are returned as they
+complete.
+"""
+
+import io
+import os
+import base64
+import asyncio
+import threading
+import multiprocessing
+
+from collections import namedtuple
+from multiprocessing import shared_memory, resource_tracker
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image
+
+from model.image import SourceImage
+from model.model_exceptions import ModelAPIError
+
+
+class ImageSlicingError(ModelAPIError):
+    pass
+
+
+# Number of processes cropping the images, 0 crops them in a thread of the
+# server process
+SLICING_PROCESSES = int(
+    os.getenv("NACHET_SLICING_PROCESSES", min(4, os.cpu_count() or 1))
+)
+
+RESAMPLING_FILTERS = {
+    "nearest": Image.Resampling.NEAREST,
+    "box": Image.Resampling.BOX,
+    "bilinear": Image.Resampling.BILINEAR,
+    "hamming": Image.Resampling.HAMMING,
+    "bicubic": Image.Resampling.BICUBIC,
+    "lanczos": Image.Resampling.LANCZOS,
+}
+CROP_FORMATS = ("PNG", "JPEG", "RAW")
+DEFAULT_CROP_QUALITY = 90
+
+# How the crops are sent to the next model of the pipeline. A None size
+# keeps the crops at the resolution of the source image and a None format
+# encodes them in the format of the source image.
+CropEncoding = namedtuple("CropEncoding", ["size", "resample", "format", "quality"])
+SOURCE_ENCODING = CropEncoding(None, Image.Resampling.BICUBIC, None, DEFAULT_CROP_QUALITY)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Fork when possible: spawned processes would import the main
+            # module of the server again
+            start_method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+            # The processes must share the resource tracker of the server,
+            # their own would remove the shared memory when they exit
+            resource_tracker.ensure_running()
+            _pool = ProcessPoolExecutor(
+                max_workers=SLICING_PROCESSES,
+                mp_context=multiprocessing.get_context(start_method),
+            )
+        return _pool
+
+
+def start():
+    """
+    Start the processes ahead of the first request, before the server
+    starts its threads.
+    """
+    if SLICING_PROCESSES > 0:
+        get_pool().submit(int).result()
+
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def box_coordinates(box: dict, width: int, height: int) -> tuple:
+    return (
+        int(box['box']['topX'] * width),
+        int(box['box']['topY'] * height),
+        int(box['box']['bottomX'] * width),
+        int(box['box']['bottomY'] * height),
+    )
+
+
+def crop_encoding(settings: dict) -> CropEncoding:
+    """
+    Read the crop settings of the model slicing the image.
+
+    Args:
+        settings (dict): The settings of the model, with the optional keys
+        crop_size (int or [width, height]), crop_resample (name of a PIL
+        resampling filter), crop_format ("PNG", "JPEG" or "RAW") and
+        crop_quality (JPEG quality, 1 to 95).
+
+    Raises:
+        ValueError: If a setting is invalid.
+    """
+    size = settings.get("crop_size")
+    if size is not None:
+        size = (size, size) if isinstance(size, int) else tuple(size)
+        if len(size) != 2 or not all(isinstance(n, int) and n > 0 for n in size):
+            raise ValueError(f"invalid crop_size: {settings.get('crop_size')}")
+
+    resample = str(settings.get("crop_resample", "bicubic")).lower()
+    if resample not in RESAMPLING_FILTERS:
+        raise ValueError(f"invalid crop_resample: {resample}, expected one of {list(RESAMPLING_FILTERS)}")
+
+    format = settings.get("crop_format")
+    if format is not None:
+        format = str(format).upper()
+        if format not in CROP_FORMATS:
+            raise ValueError(f"invalid crop_format: {format}, expected one of {list(CROP_FORMATS)}")
+        if format == "RAW" and size is None:
+            # The model could not know the dimensions of the pixels
+            raise ValueError("crop_format RAW requires a crop_size")
+
+    quality = settings.get("crop_quality", DEFAULT_CROP_QUALITY)
+    if not isinstance(quality, int) or not 1 <= quality <= 95:
+        raise ValueError(f"invalid crop_quality: {quality}")
+
+    return CropEncoding(size, RESAMPLING_FILTERS[resample], format, quality)
+
+
+def encode_crop(image: Image.Image, coordinates: tuple, format: str, encoding: CropEncoding = SOURCE_ENCODING) -> bytes:
+    img = image.crop(coordinates)
+    if encoding.size is not None:
+        img = img.resize(encoding.size, encoding.resample)
+
+    format = encoding.format or format
+    if format == "RAW":
+        return base64.b64encode(img.convert("RGB").tobytes())
+
+    buffered = io.BytesIO()
+    if format == "JPEG":
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        img.save(buffered, format, quality=encoding.quality)
+    else:
+        img.save(buffered, format)
+
+    return base64.b64encode(buffered.getvalue())
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 the block is registered again to the resource
+        # tracker shared with the server process, which removes it once
+        return shared_memory.SharedMemory(name=name)
+
+
+def _crop_shared(name: str, mode: str, size: tuple, stride: int, palette: list, info: dict, format: str, coordinates: tuple, encoding: CropEncoding) -> bytes:
+    left, top, right, bottom = coordinates
+    width, height = size
+    top, bottom = max(0, min(top, height)), max(0, min(bottom, height))
+    shm = _attach(name)
+    try:
+        # Only the rows of the box are copied out of the shared memory
+        rows = shm.buf[top * stride:bottom * stride]
+        try:
+            image = Image.frombytes(mode, (width, bottom - top), rows)
+        finally:
+            rows.release()
+    finally:
+        shm.close()
+    if palette is not None:
+        image.putpalette(palette)
+    image.info = info
+    return encode_crop(image, (left, coordinates[1] - top, right, coordinates[3] - top), format, encoding)
+
+
+class SharedImage:
+    """
+    Decoded pixels of an image copied to a shared memory block.
+    """
+    def __init__(self, image: Image.Image):
+        image.load()
+        pixels = image.tobytes()
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, len(pixels)))
+        self.shm.buf[:len(pixels)] = pixels
+        self.mode = image.mode
+        self.size = image.size
+        self.stride = len(pixels) // image.height if image.height else 0
+        self.palette = image.getpalette() if image.mode in ("P", "PA") else None
+        # Only the simple values are sent to the processes
+        self.info = {
+            key: value for key, value in image.info.items()
+            if isinstance(value, (int, float, str, bytes, tuple))
+        }
+
+    def crop_arguments(self, format: str, coordinates: tuple, encoding: CropEncoding) -> tuple:
+        return (self.shm.name, self.mode, self.size, self.stride, self.palette, self.info, format, coordinates, encoding)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def crop_coordinates(image: Image.Image, boxes: list) -> list:
+    return [box_coordinates(box, image.width, image.height) for box in boxes]
+
+
+async def _iter_crops(image: Image.Image, coordinates: list, encoding: CropEncoding):
+    format = image.format
+    if not coordinates:
+        return
+
+    if SLICING_PROCESSES <= 0:
+        for i, box_coordinates_ in enumerate(coordinates):
+            yield i, await asyncio.to_thread(encode_crop, image, box_coordinates_, format, encoding)
+        return
+
+    loop = asyncio.get_running_loop()
+    shared_image = await asyncio.to_thread(SharedImage, image)
+    futures = {}
+    try:
+        try:
+            pool = get_pool()
+            for i, box_coordinates_ in enumerate(coordinates):
+                future = loop.run_in_executor(
+                    pool, _crop_shared, *shared_image.crop_arguments(format, box_coordinates_, encoding)
+                )
+                futures[future] = i
+        except BrokenProcessPool:
+            # A process died, the next call starts a new pool
+            shutdown()
+            raise
+
+        pending = set(futures)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                yield futures[future], future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+        # The processes still cropping must be done with the shared memory
+        # before it is removed
+        await asyncio.gather(*futures, return_exceptions=True)
+        shared_image.close()
+
+
+async def iter_crops(source_image: SourceImage, boxes: list, encoding: CropEncoding = SOURCE_ENCODING):
+    """
+    Crop every box of the source image and encode it as the next model of the
+    pipeline expects it.
+
+    Args:
+        source_image (SourceImage): The image to slice.
+        boxes (list): The boxes found by the seed detector, with coordinates
+        relative to the size of the image.
+        encoding (CropEncoding): The size and format of the crops, see
+        crop_encoding.
+
+    Yields:
+        tuple: The index of the box and its cropped image encoded in base64,
+        in the order the crops complete.
+    """
+    image = source_image.open()
+    async for i, crop in _iter_crops(image, crop_coordinates(image, boxes), encoding):
+        yield i, crop
+
+
+class CropStream:
+    """
+    The cropped images of the boxes, sliced in the background so the next
+    model can send each crop as soon as it is encoded instead of waiting for
+    all of them.
+
+    The boxes are converted to coordinates when the stream is created, so
+    invalid boxes raise at once. The errors while slicing are raised to the
+    consumers as ImageSlicingError.
+    """
+    def __init__(self, source_image: SourceImage, boxes: list, encoding: CropEncoding = SOURCE_ENCODING):
+        image = source_image.open()
+        coordinates = crop_coordinates(image, boxes)
+        self._crops = [None] * len(boxes)
+        # Indexes of the crops in the order they completed
+        self._completed = []
+        self._finished = False
+        self._error = None
+        self._condition = asyncio.Condition()
+        self._task = asyncio.ensure_future(self._produce(image, coordinates, encoding))
+
+    async def _produce(self, image: Image.Image, coordinates: list, encoding: CropEncoding):
+        try:
+            async for i, crop in _iter_crops(image, coordinates, encoding):
+                self._crops[i] = crop
+                async with self._condition:
+                    self._completed.append(i)
+                    self._condition.notify_all()
+        except asyncio.CancelledError:
+            self._error = ImageSlicingError("The slicing of the image was cancelled")
+            raise
+        except Exception as error:
+            print(error)
+            self._error = ImageSlicingError(f"Error while slicing the image :\n {str(error)}")
+            self._error.__cause__ = error
+        finally:
+            async with self._condition:
+                self._finished = True
+                self._condition.notify_all()
+
+    def __len__(self) -> int:
+        return len(self._crops)
+
+    async def as_completed(self):
+        """
+        Yield the index and the cropped image of every box, in the order the
+        crops complete. The stream can be read by several consumers.
+        """
+        count = 0
+        while True:
+            async with self._condition:
+                await self._condition.wait_for(
+                    lambda: len(self._completed) > count or self._finished
+                )
+                completed = self._completed[count:]
+                finished = self._finished
+            for i in completed:
+                yield i, self._crops[i]
+            count += len(completed)
+            if finished and count == len(self._completed):
+                if self._error is not None:
+                    raise self._error
+                return
+
+    async def result(self) -> list:
+        """
+        Return the cropped images in the order of the boxes once they are all
+        sliced.
+        """
+        async for _ in self.as_completed():
+            pass
+        return list(self._crops)
+
+    def cancel(self):
+        self._task.cancel()
+
+
+async def slice_image(source_image: SourceImage, boxes: list, encoding: CropEncoding = SOURCE_ENCODING) -> list:
+    """
+    Return the cropped images of the boxes, in the order of the boxes.
+    """
+    cropped_images = [bytes(0) for _ in boxes]
+    async for i, cropped_image in iter_crops(source_image, boxes, encoding):
+        cropped_images[i] = cropped_image
+    return cropped_images
+
+
+async def resolve_crops(images) -> list:
+    """
+    Return the cropped images passed between the models as a list, waiting
+    for the end of the slicing if they are still streamed.
+    """
+    if isinstance(images, CropStream):
+        return await images.result()
+    return images
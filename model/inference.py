@@ -8,6 +8,7 @@ overlapping boxes, label occurrence, and colors for each species found.
 The colors can be returned in HEX or RGB format depending on the frontend preference.
 """
 
+import os
 import numpy as np
 
 from model.color_palette import primary_colors, light_colors, mixing_palettes, shades_colors
@@ -16,16 +17,254 @@ from model.model_exceptions import ModelAPIError
 class ProcessInferenceResultsModelAPIError(ModelAPIError) :
     pass
 
+# Above this number of boxes, the overlapping boxes are searched with a grid
+# index instead of the full overlap matrix to bound the memory used.
+SPATIAL_INDEX_THRESHOLD = int(os.getenv("NACHET_OVERLAP_INDEX_THRESHOLD", 1000))
+
 def generator(list_length):
     for i in range(list_length):
         yield i
 
 
+def clip_boxes(boxes: list, imageDims: 'list[int, int]') -> np.ndarray:
+    """
+    Scale the relative coordinates of the boxes to the image dimensions and
+    keep them 5 pixels inside the image.
+
+    Returns:
+        np.ndarray: A (n, 4) array of topX, topY, bottomX, bottomY.
+    """
+    coordinates = np.array(
+        [
+            [box["box"]["topX"], box["box"]["topY"], box["box"]["bottomX"], box["box"]["bottomY"]]
+            for box in boxes
+        ],
+        dtype=float,
+    ).reshape(-1, 4)
+    dims = np.array(
+        [imageDims[0], imageDims[1], imageDims[0], imageDims[1]], dtype=float
+    )
+    return np.clip(coordinates * dims, 5, dims - 5).astype(np.int64)
+
+
+def overlaps(box: np.ndarray, candidates: np.ndarray, area_ratio: float) -> np.ndarray:
+    """
+    Indicate which candidates overlap the box. Two boxes overlap if their
+    common area is greater than the area_ratio of the area of each box.
+
+    The arrays are broadcast against each other, so a (n, 1, 4) box array
+    and a (1, n, 4) candidates array give the (n, n) overlap matrix.
+    """
+    area_box = (box[..., 2] - box[..., 0]) * (box[..., 3] - box[..., 1])
+    area_candidates = (candidates[..., 2] - candidates[..., 0]) \
+        * (candidates[..., 3] - candidates[..., 1])
+
+    width = np.maximum(
+        0,
+        np.minimum(box[..., 2], candidates[..., 2]) - np.maximum(box[..., 0], candidates[..., 0])
+    )
+    height = np.maximum(
+        0,
+        np.minimum(box[..., 3], candidates[..., 3]) - np.maximum(box[..., 1], candidates[..., 1])
+    )
+    common_area = width * height
+
+    return (common_area >= area_box * area_ratio) \
+        & (common_area >= area_candidates * area_ratio)
+
+
+class OverlapMatrix:
+    """
+    Overlap of every pair of boxes, computed at once. The comparisons with a
+    box that took new coordinates are computed again when needed.
+    """
+    def __init__(self, coordinates: np.ndarray, area_ratio: float):
+        self.coordinates = coordinates
+        self.area_ratio = area_ratio
+        self.matrix = overlaps(coordinates[:, None, :], coordinates[None, :, :], area_ratio)
+        self.moved = np.zeros(len(coordinates), dtype=bool)
+
+    def candidates(self, i: int) -> np.ndarray:
+        return np.arange(i + 1, len(self.coordinates))
+
+    def row(self, i: int) -> 'tuple[np.ndarray, np.ndarray]':
+        columns = self.candidates(i)
+        if self.moved[i]:
+            return columns, overlaps(self.coordinates[i], self.coordinates[columns], self.area_ratio)
+
+        row = self.matrix[i, i + 1:].copy()
+        stale = np.flatnonzero(self.moved[i + 1:])
+        if stale.size:
+            row[stale] = overlaps(
+                self.coordinates[i], self.coordinates[columns[stale]], self.area_ratio
+            )
+        return columns, row
+
+    def move(self, i: int):
+        self.moved[i] = True
+
+
+class BoxGrid:
+    """
+    Grid bucket index of the boxes. Two boxes with a common area share at
+    least one cell, so only the boxes registered in the cells of a box are
+    compared with it.
+
+    Boxes with no area (or an inverted side) can only overlap each other and
+    are kept apart, as are the boxes covering too many cells which are
+    compared with every box.
+    """
+    def __init__(self, coordinates: np.ndarray, area_ratio: float, max_cells: int = 64):
+        self.coordinates = coordinates
+        self.area_ratio = area_ratio
+        self.max_cells = max_cells
+        self.cells = {}
+        self.box_cells = {}
+        self.oversized = set()
+        self.sized = set()
+
+        widths = coordinates[:, 2] - coordinates[:, 0]
+        heights = coordinates[:, 3] - coordinates[:, 1]
+        sized = (widths > 0) & (heights > 0)
+        self.flat = set(np.flatnonzero(~sized & (widths * heights <= 0)).tolist())
+
+        if sized.any():
+            self.cell_size = max(1, int(np.median(np.maximum(widths[sized], heights[sized]))))
+        else:
+            self.cell_size = 1
+
+        for i in np.flatnonzero(sized).tolist():
+            self.insert(i)
+
+    def insert(self, i: int):
+        topX, topY, bottomX, bottomY = self.coordinates[i].tolist()
+        columns = range(topX // self.cell_size, (bottomX - 1) // self.cell_size + 1)
+        rows = range(topY // self.cell_size, (bottomY - 1) // self.cell_size + 1)
+
+        self.sized.add(i)
+        if len(columns) * len(rows) > self.max_cells:
+            self.oversized.add(i)
+            return
+
+        cells = [(x, y) for x in columns for y in rows]
+        for cell in cells:
+            self.cells.setdefault(cell, set()).add(i)
+        self.box_cells[i] = cells
+
+    def remove(self, i: int):
+        self.sized.discard(i)
+        self.oversized.discard(i)
+        for cell in self.box_cells.pop(i, ()):
+            self.cells[cell].discard(i)
+
+    def candidates(self, i: int) -> np.ndarray:
+        if i in self.flat:
+            found = self.flat
+        elif i in self.oversized:
+            found = self.sized
+        elif i in self.box_cells:
+            found = set(self.oversized)
+            for cell in self.box_cells[i]:
+                found.update(self.cells[cell])
+        else:
+            return np.empty(0, dtype=np.int64)
+
+        return np.array(sorted(j for j in found if j > i), dtype=np.int64)
+
+    def row(self, i: int) -> 'tuple[np.ndarray, np.ndarray]':
+        columns = self.candidates(i)
+        return columns, overlaps(self.coordinates[i], self.coordinates[columns], self.area_ratio)
+
+    def move(self, i: int):
+        # A box only takes the coordinates of a box it overlaps, so it stays
+        # in the same group (sized or flat)
+        if i in self.sized:
+            self.remove(i)
+            self.insert(i)
+
+
+def find_overlapping_boxes(
+        coordinates: np.ndarray,
+        scores: np.ndarray,
+        area_ratio: float,
+        index_threshold: int = None
+) -> 'tuple[list[bool], list[list[int]]]':
+    """
+    Compare every box with the boxes after it. When two boxes overlap, the
+    lower score box is flagged as overlapping and takes the coordinates of
+    the higher score one, the index (starting at 1) of the second box is added
+    to the overlapping indices of the first one.
+
+    The boxes are compared in order and a box that took new coordinates is
+    compared with the next boxes using them. Up to index_threshold boxes, the
+    overlap matrix is computed once and only the comparisons involving moved
+    boxes are computed again. Above it, a grid index gives the boxes that can
+    overlap each box so the memory stays linear in the number of boxes.
+
+    Args:
+        coordinates (np.ndarray): The (n, 4) box coordinates, updated in place.
+        scores (np.ndarray): The n box scores.
+        area_ratio (float): The area ratio used to detect overlapping boxes.
+        index_threshold (int): The number of boxes above which the grid index
+        is used (default = SPATIAL_INDEX_THRESHOLD).
+
+    Returns:
+        tuple: The overlapping flag and the overlapping indices of each box.
+    """
+    if index_threshold is None:
+        index_threshold = SPATIAL_INDEX_THRESHOLD
+
+    n = len(coordinates)
+    overlapping = np.zeros(n, dtype=bool)
+    overlapping_indices = [[] for _ in range(n)]
+
+    # With a null area ratio, boxes without a common area overlap, the grid
+    # can't be used
+    if n > index_threshold and area_ratio > 0:
+        index = BoxGrid(coordinates, area_ratio)
+    else:
+        index = OverlapMatrix(coordinates, area_ratio)
+
+    for i in range(n - 1):
+        columns, row = index.row(i)
+
+        while row.any():
+            hits = columns[row]
+            lower = scores[hits] < scores[i]
+            higher = np.flatnonzero(scores[i] < scores[hits])
+            end = higher[0] if higher.size else len(hits)
+
+            # The next boxes with a lower score take the box coordinates
+            for j in hits[:end][lower[:end]]:
+                overlapping[j] = True
+                overlapping_indices[i].append(int(j) + 1)
+                coordinates[j] = coordinates[i]
+                index.move(j)
+
+            if not higher.size:
+                break
+
+            # The box has a lower score, it takes the coordinates of the
+            # other box which are used for the remaining comparisons
+            j = hits[end]
+            overlapping[i] = True
+            overlapping_indices[i].append(int(j) + 1)
+            coordinates[i] = coordinates[j]
+            index.move(i)
+
+            columns = index.candidates(i)
+            columns = columns[columns > j]
+            row = overlaps(coordinates[i], coordinates[columns], area_ratio)
+
+    return overlapping.tolist(), overlapping_indices
+
+
 async def process_inference_results(
         data: dict,
         imageDims: 'list[int, int]',
         area_ratio: float = 0.5,
-        color_format: str = "hex"
+        color_format: str = "hex",
+        index_threshold: int = None
 ) -> dict:
     """
     Process the inference results by performing various operations on the data.
@@ -40,6 +279,8 @@ async def process_inference_results(
         overlap claculation.
         color_format (str): Specified the format representation of the color.
         Support hex and rgb.
+        index_threshold (int): The number of boxes above which a grid index is
+        used to find the overlapping boxes (default = SPATIAL_INDEX_THRESHOLD).
 
     Returns:
         dict: The processed inference result data.
@@ -52,74 +293,28 @@ async def process_inference_results(
         boxes = data[0]['boxes']
         colors = mixing_palettes(primary_colors, light_colors).get(color_format)
 
-        # Perform operations on each box in the data
-        for i, box in enumerate(boxes):
-            # Set default overlapping attribute to false for each box
-            boxes[i]["overlapping"] = False
-            # Set default overlapping indices to empty array for each box
-            boxes[i]["overlappingIndices"] = []
-
-            # Perform calculations on box coordinates
-            box["box"]["bottomX"] = int(
-                np.clip(box["box"]["bottomX"] * imageDims[0], 5, imageDims[0] - 5)
-            )
-            box["box"]["bottomY"] = int(
-                np.clip(box["box"]["bottomY"] * imageDims[1], 5, imageDims[1] - 5)
-            )
-            box["box"]["topX"] = int(
-                np.clip(box["box"]["topX"] * imageDims[0], 5, imageDims[0] - 5)
-            )
-            box["box"]["topY"] = int(
-                np.clip(box["box"]["topY"] * imageDims[1], 5, imageDims[1] - 5)
-            )
+        # Perform calculations on box coordinates
+        coordinates = clip_boxes(boxes, imageDims)
+        scores = np.array([box["score"] for box in boxes])
 
         # Check if there are any overlapping boxes, if so, put the lower score
         # box in the overlapping key
-        for i, box in enumerate(boxes):
-            for j, box2 in enumerate(boxes):
-                if j > i:
-                    # Calculate the common region of the two boxes to determine
-                    # if they are overlapping
-                    area_box = (box["box"]["bottomX"] - box["box"]["topX"]) \
-                                * (box["box"]["bottomY"] - box["box"]["topY"])
-                    area_candidate = (box2["box"]["bottomX"] - box2["box"]["topX"]) \
-                                    * (box2["box"]["bottomY"] - box2["box"]["topY"])
-
-                    intersection_topX = max(
-                        box["box"]["topX"], box2["box"]["topX"])
-                    intersection_topY = max(
-                        box["box"]["topY"], box2["box"]["topY"])
-                    intersection_bottomX = min(
-                        box["box"]["bottomX"], box2["box"]["bottomX"])
-                    intersection_bottomY = min(
-                        box["box"]["bottomY"], box2["box"]["bottomY"])
-
-                    width = max(0, intersection_bottomX - intersection_topX)
-                    height = max(0, intersection_bottomY - intersection_topY)
-
-                    common_area = width * height
-
-                    if common_area >= area_box * area_ratio \
-                        and common_area >= area_candidate * area_ratio:
-                        # box2 is the lower score box
-                        if box2["score"] < box["score"]:
-                            boxes[j]["overlapping"] = True
-                            boxes[i]["overlappingIndices"].append(j + 1)
-                            box2["box"]["bottomX"] = box["box"]["bottomX"]
-                            box2["box"]["bottomY"] = box["box"]["bottomY"]
-                            box2["box"]["topX"] = box["box"]["topX"]
-                            box2["box"]["topY"] = box["box"]["topY"]
-                        # box is the lower score box
-                        elif box["score"] < box2["score"]:
-                            boxes[i]["overlapping"] = True
-                            boxes[i]["overlappingIndices"].append(j + 1)
-                            box["box"]["bottomX"] = box2["box"]["bottomX"]
-                            box["box"]["bottomY"] = box2["box"]["bottomY"]
-                            box["box"]["topX"] = box2["box"]["topX"]
-                            box["box"]["topY"] = box2["box"]["topY"]
+        overlapping, overlapping_indices = find_overlapping_boxes(
+            coordinates, scores, area_ratio, index_threshold
+        )
+
+        for i, (box, (topX, topY, bottomX, bottomY)) in enumerate(
+            zip(boxes, coordinates.tolist())
+        ):
+            box["overlapping"] = overlapping[i]
+            box["overlappingIndices"] = overlapping_indices[i]
+            box["box"]["topX"] = topX
+            box["box"]["topY"] = topY
+            box["box"]["bottomX"] = bottomX
+            box["box"]["bottomY"] = bottomY
 
         # Calculate label occurrence
-        gen = generator(i) # Number of individual seed (boxes)
+        gen = generator(len(boxes) - 1) # Number of individual seed (boxes)
         label_occurrence = {}
         label_colors = {}
         for i, box in enumerate(boxes):
@@ -0,0 +1,173 @@
+"""
+This file contains the queue of the inference jobs.
+
+A job is submitted with the arguments of an inference request and its id is
+returned at once. A pool of NACHET_INFERENCE_JOB_WORKERS tasks runs the jobs
+in order of submission, and their result is kept for
+NACHET_INFERENCE_JOB_RETENTION_SECONDS so the client polls it instead of
+holding a connection open while a heavy pipeline runs.
+"""
+
+import os
+import time
+import uuid
+import asyncio
+
+from model.model_exceptions import ModelAPIError
+from storage.cache import LRUCache
+
+WORKERS = int(os.getenv("NACHET_INFERENCE_JOB_WORKERS", 4))
+QUEUE_SIZE = int(os.getenv("NACHET_INFERENCE_JOB_QUEUE_SIZE", 100))
+RETENTION_SECONDS = float(os.getenv("NACHET_INFERENCE_JOB_RETENTION_SECONDS", 600))
+# Finished jobs kept at most, the oldest are forgotten first
+MAX_RESULTS = int(os.getenv("NACHET_INFERENCE_JOB_RESULTS", 1000))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobQueueFullError(ModelAPIError):
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class JobQueue:
+    """
+    Bounded queue of jobs run by a pool of worker tasks. A job is a coroutine
+    function returning the result, the status code and the headers of the
+    response, as run_inference does.
+    """
+    def __init__(
+        self,
+        workers: int = WORKERS,
+        queue_size: int = QUEUE_SIZE,
+        retention_seconds: float = RETENTION_SECONDS,
+        max_results: int = MAX_RESULTS,
+    ):
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self._loop = None
+        self._queue = None
+        self._tasks = []
+        # job id -> job, until the job is finished
+        self._jobs = {}
+        self._results = LRUCache(max_results, ttl=retention_seconds)
+        self._submitted = 0
+        self._rejected = 0
+        self._done = 0
+        self._failed = 0
+        self._total_run_time = 0.0
+
+    def start(self):
+        """
+        Start the workers on the running event loop, if they are not already.
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._queue = asyncio.Queue(self.queue_size)
+        self._jobs.clear()
+        self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """
+        Cancel the workers. The jobs not finished are lost.
+        """
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._loop = None
+        self._queue = None
+        self._jobs.clear()
+
+    def retry_after(self) -> float:
+        """
+        Estimate the seconds until the queued jobs are done.
+        """
+        finished = self._done + self._failed
+        run_time = self._total_run_time / finished if finished else 1.0
+        return max(1.0, run_time * self._queue.qsize() / self.workers)
+
+    def submit(self, func, *args, progress: dict = None) -> dict:
+        """
+        Queue the job func(*args) and return its state. The progress dict,
+        updated by the job while it runs, is reported with its state.
+
+        Raises:
+            JobQueueFullError: If queue_size jobs are already waiting.
+        """
+        self.start()
+        job = {
+            "job_id": uuid.uuid4().hex,
+            "status": QUEUED,
+            "submitted_at": time.time(),
+        }
+        if progress is not None:
+            job["progress"] = progress
+        try:
+            self._queue.put_nowait((job, func, args))
+        except asyncio.QueueFull:
+            self._rejected += 1
+            raise JobQueueFullError("The inference job queue is full", self.retry_after()) from None
+        self._submitted += 1
+        self._jobs[job["job_id"]] = job
+        return dict(job)
+
+    def get(self, job_id: str) -> dict:
+        """
+        Return the state of the job, with its result once it is finished, or
+        None if it is unknown or its result expired.
+        """
+        job = self._jobs.get(job_id) or self._results.get(job_id)
+        return None if job is None else dict(job)
+
+    async def _work(self):
+        while True:
+            job, func, args = await self._queue.get()
+            job["status"] = RUNNING
+            job["started_at"] = time.time()
+            started = time.perf_counter()
+            try:
+                result, status_code, headers = await func(*args)
+            except Exception as error:
+                print(error)
+                result, status_code, headers = ["Unhandled error during the inference job"], 500, {}
+            finally:
+                self._total_run_time += time.perf_counter() - started
+                self._queue.task_done()
+
+            job.update({
+                "status": DONE if status_code < 400 else FAILED,
+                "finished_at": time.time(),
+                "status_code": status_code,
+                "headers": headers,
+                "result": result,
+            })
+            if status_code < 400:
+                self._done += 1
+            else:
+                self._failed += 1
+            self._results.set(job["job_id"], job)
+            self._jobs.pop(job["job_id"], None)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "running": sum(1 for job in self._jobs.values() if job["status"] == RUNNING),
+            "submitted": self._submitted,
+            "rejected": self._rejected,
+            "done": self._done,
+            "failed": self._failed,
+            "mean_run_time": (
+                self._total_run_time / (self._done + self._failed)
+                if self._done + self._failed else 0.0
+            ),
+            "results": self._results.stats(),
+        }
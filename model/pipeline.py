@@ -0,0 +1,240 @@
+"""
+This file contains the engine running the models of a pipeline.
+
+A pipeline is a graph of models. Every model receives the result of the
+models it depends on, or the image of the request, and the models that do
+not depend on each other are called concurrently. By default every model
+depends on the previous one, in the order of the pipeline, so the first model
+receives the image and the result of the pipeline is the one of the last
+model.
+
+When the deadline of the request passes before the output model completes,
+the pipeline returns instead the result of the last model of the output
+chain that completed, marked as partial.
+"""
+
+import copy
+import time
+import asyncio
+
+from collections import namedtuple
+from model import deadline
+from model.deadline import DeadlineExceededError
+from model.model_exceptions import ModelAPIError
+
+# Name of the input holding the image of the request
+SOURCE = "image"
+
+
+class PipelineGraphError(ModelAPIError):
+    pass
+
+
+def _own_copy(result):
+    """
+    Return the result of a model with its own copy of the boxes. The request
+    functions label the boxes of their input in place, so the models reading
+    the same result must not share them. The images are not copied.
+    """
+    if isinstance(result, dict) and "result_json" in result:
+        return {**result, "result_json": copy.deepcopy(result["result_json"])}
+    return result
+
+
+PipelineRun = namedtuple(
+    "PipelineRun", ["result", "results", "timings", "partial"], defaults=(False,)
+)
+
+
+class PipelineGraph:
+    """
+    The models of a pipeline and their dependencies.
+
+    Args:
+        models (tuple): The models of the pipeline, in order.
+        dependencies (dict): For the models that do not simply depend on the
+        previous one, the name of the model (or "image") whose result they
+        receive. A model depending on several models receives a dict of
+        their results by name.
+        output (str): The model whose result is the result of the pipeline,
+        the last model by default.
+
+    Raises:
+        PipelineGraphError: If a dependency is unknown or the dependencies
+        form a cycle.
+    """
+    def __init__(self, models: tuple, dependencies: dict = None, output: str = None):
+        if not models:
+            raise PipelineGraphError("The pipeline has no model")
+        dependencies = dependencies or {}
+        self.models = {model.name: model for model in models}
+
+        unknown = [name for name in dependencies if name not in self.models]
+        if unknown:
+            raise PipelineGraphError(f"Dependencies defined for unknown models: {unknown}")
+
+        self.dependencies = {}
+        previous = SOURCE
+        for model in models:
+            model_dependencies = dependencies.get(model.name, previous)
+            if isinstance(model_dependencies, str):
+                model_dependencies = [model_dependencies]
+            model_dependencies = list(model_dependencies)
+            unknown = [
+                name for name in model_dependencies
+                if name != SOURCE and name not in self.models
+            ]
+            if unknown or not model_dependencies:
+                raise PipelineGraphError(
+                    f"Invalid dependencies for model {model.name}: {model_dependencies}"
+                )
+            self.dependencies[model.name] = model_dependencies
+            previous = model.name
+
+        self.output = output or models[-1].name
+        if self.output not in self.models:
+            raise PipelineGraphError(f"Unknown output model: {self.output}")
+
+        self.order = self._sort()
+        # name -> number of models reading its result
+        self._consumers = {name: 0 for name in self.models}
+        for model_dependencies in self.dependencies.values():
+            for dependency in model_dependencies:
+                if dependency != SOURCE:
+                    self._consumers[dependency] += 1
+        # name -> [calls, total time, max time]
+        self._timings = {name: [0, 0.0, 0.0] for name in self.models}
+
+    @classmethod
+    def from_definition(cls, models: tuple, pipeline: dict) -> "PipelineGraph":
+        """
+        Build the graph of a pipeline of the ML structure.
+        """
+        return cls(models, pipeline.get("dependencies"), pipeline.get("output"))
+
+    def _sort(self) -> list:
+        # Kahn's algorithm, keeping the order of the pipeline between the
+        # models that are ready at the same time
+        remaining = {
+            name: {dependency for dependency in dependencies if dependency != SOURCE}
+            for name, dependencies in self.dependencies.items()
+        }
+        order = []
+        while remaining:
+            ready = [name for name, dependencies in remaining.items() if not dependencies]
+            if not ready:
+                raise PipelineGraphError(f"The dependencies of the models form a cycle: {list(remaining)}")
+            for name in ready:
+                del remaining[name]
+                order.append(name)
+            for dependencies in remaining.values():
+                dependencies.difference_update(ready)
+        return order
+
+    async def run(self, source) -> PipelineRun:
+        """
+        Call every model of the pipeline as soon as the results it depends on
+        are ready.
+
+        Args:
+            source: The image of the request.
+
+        Returns:
+            PipelineRun: The result of the output model, the results of every
+            model by name and the time taken by every model in seconds. If the
+            deadline of the request passed, the result is the one of the last
+            completed model the output depends on and partial is True.
+
+        Raises:
+            DeadlineExceededError: If the deadline passed before any model the
+            output depends on completed.
+        """
+        tasks = {}
+        timings = {}
+        # name -> number of models that did not take its result yet
+        consumers = dict(self._consumers)
+
+        async def take(dependency):
+            result = await tasks[dependency]
+            consumers[dependency] -= 1
+            # Only a result read by several models is copied, the last one
+            # takes the original
+            return _own_copy(result) if consumers[dependency] else result
+
+        async def run_model(name):
+            dependencies = self.dependencies[name]
+            inputs = [
+                source if dependency == SOURCE else await take(dependency)
+                for dependency in dependencies
+            ]
+            previous_result = inputs[0] if len(inputs) == 1 else dict(zip(dependencies, inputs))
+
+            model = self.models[name]
+            print(f"Entering {name.upper()} model")  # TODO: Transform into logging
+            model_time = time.perf_counter()
+            result = await model.request_function(model, previous_result)
+            timings[name] = time.perf_counter() - model_time
+            print(f"Time {name}: {timings[name]} seconds")  # TODO: Transform into logging
+            self._record(name, timings[name])
+            return result
+
+        # The models are scheduled in topological order so the task of every
+        # dependency exists when a model awaits it
+        for name in self.order:
+            tasks[name] = asyncio.ensure_future(run_model(name))
+        try:
+            await asyncio.wait_for(asyncio.gather(*tasks.values()), deadline.remaining())
+        except (asyncio.TimeoutError, ModelAPIError) as error:
+            for task in tasks.values():
+                task.cancel()
+            if isinstance(error, ModelAPIError) and not deadline.is_deadline_error(error):
+                raise
+            return self._partial_run(tasks, timings)
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            raise
+
+        results = {name: task.result() for name, task in tasks.items()}
+        return PipelineRun(results[self.output], results, timings)
+
+    def _ancestors(self, name: str) -> set:
+        ancestors = set()
+        stack = [name]
+        while stack:
+            for dependency in self.dependencies[stack.pop()]:
+                if dependency != SOURCE and dependency not in ancestors:
+                    ancestors.add(dependency)
+                    stack.append(dependency)
+        return ancestors
+
+    def _partial_run(self, tasks: dict, timings: dict) -> PipelineRun:
+        results = {
+            name: task.result() for name, task in tasks.items()
+            if task.done() and not task.cancelled() and task.exception() is None
+        }
+        # The completed model closest to the output in topological order
+        chain = self._ancestors(self.output) | {self.output}
+        completed = [name for name in self.order if name in chain and name in results]
+        if not completed:
+            raise DeadlineExceededError(
+                "The budget of the request is spent before any model completed"
+            )
+        print(f"Budget spent, returning the result of {completed[-1].upper()}")  # TODO: Transform into logging
+        return PipelineRun(results[completed[-1]], results, timings, True)
+
+    def _record(self, name: str, duration: float):
+        timing = self._timings[name]
+        timing[0] += 1
+        timing[1] += duration
+        timing[2] = max(timing[2], duration)
+
+    def stats(self) -> dict:
+        return {
+            name: {
+                "calls": calls,
+                "mean_time": total / calls if calls else 0.0,
+                "max_time": max_time,
+            }
+            for name, (calls, total, max_time) in self._timings.items()
+        }
@@ -3,22 +3,26 @@ This file contains the function that requests the inference and processes the da
 the seed detector model.
 """
 
-import io
-import base64
+import os
 import json
-from urllib.error import URLError
+import asyncio
 
-from PIL import Image
 from collections import namedtuple
-from urllib.request import Request, urlopen
+from model import http_client, image_slicing
+from model.image import SourceImage
 from model.model_exceptions import ModelAPIError
 
 class SeedDetectorModelAPIError(ModelAPIError) :
     pass
 
-def process_image_slicing(image_bytes: bytes, result_json: dict) -> list:
+# Images sent in one request to the seed detector, unless the model settings
+# define their own "max_images_per_request" and "max_payload_megabytes"
+DEFAULT_MAX_IMAGES_PER_REQUEST = int(os.getenv("NACHET_SEED_DETECTOR_MAX_IMAGES", 8))
+DEFAULT_MAX_PAYLOAD_MEGABYTES = float(os.getenv("NACHET_SEED_DETECTOR_MAX_PAYLOAD_MEGABYTES", 64))
+
+def process_image_slicing(source_image: SourceImage, result_json: dict, encoding: image_slicing.CropEncoding = image_slicing.SOURCE_ENCODING) -> list:
     """
-    This function takes the image bytes and the result_json from the model and
+    This function takes the source image and the result_json from the model and
     returns a list of cropped images.
     The result_json is expected to be in the following format:
     {
@@ -35,75 +39,163 @@ def process_image_slicing(image_bytes: bytes, result_json: dict) -> list:
             }
         ],
     }
+    The crops are resized and encoded as described by encoding, by default
+    they keep the resolution and the format of the source image.
     """
     boxes = result_json[0]['boxes']
-    image_io_byte = io.BytesIO(base64.b64decode(image_bytes))
-    image_io_byte.seek(0)
-    image = Image.open(image_io_byte)
+    image = SourceImage.coerce(source_image).open()
 
     format = image.format
 
-    cropped_images = [bytes(0) for _ in boxes]
+    return [
+        image_slicing.encode_crop(
+            image, image_slicing.box_coordinates(box, image.width, image.height), format, encoding
+        )
+        for box in boxes
+    ]
+
+
+def build_payload(source_images: list) -> bytes:
+    data = {
+        "input_data": {
+            "columns": ["image"],
+            "index": list(range(len(source_images))),
+            "data": [source_image.base64 for source_image in source_images],
+        }
+    }
+    return str.encode(json.dumps(data))
 
-    for i, box in enumerate(boxes):
-        topX = int(box['box']['topX'] * image.width)
-        topY = int(box['box']['topY'] * image.height)
-        bottomX = int(box['box']['bottomX'] * image.width)
-        bottomY = int(box['box']['bottomY'] * image.height)
 
-        img = image.crop((topX, topY, bottomX, bottomY))
+def chunk_images(source_images: list, max_images: int, max_bytes: int) -> list:
+    """
+    Split the images into the chunks sent in one request each, with at most
+    max_images images and about max_bytes of base64 data per chunk. An image
+    larger than max_bytes is sent alone.
 
-        buffered = io.BytesIO()
-        img.save(buffered, format)
+    Returns:
+        list[list[int]]: The indexes of the images of every chunk.
+    """
+    chunks = []
+    chunk = []
+    chunk_bytes = 0
+    for i, source_image in enumerate(source_images):
+        # Length of the image once encoded in base64
+        size = 4 * ((len(source_image) + 2) // 3)
+        if chunk and (len(chunk) >= max_images or chunk_bytes + size > max_bytes):
+            chunks.append(chunk)
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(i)
+        chunk_bytes += size
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def split_results(result, count: int) -> list:
+    """
+    Return the result of every image of a request. The result of a request
+    with several images is a list holding the result of each image, the
+    result of a request with one image can also be the result itself.
+    """
+    if isinstance(result, dict) and count == 1:
+        return [result]
+    if not isinstance(result, list) or len(result) != count:
+        raise ValueError(f"Expected the results of {count} images from the seed detector")
+    return result
 
-        cropped_images[i] = base64.b64encode(buffered.getvalue())
 
-    return cropped_images
+async def detect_seeds(model: namedtuple, source_images: list) -> list:
+    """
+    Requests the boxes of the seeds of several images, sent to the seed
+    detector in chunks that respect the limits of the endpoint payload. At
+    most max_concurrency(model) chunks are sent at once.
 
+    Args:
+        model (namedtuple): The seed detector model.
+        source_images (list[SourceImage]): The images to analyse.
 
-async def request_inference_from_seed_detector(model: namedtuple, previous_result: str):
+    Returns:
+        list[dict]: The result of the seed detector for every image, in the
+        order of the images.
+    """
+    max_images = max(1, int(model.settings.get("max_images_per_request", DEFAULT_MAX_IMAGES_PER_REQUEST)))
+    max_bytes = int(float(model.settings.get("max_payload_megabytes", DEFAULT_MAX_PAYLOAD_MEGABYTES)) * 1024 * 1024)
+    semaphore = asyncio.Semaphore(http_client.max_concurrency(model))
+
+    async def detect_chunk(chunk):
+        async with semaphore:
+            result = await http_client.post(
+                model, build_payload([source_images[i] for i in chunk])
+            )
+        return split_results(json.loads(result.decode("utf8")), len(chunk))
+
+    chunks = chunk_images(source_images, max_images, max_bytes)
+    tasks = [asyncio.ensure_future(detect_chunk(chunk)) for chunk in chunks]
+    try:
+        chunk_results = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+    results = [None] * len(source_images)
+    for chunk, chunk_result in zip(chunks, chunk_results):
+        for i, result in zip(chunk, chunk_result):
+            results[i] = result
+    return results
+
+
+async def request_inference_from_seed_detector(model: namedtuple, previous_result: SourceImage):
     """
     Requests inference from the seed detector model using the previously provided result.
 
     Args:
         model (namedtuple): The seed detector model.
-        previous_result (str): The previous result used for inference.
+        previous_result (SourceImage): The image of the request.
 
     Returns:
-        dict: A dictionary containing the result JSON and the images generated from the inference.
+        dict: A dictionary containing the result JSON and the images generated from the inference,
+        as a CropStream.
 
     Raises:
         ProcessInferenceResultsError: If an error occurs while processing the request.
     """
-    try:
+    results = await request_inference_from_seed_detector_many(model, [previous_result])
+    return results[0]
 
-        headers = {
-            "Content-Type": model.content_type,
-            "Authorization": ("Bearer " + model.api_key),
-            model.deployment_platform: model.name
-        }
 
-        data = {
-            "input_data": {
-                "columns": ["image"],
-                "index": [0],
-                "data": [previous_result],
-            }
-        }
+async def request_inference_from_seed_detector_many(model: namedtuple, source_images: list) -> list:
+    """
+    Requests inference from the seed detector model for several images, sent
+    in as few requests as the endpoint payload limits allow.
 
-        body = str.encode(json.dumps(data))
-        req = Request(model.endpoint, body, headers, method="POST")
-        # req = Request("http://192.168.x.x:12380/score", body, headers, method="POST")
-        response = urlopen(req)
+    Args:
+        model (namedtuple): The seed detector model.
+        source_images (list[SourceImage]): The images to analyse.
 
-        result = response.read()
-        result_object = [json.loads(result.decode("utf8"))]  
-        print(json.dumps(result_object[0].get("boxes"), indent=4)) #TODO Transform into logging
+    Returns:
+        list[dict]: For every image, a dictionary containing the result JSON and
+        the images generated from the inference, as a CropStream.
 
-        return {
-            "result_json": result_object,
-            "images": process_image_slicing(previous_result, result_object)
-        }
-    except (KeyError, TypeError, IndexError, ValueError, URLError, json.JSONDecodeError)  as error:
+    Raises:
+        SeedDetectorModelAPIError: If an error occurs while processing the request.
+    """
+    try:
+        source_images = [SourceImage.coerce(source_image) for source_image in source_images]
+        encoding = image_slicing.crop_encoding(model.settings)
+        results = await detect_seeds(model, source_images)
+
+        inferences = []
+        for source_image, result in zip(source_images, results):
+            result_object = [result]
+            print(json.dumps(result_object[0].get("boxes"), indent=4)) #TODO Transform into logging
+            inferences.append({
+                "result_json": result_object,
+                # The crops are sent to the next model while they are sliced
+                "images": image_slicing.CropStream(source_image, result_object[0]['boxes'], encoding)
+            })
+        return inferences
+    except (KeyError, TypeError, IndexError, ValueError, AttributeError, http_client.ModelEndpointError, json.JSONDecodeError, OSError)  as error:
         print(error)
         raise SeedDetectorModelAPIError(f"Error while processing inference results :\n {str(error)}") from error
@@ -6,8 +6,7 @@ the swin model.
 import json
 
 from collections import namedtuple
-from urllib.error import URLError
-from urllib.request import Request, urlopen
+from model import http_client
 from model.model_exceptions import ModelAPIError
 
 class SwinModelAPIError(ModelAPIError) :
@@ -54,19 +53,8 @@ async def request_inference_from_swin(model: namedtuple, previous_result: 'list[
         ProcessInferenceResultsError: If an error occurs while processing the request.
     """
     try:
-        results = []
-        for img in previous_result.get("images"):
-            headers = {
-                "Content-Type": model.content_type,
-                "Authorization": ("Bearer " + model.api_key),
-                model.deployment_platform: model.name
-            }
-            body = img
-            req = Request(model.endpoint, body, headers, method="POST")
-            # req = Request("http://192.168.x.x:12390/score", body, headers, method="POST")
-            response = urlopen(req)
-            result = response.read()
-            results.append(json.loads(result.decode("utf8")))
+        responses = await http_client.post_many(model, previous_result.get("images"))
+        results = [json.loads(result.decode("utf8")) for result in responses]
 
         print(json.dumps(results, indent=4)) #TODO Transform into logging
 
@@ -75,6 +63,6 @@ async def request_inference_from_swin(model: namedtuple, previous_result: 'list[
 
         return img_box
 
-    except (TypeError, IndexError, AttributeError, URLError, json.JSONDecodeError)  as error:
+    except (TypeError, IndexError, AttributeError, http_client.ModelEndpointError, json.JSONDecodeError)  as error:
         print(error)
         raise SwinModelAPIError(f"An error occurred while processing the request:\n {str(error)}") from error
@@ -27,7 +27,7 @@ async def request_inference_from_test(model: namedtuple, previous_result: str):
         ProcessInferenceResultsError: If an error occurs while processing the request.
     """
     try:
-        if previous_result == '':
+        if not previous_result:
            raise ValueError("The result send to the inference function is empty")
         print(f"processing test request for {model.name} with {type(previous_result)} arguments")
         return [
@@ -4,10 +4,9 @@ the swin model.
 """
 
 import json
-from copy import deepcopy
+import asyncio
 from collections import namedtuple
-from urllib.error import URLError
-from urllib.request import Request, urlopen
+from model import http_client, image_slicing
 from model.model_exceptions import ModelAPIError
 
 
@@ -15,6 +14,8 @@ class SwinModelAPIError(ModelAPIError):
     pass
 
 
+# Labels sent again to the ensemble B model when the pipeline does not define
+# its own "routes"
 SPECIES_LIST = [
     "012 Ambrosia artemisiifolia",
     "013 Ambrosia trifida",
@@ -22,6 +23,28 @@ SPECIES_LIST = [
 ]
 
 
+def with_routes(model: namedtuple, routes: dict, models: tuple) -> namedtuple:
+    """
+    Return the ensemble B model with the routes of its pipeline: the label of
+    a seed -> the specialist model that classifies it again. A label routed
+    to None is classified again by the ensemble B model itself. The other
+    models are returned unchanged.
+
+    Raises:
+        SwinModelAPIError: If a route leads to an unknown model.
+    """
+    if model.request_function is not request_inference_ensemble_b:
+        return model
+
+    models_by_name = {m.name: m for m in models}
+    route_models = {}
+    for label, name in routes.items():
+        if name is not None and name not in models_by_name:
+            raise SwinModelAPIError(f"Unknown model {name} in the route of {label}")
+        route_models[label] = models_by_name[name] if name is not None else model
+    return model._replace(settings={**model.settings, "routes": route_models})
+
+
 def process_swin_result(img_box: dict, results: dict) -> list:
     """
     Args:
@@ -59,22 +82,10 @@ async def request_inference_ensemble_a(model: namedtuple, previous_result: "dict
         print(f"Requesting inference from {model.name}")
         print(f"Endpoint: {model.endpoint}")
 
-        inf_results = []
-        # img_count = len(previous_result.get("images"))
-        for idx, img in enumerate(previous_result.get("images")):
-            headers = {
-                "Content-Type": model.content_type,
-                "Authorization": ("Bearer " + model.api_key),
-                model.deployment_platform: model.name,
-            }
-            body = img
-
-            print(f"Processing image {idx + 1}")
-            req = Request(model.endpoint, body, headers, method="POST")
-            response = urlopen(req)
-            inf_result = response.read()
-            inf_result_json = json.loads(inf_result.decode("utf8"))
-            inf_results.append(inf_result_json)
+        images = previous_result.get("images")
+        print(f"Processing {len(images)} images")
+        responses = await http_client.post_many(model, images)
+        inf_results = [json.loads(inf_result.decode("utf8")) for inf_result in responses]
 
         print(json.dumps(inf_results, indent=4))  # TODO Transform into logging
 
@@ -88,7 +99,7 @@ async def request_inference_ensemble_a(model: namedtuple, previous_result: "dict
         TypeError,
         IndexError,
         AttributeError,
-        URLError,
+        http_client.ModelEndpointError,
         json.JSONDecodeError,
     ) as error:
         print(error)
@@ -99,36 +110,53 @@ async def request_inference_ensemble_a(model: namedtuple, previous_result: "dict
 
 async def request_inference_ensemble_b(model: namedtuple, previous_result: "dict"):
     """
-    Perform inference on images that are in the specified species list.
+    Perform inference again on the seeds whose label is routed to a
+    specialist model, by default the labels of SPECIES_LIST to this model.
+    The specialist models are called concurrently and only the amended boxes
+    are copied, the other boxes are shared with the previous result.
     """
     try:
         print(f"Requesting inference from {model.name}")
         print(f"Endpoint: {model.endpoint}")
-        amended_result = deepcopy(previous_result.get("result_json"))
-
-        for i, result in enumerate(previous_result.get("result_json")[0]["boxes"]):
-            if result["label"] in SPECIES_LIST:
-                headers = {
-                    "Content-Type": model.content_type,
-                    "Authorization": ("Bearer " + model.api_key),
-                    model.deployment_platform: model.name,
-                }
-                body = previous_result.get("images")[i]
-                req = Request(model.endpoint, body, headers, method="POST")
-                response = urlopen(req)
-                inf_result = response.read()
-                inf_result_json = json.loads(inf_result.decode("utf8"))
-                amended_result[0]["boxes"][i]["label"] = inf_result_json[0].get("label")
-                amended_result[0]["boxes"][i]["score"] = inf_result_json[0].get("score")
-                amended_result[0]["boxes"][i]["topN"] = [d for d in inf_result_json]
+        routes = model.settings.get("routes") or {label: model for label in SPECIES_LIST}
+        result_json = previous_result.get("result_json")
+        boxes = result_json[0]["boxes"]
+
+        # Indexes of the boxes to amend, by specialist model
+        routed = {}
+        for i, box in enumerate(boxes):
+            route_model = routes.get(box["label"])
+            if route_model is not None:
+                routed.setdefault(route_model.name, (route_model, []))[1].append(i)
+
+        amended_boxes = list(boxes)
+        if routed:
+            images = await image_slicing.resolve_crops(previous_result.get("images"))
+            routed = list(routed.values())
+            responses = await asyncio.gather(*[
+                http_client.post_many(route_model, [images[i] for i in indexes])
+                for route_model, indexes in routed
+            ])
+            for (_, indexes), route_responses in zip(routed, responses):
+                for i, inf_result in zip(indexes, route_responses):
+                    inf_result_json = json.loads(inf_result.decode("utf8"))
+                    amended_boxes[i] = {
+                        **boxes[i],
+                        "label": inf_result_json[0].get("label"),
+                        "score": inf_result_json[0].get("score"),
+                        "topN": [d for d in inf_result_json],
+                    }
+
+        amended_result = [{**result_json[0], "boxes": amended_boxes}, *result_json[1:]]
 
         print(json.dumps(amended_result, indent=4))  # TODO Transform into logging
         return amended_result
     except (
+        KeyError,
         TypeError,
         IndexError,
         AttributeError,
-        URLError,
+        http_client.ModelEndpointError,
         json.JSONDecodeError,
     ) as error:
         print(error)
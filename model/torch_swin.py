@@ -5,8 +5,7 @@ the swin model.
 
 import json
 from collections import namedtuple
-from urllib.error import URLError
-from urllib.request import Request, urlopen
+from model import http_client
 from model.model_exceptions import ModelAPIError
 
 
@@ -49,19 +48,8 @@ async def request_inference_from_torch_swin(model: namedtuple, previous_result:
         ProcessInferenceResultsError: If an error occurs while processing the request.
     """
     try:
-        results = []
-        for img in previous_result.get("images"):
-            headers = {
-                "Content-Type": model.content_type,
-                "Authorization": ("Bearer " + model.api_key),
-                model.deployment_platform: model.name,
-            }
-            body = img
-            req = Request(model.endpoint, body, headers, method="POST")
-            response = urlopen(req)
-            result = response.read()
-            result_json = json.loads(result.decode("utf8"))
-            results.append(result_json)
+        responses = await http_client.post_many(model, previous_result.get("images"))
+        results = [json.loads(result.decode("utf8")) for result in responses]
 
         print(json.dumps(results, indent=4))  # TODO Transform into logging
 
@@ -70,7 +58,7 @@ async def request_inference_from_torch_swin(model: namedtuple, previous_result:
         TypeError,
         IndexError,
         AttributeError,
-        URLError,
+        http_client.ModelEndpointError,
         json.JSONDecodeError,
     ) as error:
         print(error)
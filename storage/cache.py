@@ -0,0 +1,359 @@
+"""
+This file contains the caches used by the backend to keep the objects that
+are expensive to rebuild between requests, in memory and optionally on disk.
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Size-bounded mapping that evicts the least recently used entry when it is
+    full. Entries can also expire after a time to live (in seconds).
+
+    When max_bytes is given, the values are bytes and their total length is
+    also kept under max_bytes.
+
+    on_evict(key, value, expires_at) is called for every entry removed to make
+    room for a new one, but not for the entries that expire, are popped or
+    cleared.
+    """
+    def __init__(self, max_size: int, ttl: float = None, on_evict=None, max_bytes: int = None):
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.max_bytes = max_bytes
+        # key -> (value, expires_at)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def _is_expired(self, expires_at) -> bool:
+        return expires_at is not None and expires_at <= time.monotonic()
+
+    def _size_of(self, value) -> int:
+        return len(value) if self.max_bytes is not None else 0
+
+    def _delete(self, key):
+        value, _ = self._entries.pop(key)
+        self._bytes -= self._size_of(value)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return default
+            value, expires_at = entry
+            if self._is_expired(expires_at):
+                self._delete(key)
+                self._expirations += 1
+                self._misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        evicted = []
+        with self._lock:
+            if key in self._entries:
+                self._delete(key)
+            self._entries[key] = (value, expires_at)
+            self._bytes += self._size_of(value)
+            while len(self._entries) > self.max_size or (
+                self.max_bytes is not None and self._bytes > self.max_bytes
+            ):
+                evicted_key, (evicted_value, evicted_expires_at) = self._entries.popitem(last=False)
+                self._bytes -= self._size_of(evicted_value)
+                if self._is_expired(evicted_expires_at):
+                    self._expirations += 1
+                else:
+                    self._evictions += 1
+                    evicted.append((evicted_key, evicted_value, evicted_expires_at))
+        if self.on_evict is not None:
+            for evicted_key, evicted_value, evicted_expires_at in evicted:
+                self.on_evict(evicted_key, evicted_value, evicted_expires_at)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._delete(key)
+        if entry is None or self._is_expired(entry[1]):
+            return default
+        return entry[0]
+
+    def purge_expired(self):
+        with self._lock:
+            expired = [
+                key for key, (_, expires_at) in self._entries.items()
+                if self._is_expired(expires_at)
+            ]
+            for key in expired:
+                self._delete(key)
+            self._expirations += len(expired)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and not self._is_expired(entry[1])
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "bytes": self._bytes if self.max_bytes is not None else None,
+                "max_bytes": self.max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+                "evictions": self._evictions,
+                "expirations": self._expirations,
+            }
+
+
+class DiskCache:
+    """
+    Size-bounded directory of cached bytes. The least recently used files
+    are removed when the total size goes over max_bytes. Entries can also
+    expire after a time to live (in seconds).
+
+    Every cache writes its files in its own subdirectory of directory, so the
+    processes sharing the directory do not remove each other's files. The
+    index of the files is only kept in memory: with a time to live, the
+    subdirectories left by previous processes are removed once all their
+    entries expired.
+    """
+    PREFIX = "cache-"
+    SUFFIX = ".cache"
+
+    def __init__(self, directory: str, max_bytes: int, ttl: float = None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # key -> (path, size, expires_at)
+        self._files = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+        os.makedirs(directory, exist_ok=True)
+        if ttl is not None:
+            self._remove_expired_directories(directory, ttl)
+        self.directory = tempfile.mkdtemp(prefix=self.PREFIX, dir=directory)
+
+    def _remove_expired_directories(self, directory: str, ttl: float):
+        # A subdirectory not written to for ttl seconds only holds expired
+        # entries
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                if name.startswith(self.PREFIX) and time.time() - os.path.getmtime(path) > ttl:
+                    shutil.rmtree(path)
+            except OSError as error:
+                print(error)
+
+    def _path(self, key) -> str:
+        name = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name + self.SUFFIX)
+
+    def _remove(self, path: str):
+        try:
+            os.remove(path)
+        except OSError as error:
+            print(error)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._files.get(key)
+            if entry is not None:
+                self._files.move_to_end(key)
+        if entry is not None and entry[2] is not None and entry[2] <= time.monotonic():
+            self.pop(key)
+            self._expirations += 1
+            entry = None
+        if entry is None:
+            self._misses += 1
+            return None
+        try:
+            with open(entry[0], "rb") as file:
+                data = file.read()
+        except OSError:
+            self.pop(key)
+            self._misses += 1
+            return None
+        self._hits += 1
+        return data
+
+    def remaining_ttl(self, key) -> float:
+        """
+        Return the seconds before the entry expires, or None if it does not.
+        """
+        entry = self._files.get(key)
+        if entry is None or entry[2] is None:
+            return None
+        return max(0.0, entry[2] - time.monotonic())
+
+    def set(self, key, data: bytes, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        temporary_path = path + ".tmp"
+        try:
+            with open(temporary_path, "wb") as file:
+                file.write(data)
+            os.replace(temporary_path, path)
+        except OSError as error:
+            print(error)
+            return
+
+        evicted = []
+        with self._lock:
+            previous = self._files.pop(key, None)
+            if previous is not None:
+                self._size -= previous[1]
+            expires_at = time.monotonic() + ttl if ttl is not None else None
+            self._files[key] = (path, len(data), expires_at)
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, (evicted_path, evicted_size, _) = self._files.popitem(last=False)
+                self._size -= evicted_size
+                self._evictions += 1
+                evicted.append(evicted_path)
+        for evicted_path in evicted:
+            self._remove(evicted_path)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._files.pop(key, None)
+            if entry is not None:
+                self._size -= entry[1]
+        if entry is not None:
+            self._remove(entry[0])
+
+    def clear(self):
+        with self._lock:
+            files, self._files = self._files, OrderedDict()
+            self._size = 0
+        for path, _, _ in files.values():
+            self._remove(path)
+
+    def __contains__(self, key) -> bool:
+        return key in self._files
+
+    def stats(self) -> dict:
+        lookups = self._hits + self._misses
+        return {
+            "size": len(self._files),
+            "bytes": self._size,
+            "max_bytes": self.max_bytes,
+            "hits": self._hits,
+            "misses": self._misses,
+            "hit_rate": self._hits / lookups if lookups else 0.0,
+            "evictions": self._evictions,
+            "expirations": self._expirations,
+        }
+
+
+class TieredCache:
+    """
+    Cache of bytes kept in memory, bounded by number of entries and
+    optionally by total size. Entries evicted from memory are moved to the
+    optional disk tier, and read back into memory on their next use. Entries
+    expire after the optional time to live (in seconds) in either tier.
+    """
+    def __init__(self, max_size: int, max_bytes: int = None, directory: str = None, max_disk_bytes: int = 0, ttl: float = None):
+        self.disk = DiskCache(directory, max_disk_bytes, ttl) if directory else None
+        self.memory = LRUCache(
+            max_size,
+            ttl=ttl,
+            on_evict=self._to_disk if self.disk is not None else None,
+            max_bytes=max_bytes,
+        )
+
+    def _to_disk(self, key, data: bytes, expires_at: float):
+        # The entry keeps the time it had left in memory
+        ttl = None if expires_at is None else expires_at - time.monotonic()
+        self.disk.set(key, data, ttl)
+
+    def get(self, key) -> bytes:
+        data = self.memory.get(key)
+        if data is None and self.disk is not None:
+            data = self.disk.get(key)
+            if data is not None:
+                ttl = self.disk.remaining_ttl(key)
+                self.disk.pop(key)
+                self.memory.set(key, data, ttl)
+        return data
+
+    def set(self, key, data: bytes):
+        if self.disk is not None:
+            self.disk.pop(key)
+        self.memory.set(key, data)
+
+    def pop(self, key):
+        self.memory.pop(key)
+        if self.disk is not None:
+            self.disk.pop(key)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self) -> dict:
+        return {
+            "memory": self.memory.stats(),
+            "disk": self.disk.stats() if self.disk is not None else None,
+        }
+
+
+class ResultCache(TieredCache):
+    """
+    Cache of JSON results, kept serialized so every get returns a new copy
+    that the caller is free to modify.
+    """
+    def __init__(self, max_size: int, directory: str = None, max_disk_bytes: int = 0):
+        super().__init__(max_size, directory=directory, max_disk_bytes=max_disk_bytes)
+
+    def get(self, key):
+        data = super().get(key)
+        if data is None:
+            return None
+        return json.loads(data)
+
+    def set(self, key, result):
+        try:
+            data = json.dumps(result).encode("utf-8")
+        except (TypeError, ValueError) as error:
+            print(f"Result not cached : {error}")
+            return
+        super().set(key, data)
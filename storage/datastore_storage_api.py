@@ -2,14 +2,23 @@
 This module provide an absraction to the nachet-datastore interface.
 """
 import os
+import time
+import asyncio
+import threading
+import warnings
+import traceback
 import datastore
+from contextlib import asynccontextmanager
 from datastore import db
 from datastore import user as user_datastore
+from datastore import azure_storage
 import nachet as nachet_datastore
 import nachet.bin.deployment_mass_import
 
 import datastore.bin.upload_picture_set
 import nachet.db.queries.seed as seed_queries
+from storage.executor import run_in_executor
+from storage.cache import LRUCache
 
 class DatastoreError(Exception):
     pass
@@ -23,6 +32,12 @@ class GetPipelinesError(DatastoreError):
 class UserNotFoundError(DatastoreError):
     pass
 
+class PoolTimeoutError(DatastoreError):
+    pass
+
+class ConnectionLeakWarning(UserWarning):
+    pass
+
 NACHET_DB_URL = os.getenv("NACHET_DB_URL")
 NACHET_SCHEMA = os.getenv("NACHET_SCHEMA")
 
@@ -32,6 +47,14 @@ if NACHET_DB_URL is None:
 if NACHET_SCHEMA is None:
     raise DatastoreError("Missing environment variable: NACHET_SCHEMA")
 
+NACHET_DB_POOL_MIN_SIZE = int(os.getenv("NACHET_DB_POOL_MIN_SIZE", 1))
+NACHET_DB_POOL_MAX_SIZE = int(os.getenv("NACHET_DB_POOL_MAX_SIZE", 10))
+NACHET_DB_POOL_TIMEOUT = float(os.getenv("NACHET_DB_POOL_TIMEOUT", 30))
+NACHET_DB_POOL_LEAK_TIMEOUT = float(os.getenv("NACHET_DB_POOL_LEAK_TIMEOUT", 120))
+NACHET_DB_POOL_HEALTH_CHECK_INTERVAL = float(os.getenv("NACHET_DB_POOL_HEALTH_CHECK_INTERVAL", 30))
+NACHET_CONTAINER_CACHE_SIZE = int(os.getenv("NACHET_CONTAINER_CACHE_SIZE", 256))
+NACHET_CONTAINER_EXISTS_TTL = float(os.getenv("NACHET_CONTAINER_EXISTS_TTL", 300))
+
 def get_connection() :
     try :
         return db.connect_db(NACHET_DB_URL, NACHET_SCHEMA)
@@ -49,46 +72,297 @@ def end_query(connection, cursor):
         db.end_query(connection, cursor)
     except Exception as error:
         raise DatastoreError(error)
- 
+
+
+class ConnectionPool:
+    """
+    Bounded pool of database connections.
+
+    At most max_size connections are handed out at once, a caller waits up to
+    timeout seconds for one to be released. Idle connections are checked
+    before being reused and the connections held longer than leak_timeout
+    seconds are reported with a ConnectionLeakWarning.
+    """
+    def __init__(self, min_size: int, max_size: int, timeout: float, leak_timeout: float, health_check_interval: float):
+        self.min_size = min_size
+        self.max_size = max(1, max_size)
+        self.timeout = timeout
+        self.leak_timeout = leak_timeout
+        self.health_check_interval = health_check_interval
+        # (connection, released_at)
+        self._idle = []
+        self._lock = threading.Lock()
+        # id(connection) -> dict(connection, semaphore, acquired_at, stack, reported)
+        self._in_use = {}
+        self._loop = None
+        self._semaphore = None
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # asyncio primitives belong to the loop that first used them
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_size)
+        return self._semaphore
+
+    def _is_healthy(self, connection, released_at: float) -> bool:
+        if connection.closed:
+            return False
+        if time.monotonic() - released_at < self.health_check_interval:
+            return True
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            connection.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except Exception as error:
+            print(error)
+
+    def _checkout(self):
+        # Runs on the executor threads, the idle list is shared with them
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                connection, released_at = self._idle.pop()
+            if self._is_healthy(connection, released_at):
+                return connection
+            self._discard(connection)
+        return get_connection()
+
+    async def open(self):
+        """
+        Open the minimum number of connections ahead of the first requests.
+        """
+        while len(self._idle) < self.min_size:
+            connection = await run_in_executor(get_connection)
+            with self._lock:
+                self._idle.append((connection, time.monotonic()))
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            self._discard(connection)
+
+    def check_leaks(self):
+        now = time.monotonic()
+        for checkout in self._in_use.values():
+            held = now - checkout["acquired_at"]
+            if held > self.leak_timeout and not checkout["reported"]:
+                checkout["reported"] = True
+                warnings.warn(
+                    f"database connection held for {held:.0f} seconds, acquired at:\n{checkout['stack']}",
+                    ConnectionLeakWarning,
+                )
+
+    async def acquire(self):
+        self.check_leaks()
+        semaphore = self._get_semaphore()
+        try:
+            await asyncio.wait_for(semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeoutError(
+                f"no database connection available after {self.timeout} seconds"
+            )
+
+        # Checking and opening connections is blocking I/O
+        checkout = asyncio.ensure_future(run_in_executor(self._checkout))
+        try:
+            connection = await asyncio.shield(checkout)
+        except asyncio.CancelledError:
+            # The thread cannot be interrupted, the connection it opens goes
+            # back to the pool once it is done
+            def give_back(checkout):
+                if not checkout.cancelled() and checkout.exception() is None:
+                    self.release(checkout.result())
+                semaphore.release()
+
+            checkout.add_done_callback(give_back)
+            raise
+        except BaseException:
+            semaphore.release()
+            raise
+
+        self._in_use[id(connection)] = {
+            "connection": connection,
+            "semaphore": semaphore,
+            "acquired_at": time.monotonic(),
+            "stack": "".join(traceback.format_stack(limit=6)[:-1]),
+            "reported": False,
+        }
+        return connection
+
+    def release(self, connection, discard: bool = False):
+        checkout = self._in_use.pop(id(connection), None)
+        with self._lock:
+            keep = not (discard or connection.closed or len(self._idle) >= self.max_size)
+            if keep:
+                self._idle.append((connection, time.monotonic()))
+        if not keep:
+            self._discard(connection)
+        if checkout is not None:
+            checkout["semaphore"].release()
+
+    def stats(self) -> dict:
+        return {
+            "idle": len(self._idle),
+            "in_use": len(self._in_use),
+            "max_size": self.max_size,
+        }
+
+
+connection_pool = ConnectionPool(
+    NACHET_DB_POOL_MIN_SIZE,
+    NACHET_DB_POOL_MAX_SIZE,
+    NACHET_DB_POOL_TIMEOUT,
+    NACHET_DB_POOL_LEAK_TIMEOUT,
+    NACHET_DB_POOL_HEALTH_CHECK_INTERVAL,
+)
+
+
+def _end_transaction(connection, cursor, commit: bool):
+    cursor.close()
+    if commit:
+        connection.commit()
+    else:
+        connection.rollback()
+
+
+@asynccontextmanager
+async def pooled_cursor():
+    """
+    Borrow a connection from the pool and yield a cursor on it. The
+    transaction is committed when the block succeeds and rolled back
+    otherwise, then the connection goes back to the pool.
+    """
+    connection = await connection_pool.acquire()
+    try:
+        cursor = get_cursor(connection)
+    except BaseException:
+        connection_pool.release(connection, discard=True)
+        raise
+
+    # The commit and the rollback are blocking I/O like the queries
+    try:
+        yield cursor
+    except BaseException:
+        try:
+            await run_in_executor(_end_transaction, connection, cursor, False)
+        except BaseException as error:
+            print(error)
+            connection_pool.release(connection, discard=True)
+        else:
+            connection_pool.release(connection)
+        raise
+
+    try:
+        await run_in_executor(_end_transaction, connection, cursor, True)
+    except Exception as error:
+        connection_pool.release(connection, discard=True)
+        raise DatastoreError(error)
+    except BaseException:
+        connection_pool.release(connection, discard=True)
+        raise
+    connection_pool.release(connection)
+
+
+class ContainerClientCache:
+    """
+    Container clients of the users, kept so the repeated requests of a user
+    do not rebuild the client and check that the container exists every time.
+
+    The clients are evicted in least recently used order. The existence of a
+    container is trusted for exists_ttl seconds, then checked again.
+    """
+    def __init__(self, max_size: int, exists_ttl: float):
+        self.exists_ttl = exists_ttl
+        # user_id -> (container_client, verified_at)
+        self._clients = LRUCache(max_size)
+
+    async def mount(self, connection_string: str, user_id: str):
+        entry = self._clients.get(user_id)
+        if entry is not None:
+            container_client, verified_at = entry
+            if time.monotonic() - verified_at < self.exists_ttl:
+                return container_client
+            try:
+                exists = await run_in_executor(container_client.exists)
+            except Exception as error:
+                print(error)
+                exists = False
+            if exists:
+                self._clients.set(user_id, (container_client, time.monotonic()))
+                return container_client
+            self._clients.pop(user_id)
+
+        container_client = await run_in_executor(
+            azure_storage.mount_container, connection_string, user_id, create_container=True
+        )
+        if container_client:
+            self._clients.set(user_id, (container_client, time.monotonic()))
+        return container_client
+
+    def invalidate(self, user_id: str):
+        self._clients.pop(user_id)
+
+    def clear(self):
+        self._clients.clear()
+
+    def stats(self) -> dict:
+        return self._clients.stats()
+
+
+container_clients = ContainerClientCache(NACHET_CONTAINER_CACHE_SIZE, NACHET_CONTAINER_EXISTS_TTL)
+
+
+async def mount_container(connection_string: str, user_id: str):
+    """
+    Return the container client of the user, creating the container if it
+    does not exist.
+    """
+    return await container_clients.mount(connection_string, user_id)
+
+
 async def get_all_seeds() -> list:
 
     """
     Return all seeds name register in the Datastore.
     """
     try:
-        connection = get_connection()
-        cursor = get_cursor(connection)
-        return await nachet_datastore.get_seed_info(cursor)
+        async with pooled_cursor() as cursor:
+            return await run_in_executor(nachet_datastore.get_seed_info, cursor)
     except Exception as error:
         raise SeedNotFoundError(error.args[0])
 
 
-def get_all_seeds_names() -> list:
+async def get_all_seeds_names() -> list:
 
     """
     Return all seeds name register in the Datastore.
     """
     try:
-        connection = get_connection()
-        cursor = get_cursor(connection)
-        return seed_queries.get_all_seeds_names(cursor)
+        async with pooled_cursor() as cursor:
+            return await run_in_executor(seed_queries.get_all_seeds_names, cursor)
     except Exception as error: # TODO modify Exception for more specific exception
         raise SeedNotFoundError(error.args[0])
 
-def get_user_id(email: str) -> str:
+async def get_user_id(email: str) -> str:
     """
     Return the user_id of the user
     """
     try :
-        connection = get_connection()
-        cursor = get_cursor(connection)
-        if user_datastore.is_user_registered(cursor, email):
-            user_id = user_datastore.get_user_id(cursor, email)
-            end_query(connection, cursor)
-            return user_id
-        else :
-            end_query(connection, cursor)
-            raise UserNotFoundError("User not found")
+        async with pooled_cursor() as cursor:
+            if await run_in_executor(user_datastore.is_user_registered, cursor, email):
+                return await run_in_executor(user_datastore.get_user_id, cursor, email)
+        raise UserNotFoundError("User not found")
     except Exception as error:
         raise DatastoreError(error)
                                       
@@ -97,11 +371,8 @@ async def create_user(email: str, connection_string) -> datastore.User:
     Return the user User(email, user_id)
     """
     try:
-        connection = get_connection()
-        cursor = get_cursor(connection)
-        user = await datastore.new_user(cursor, email, connection_string)
-        end_query(connection, cursor)
-        return user
+        async with pooled_cursor() as cursor:
+            return await run_in_executor(datastore.new_user, cursor, email, connection_string)
     except Exception as error:
         raise DatastoreError(error)
 
@@ -111,19 +382,19 @@ async def get_picture_id(cursor, user_id, image, container_client) :
     Return the picture_id of the image
     """
     try:
-        return await nachet_datastore.upload_picture_unknown(cursor, str(user_id), image, container_client)
+        return await run_in_executor(nachet_datastore.upload_picture_unknown, cursor, str(user_id), image, container_client)
     except Exception as error:
         raise DatastoreError(error)
 
 async def upload_pictures(cursor, user_id, picture_set_id, container_client, pictures, seed_name, seed_id: str, zoom_level: float = None, nb_seeds: int = None) :
     try :
-        return await nachet_datastore.upload_pictures(cursor, user_id, picture_set_id, container_client, pictures, seed_name, seed_id, zoom_level, nb_seeds)
+        return await run_in_executor(nachet_datastore.upload_pictures, cursor, user_id, picture_set_id, container_client, pictures, seed_name, seed_id, zoom_level, nb_seeds)
     except Exception as error:
         raise DatastoreError(error)
     
 async def create_picture_set(cursor, container_client, user_id: str, nb_pictures: int, folder_name = None):
     try :
-        return await datastore.create_picture_set(cursor, container_client, nb_pictures, user_id, folder_name)
+        return await run_in_executor(datastore.create_picture_set, cursor, container_client, nb_pictures, user_id, folder_name)
     except Exception as error:
         raise DatastoreError(error)
 
@@ -132,63 +403,61 @@ async def get_pipelines() -> list:
     Retrieves the pipelines from the Datastore
     """
     try:
-        connection = get_connection()
-        cursor = get_cursor(connection)
-        pipelines = await nachet_datastore.get_ml_structure(cursor)
-        return pipelines
+        async with pooled_cursor() as cursor:
+            return await run_in_executor(nachet_datastore.get_ml_structure, cursor)
     except Exception as error: # TODO modify Exception for more specific exception
         raise GetPipelinesError(error.args[0])
 
 async def save_inference_result(cursor, user_id:str, inference_dict, picture_id:str, pipeline_id:str, type:int):
     try :
-        return await nachet_datastore.register_inference_result(cursor, user_id, inference_dict, picture_id, pipeline_id, type)
+        return await run_in_executor(nachet_datastore.register_inference_result, cursor, user_id, inference_dict, picture_id, pipeline_id, type)
     except Exception as error:
         raise DatastoreError(error)
 
 async def save_perfect_feedback(cursor, inference_id:str, user_id:str, boxes_id):
     try :
-        await nachet_datastore.new_perfect_inference_feeback(cursor, inference_id, user_id, boxes_id)
+        await run_in_executor(nachet_datastore.new_perfect_inference_feeback, cursor, inference_id, user_id, boxes_id)
     except Exception as error:
         raise DatastoreError(error)
     
 async def save_annoted_feedback(cursor, feedback_dict):
     try :
-        await nachet_datastore.new_correction_inference_feedback(cursor, feedback_dict)
+        await run_in_executor(nachet_datastore.new_correction_inference_feedback, cursor, feedback_dict)
     except Exception as error:
         raise DatastoreError(error)
 
 async def delete_directory_request(cursor, user_id, picture_set_id):
     try :
-        return len(await nachet_datastore.find_validated_pictures(cursor, user_id, picture_set_id)) > 0
+        return len(await run_in_executor(nachet_datastore.find_validated_pictures, cursor, user_id, picture_set_id)) > 0
     except Exception as error:
         raise DatastoreError(error)
 
 async def delete_directory_permanently(cursor, user_id, picture_set_id, container_client):
     try :
-        return await datastore.delete_picture_set_permanently(cursor, user_id, picture_set_id, container_client)
+        return await run_in_executor(datastore.delete_picture_set_permanently, cursor, user_id, picture_set_id, container_client)
     except Exception as error:
         raise DatastoreError(error)
 
 async def delete_directory_with_archive(cursor, user_id, picture_set_id, container_client):
     try :
-        return await nachet_datastore.delete_picture_set_with_archive(cursor, user_id, picture_set_id, container_client)
+        return await run_in_executor(nachet_datastore.delete_picture_set_with_archive, cursor, user_id, picture_set_id, container_client)
     except Exception as error:
         raise DatastoreError(error)
     
 async def get_directories(cursor, user_id):
     try :
-        return await nachet_datastore.get_picture_sets_info(cursor, user_id)
+        return await run_in_executor(nachet_datastore.get_picture_sets_info, cursor, user_id)
     except Exception as error:
         raise DatastoreError(error)
 
 async def get_inference(cursor, user_id, picture_id=None, inference_id=None):
     try :
-        return await nachet_datastore.get_picture_inference(cursor, user_id, picture_id, inference_id)
+        return await run_in_executor(nachet_datastore.get_picture_inference, cursor, user_id, picture_id, inference_id)
     except Exception as error:
         raise DatastoreError(error)
     
 async def get_picture_blob(cursor, user_id, container_client, picture_id):
     try :
-        return await nachet_datastore.get_picture_blob(cursor, user_id, container_client, picture_id)
+        return await run_in_executor(nachet_datastore.get_picture_blob, cursor, user_id, container_client, picture_id)
     except Exception as error:
         raise DatastoreError(error)
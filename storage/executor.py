@@ -0,0 +1,155 @@
+"""
+This file contains the thread pool used by the datastore wrapper.
+
+The nachet-datastore functions are coroutines, but they do their database and
+Azure Storage I/O synchronously. Awaiting them directly blocks the event loop,
+so a slow blob upload for one user stalls every other request of the worker.
+They are run instead on a dedicated, sized pool of threads, each thread
+keeping its own event loop to run the coroutines.
+"""
+
+import os
+import time
+import asyncio
+import inspect
+import threading
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+NACHET_DB_EXECUTOR_WORKERS = int(os.getenv("NACHET_DB_EXECUTOR_WORKERS", 8))
+# Number of recent queue wait times kept to compute the percentiles
+WAIT_TIME_WINDOW = 1000
+
+
+class DatastoreExecutor:
+    """
+    Thread pool running the blocking datastore calls, with metrics on the
+    time the calls wait in the queue before a thread picks them up.
+    """
+    def __init__(self, max_workers: int):
+        self.max_workers = max(1, max_workers)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._thread_data = threading.local()
+        self._queued = 0
+        self._running = 0
+        self._completed = 0
+        self._failed = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._waits = deque(maxlen=WAIT_TIME_WINDOW)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix="nachet-datastore",
+                )
+            return self._executor
+
+    def _get_thread_loop(self) -> asyncio.AbstractEventLoop:
+        loop = getattr(self._thread_data, "loop", None)
+        if loop is None or loop.is_closed():
+            loop = asyncio.new_event_loop()
+            self._thread_data.loop = loop
+        return loop
+
+    def _dequeue(self, call: dict) -> bool:
+        # Called with the lock held, by the thread starting the call or when
+        # the call is cancelled, whichever comes first
+        if call["dequeued"]:
+            return False
+        call["dequeued"] = True
+        self._queued -= 1
+        return True
+
+    def _call(self, call: dict, submitted_at: float, func, args, kwargs):
+        wait = time.perf_counter() - submitted_at
+        with self._lock:
+            self._dequeue(call)
+            self._running += 1
+            self._total_wait += wait
+            self._max_wait = max(self._max_wait, wait)
+            self._waits.append(wait)
+
+        try:
+            result = func(*args, **kwargs)
+            if inspect.isawaitable(result):
+                result = self._get_thread_loop().run_until_complete(result)
+        except BaseException:
+            with self._lock:
+                self._failed += 1
+            raise
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+        return result
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) on the pool and return its result. If func
+        is a coroutine function, the coroutine is run to completion on the
+        thread's own event loop.
+        """
+        loop = asyncio.get_running_loop()
+        call = {"dequeued": False}
+        with self._lock:
+            self._queued += 1
+        future = loop.run_in_executor(
+            self._get_executor(),
+            self._call,
+            call,
+            time.perf_counter(),
+            func,
+            args,
+            kwargs,
+        )
+
+        def dequeue_cancelled(future):
+            # A call cancelled before a thread picked it up is never started
+            if future.cancelled():
+                with self._lock:
+                    self._dequeue(call)
+
+        future.add_done_callback(dequeue_cancelled)
+        return await future
+
+    def stats(self) -> dict:
+        with self._lock:
+            waits = sorted(self._waits)
+            started = self._completed + self._running
+
+            def percentile(ratio):
+                if not waits:
+                    return 0.0
+                return waits[min(len(waits) - 1, int(ratio * len(waits)))]
+
+            return {
+                "max_workers": self.max_workers,
+                "queued": self._queued,
+                "running": self._running,
+                "completed": self._completed,
+                "failed": self._failed,
+                "wait_time": {
+                    "mean": self._total_wait / started if started else 0.0,
+                    "p50": percentile(0.5),
+                    "p95": percentile(0.95),
+                    "max": self._max_wait,
+                },
+            }
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+datastore_executor = DatastoreExecutor(NACHET_DB_EXECUTOR_WORKERS)
+
+
+async def run_in_executor(func, *args, **kwargs):
+    return await datastore_executor.run(func, *args, **kwargs)
@@ -0,0 +1,30 @@
+from collections import namedtuple
+
+# Same fields as the Model of app.py, which can't be imported without the
+# datastore
+Model = namedtuple(
+    "Model",
+    [
+        "request_function",
+        "name",
+        "version",
+        "endpoint",
+        "api_key",
+        "content_type",
+        "deployment_platform",
+        "settings",
+    ],
+)
+
+
+def make_model(name, request_function=None, endpoint="http://localhost:8080/score", settings=None):
+    return Model(
+        request_function,
+        name,
+        1,
+        endpoint,
+        "test_api_key",
+        "application/json",
+        "azureml-model-deployment",
+        settings or {},
+    )
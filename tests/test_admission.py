@@ -0,0 +1,78 @@
+import asyncio
+import unittest
+
+from model.admission import AdmissionController, AdmissionRejectedError
+
+
+class TestAdmissionController(unittest.IsolatedAsyncioTestCase):
+    async def test_global_limit_queues_requests(self):
+        admission = AdmissionController(max_concurrency=1, queue_size=1, queue_timeout=1)
+        await admission.acquire("pipeline")
+
+        waiting = asyncio.ensure_future(admission.acquire("pipeline"))
+        await asyncio.sleep(0)
+        self.assertEqual(admission.stats()["queued"], 1)
+        self.assertFalse(waiting.done())
+
+        admission.release("pipeline", 0.5)
+        self.assertGreaterEqual(await waiting, 0)
+        stats = admission.stats()
+        self.assertEqual(stats["running"], 1)
+        self.assertEqual(stats["queued"], 0)
+        self.assertEqual(stats["admitted"], 2)
+
+    async def test_full_queue_rejects_at_once(self):
+        admission = AdmissionController(max_concurrency=1, queue_size=1, queue_timeout=1)
+        await admission.acquire("pipeline")
+        waiting = asyncio.ensure_future(admission.acquire("pipeline"))
+        await asyncio.sleep(0)
+
+        with self.assertRaises(AdmissionRejectedError) as context:
+            await admission.acquire("pipeline")
+        self.assertGreaterEqual(context.exception.retry_after, 1)
+        self.assertEqual(admission.stats()["rejected"], 1)
+
+        waiting.cancel()
+
+    async def test_queue_timeout(self):
+        admission = AdmissionController(max_concurrency=1, queue_size=1, queue_timeout=0.01)
+        await admission.acquire("pipeline")
+
+        with self.assertRaises(AdmissionRejectedError):
+            await admission.acquire("pipeline")
+        stats = admission.stats()
+        self.assertEqual(stats["timed_out"], 1)
+        self.assertEqual(stats["queued"], 0)
+
+    async def test_pipeline_limit_does_not_block_other_pipelines(self):
+        admission = AdmissionController(max_concurrency=4, queue_size=4, queue_timeout=1)
+        await admission.acquire("slow", 1)
+
+        waiting = asyncio.ensure_future(admission.acquire("slow", 1))
+        await admission.acquire("fast", 1)
+        await asyncio.sleep(0)
+        self.assertFalse(waiting.done())
+        self.assertEqual(admission.stats()["pipelines"]["slow"], {"running": 1, "queued": 1})
+
+        admission.release("slow")
+        await waiting
+        self.assertEqual(admission.stats()["running"], 2)
+
+    async def test_cancelled_waiter_leaves_the_queue(self):
+        admission = AdmissionController(max_concurrency=1, queue_size=1, queue_timeout=1)
+        await admission.acquire("pipeline")
+        waiting = asyncio.ensure_future(admission.acquire("pipeline"))
+        await asyncio.sleep(0)
+
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        admission.release("pipeline")
+
+        stats = admission.stats()
+        self.assertEqual(stats["queued"], 0)
+        self.assertEqual(stats["running"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
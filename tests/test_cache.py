@@ -0,0 +1,195 @@
+import os
+import time
+import tempfile
+import unittest
+
+from storage.cache import LRUCache, DiskCache, TieredCache, ResultCache
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_get_and_set(self):
+        cache = LRUCache(max_size=2)
+        cache.set("a", 1)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("b", 0), 0)
+        self.assertIn("a", cache)
+
+    def test_least_recently_used_evicted(self):
+        evicted = []
+        cache = LRUCache(max_size=2, on_evict=lambda key, value, expires_at: evicted.append(key))
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertNotIn("b", cache)
+        self.assertIn("a", cache)
+        self.assertIn("c", cache)
+        self.assertEqual(evicted, ["b"])
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_entries_expire(self):
+        cache = LRUCache(max_size=2, ttl=0.01)
+        cache.set("a", 1)
+        cache.set("b", 2, ttl=60)
+        time.sleep(0.02)
+
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), 2)
+        self.assertEqual(cache.stats()["expirations"], 1)
+
+    def test_pop_and_clear(self):
+        cache = LRUCache(max_size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+
+        self.assertEqual(cache.pop("a"), 1)
+        self.assertIsNone(cache.pop("a"))
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_hit_rate(self):
+        cache = LRUCache(max_size=2)
+        cache.set("a", 1)
+        cache.get("a")
+        cache.get("a")
+        cache.get("a")
+        cache.get("b")
+
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 3)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hit_rate"], 0.75)
+
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_get_and_set(self):
+        cache = DiskCache(self.directory.name, max_bytes=100)
+        cache.set("a", b"data")
+
+        self.assertEqual(cache.get("a"), b"data")
+        self.assertIsNone(cache.get("b"))
+
+    def test_least_recently_used_removed_over_max_bytes(self):
+        cache = DiskCache(self.directory.name, max_bytes=10)
+        cache.set("a", b"12345")
+        cache.set("b", b"12345")
+        cache.get("a")
+        cache.set("c", b"12345")
+
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), b"12345")
+        self.assertEqual(cache.stats()["bytes"], 10)
+
+    def test_caches_sharing_a_directory_keep_their_files(self):
+        first = DiskCache(self.directory.name, max_bytes=100, ttl=60)
+        first.set("a", b"data")
+        second = DiskCache(self.directory.name, max_bytes=100, ttl=60)
+        second.set("a", b"other")
+
+        self.assertEqual(first.get("a"), b"data")
+        self.assertEqual(second.get("a"), b"other")
+
+    def test_entries_expire(self):
+        cache = DiskCache(self.directory.name, max_bytes=100, ttl=0.01)
+        cache.set("a", b"data")
+        time.sleep(0.02)
+
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["expirations"], 1)
+        self.assertEqual(os.listdir(cache.directory), [])
+
+    def test_expired_files_of_previous_process_removed(self):
+        previous = DiskCache(self.directory.name, max_bytes=100, ttl=60)
+        previous.set("a", b"data")
+        os.utime(previous.directory, (0, 0))
+        cache = DiskCache(self.directory.name, max_bytes=100, ttl=60)
+
+        self.assertEqual(os.listdir(self.directory.name), [os.path.basename(cache.directory)])
+
+
+class TestTieredCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_memory_bounded_by_bytes(self):
+        cache = TieredCache(max_size=10, max_bytes=10, directory=self.directory.name, max_disk_bytes=100)
+        cache.set("a", b"123456")
+        cache.set("b", b"123456")
+
+        self.assertEqual(cache.memory.stats()["bytes"], 6)
+        self.assertIn("a", cache.disk)
+        self.assertEqual(cache.get("a"), b"123456")
+        self.assertEqual(cache.get("b"), b"123456")
+
+    def test_value_larger_than_memory_goes_to_disk(self):
+        cache = TieredCache(max_size=10, max_bytes=10, directory=self.directory.name, max_disk_bytes=100)
+        cache.set("a", b"0123456789abc")
+
+        self.assertNotIn("a", cache.memory)
+        self.assertEqual(cache.disk.get("a"), b"0123456789abc")
+
+    def test_ttl_kept_on_disk(self):
+        cache = TieredCache(max_size=1, directory=self.directory.name, max_disk_bytes=100, ttl=0.05)
+        cache.set("a", b"1")
+        time.sleep(0.03)
+        cache.set("b", b"2")
+
+        self.assertIn("a", cache.disk)
+        self.assertLess(cache.disk.remaining_ttl("a"), 0.03)
+        time.sleep(0.03)
+        self.assertIsNone(cache.get("a"))
+
+    def test_pop(self):
+        cache = TieredCache(max_size=1, directory=self.directory.name, max_disk_bytes=100)
+        cache.set("a", b"1")
+        cache.set("b", b"2")
+        cache.pop("a")
+        cache.pop("b")
+
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+
+
+class TestResultCache(unittest.TestCase):
+    def test_get_returns_a_copy(self):
+        cache = ResultCache(max_size=2)
+        cache.set("a", [{"boxes": []}])
+
+        result = cache.get("a")
+        result[0]["boxes"].append("box")
+        self.assertEqual(cache.get("a"), [{"boxes": []}])
+
+    def test_unserializable_result_not_cached(self):
+        cache = ResultCache(max_size=2)
+        cache.set("a", [{"images": b"bytes"}])
+
+        self.assertIsNone(cache.get("a"))
+
+    def test_disk_tier(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ResultCache(max_size=1, directory=directory, max_disk_bytes=1000)
+            cache.set("a", [1])
+            cache.set("b", [2])
+
+            self.assertIn("a", cache.disk)
+            self.assertEqual(cache.get("a"), [1])
+            # "a" is back in memory, "b" was moved to disk to make room
+            self.assertNotIn("a", cache.disk)
+            self.assertIn("b", cache.disk)
+            self.assertEqual(cache.get("b"), [2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,216 @@
+import asyncio
+import unittest
+import httpx
+
+from unittest.mock import patch
+
+from model import deadline, http_client
+from model.circuit_breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN, PROBE, MIN_LATENCY_SAMPLES
+from tests.helpers import make_model
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker(
+            "test_model", failure_threshold=2, open_seconds=30, min_timeout=1, max_timeout=60
+        )
+
+    def test_opens_after_consecutive_failures(self):
+        for _ in range(2):
+            self.assertTrue(self.breaker.before_call())
+            self.breaker.record_failure()
+
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertFalse(self.breaker.before_call())
+        self.assertGreater(self.breaker.retry_after(), 0)
+        self.assertEqual(self.breaker.stats()["rejected"], 1)
+
+    def test_success_resets_the_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_success(0.1)
+        self.breaker.record_failure()
+
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_half_open_lets_one_probe_through(self):
+        for _ in range(2):
+            self.breaker.record_failure()
+
+        with patch("model.circuit_breaker.time.monotonic", return_value=10 ** 9):
+            self.assertEqual(self.breaker.state, HALF_OPEN)
+            self.assertTrue(self.breaker.before_call())
+            self.assertFalse(self.breaker.before_call())
+            self.breaker.record_success(0.1)
+            self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_release_of_older_call_keeps_probe(self):
+        call = self.breaker.before_call()
+        for _ in range(2):
+            self.breaker.record_failure()
+
+        with patch("model.circuit_breaker.time.monotonic", return_value=10 ** 9):
+            self.assertEqual(self.breaker.before_call(), PROBE)
+            self.breaker.release(call)
+            self.assertFalse(self.breaker.before_call())
+
+    def test_failed_probe_opens_again(self):
+        for _ in range(2):
+            self.breaker.record_failure()
+
+        with patch("model.circuit_breaker.time.monotonic", return_value=10 ** 9):
+            self.assertTrue(self.breaker.before_call())
+            self.breaker.record_failure()
+            self.assertEqual(self.breaker.state, OPEN)
+
+    def test_adaptive_timeout(self):
+        self.assertEqual(self.breaker.timeout(), 60)
+
+        for _ in range(MIN_LATENCY_SAMPLES):
+            self.breaker.record_success(2.0)
+
+        self.assertEqual(self.breaker.timeout(), 6.0)
+
+
+class TestHttpClientCircuit(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.model = make_model("circuit_model", endpoint="http://localhost:8080/circuit")
+        http_client._breakers.clear()
+        self.requests = 0
+
+    async def asyncTearDown(self):
+        http_client._breakers.clear()
+        await http_client.close_clients()
+
+    def mock_client(self, status_code):
+        def handler(request):
+            self.requests += 1
+            return httpx.Response(status_code)
+
+        return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    async def test_open_circuit_fails_fast(self):
+        client = self.mock_client(503)
+        with patch("model.http_client.get_client", return_value=client), \
+                patch.object(http_client.get_breaker(self.model), "failure_threshold", 2):
+            for _ in range(2):
+                with self.assertRaises(http_client.ModelEndpointError):
+                    await http_client.post(self.model, b"body")
+            with self.assertRaises(http_client.CircuitOpenError):
+                await http_client.post(self.model, b"body")
+
+        self.assertEqual(self.requests, 2)
+        with self.assertRaises(http_client.CircuitOpenError):
+            http_client.check_circuit(self.model)
+
+    async def test_client_errors_do_not_open_the_circuit(self):
+        client = self.mock_client(400)
+        with patch("model.http_client.get_client", return_value=client), \
+                patch.object(http_client.get_breaker(self.model), "failure_threshold", 1):
+            for _ in range(3):
+                with self.assertRaises(http_client.ModelEndpointError):
+                    await http_client.post(self.model, b"body")
+
+        self.assertEqual(self.requests, 3)
+
+    async def test_find_circuit_open_error(self):
+        circuit_open_error = http_client.CircuitOpenError("open", 5)
+        try:
+            try:
+                raise circuit_open_error
+            except http_client.ModelEndpointError as error:
+                raise ValueError("wrapped") from error
+        except ValueError as error:
+            self.assertIs(http_client.find_circuit_open_error(error), circuit_open_error)
+
+
+class TestHttpClientReplicas(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.replicas = ["http://replica1:8080/score", "http://replica2:8080/score"]
+        self.model = make_model("replica_model", endpoint=self.replicas[0], settings={"replicas": self.replicas})
+        http_client._breakers.clear()
+        self.requests = []
+        self.cancelled = []
+
+    async def asyncTearDown(self):
+        http_client._breakers.clear()
+        await http_client.close_clients()
+
+    def mock_client(self, delays):
+        class Client:
+            async def post(client, endpoint, **kwargs):
+                self.requests.append(endpoint)
+                try:
+                    await asyncio.sleep(delays[endpoint])
+                except asyncio.CancelledError:
+                    self.cancelled.append(endpoint)
+                    raise
+                return httpx.Response(
+                    200, content=endpoint.encode(), request=httpx.Request("POST", endpoint)
+                )
+
+        return Client()
+
+    def record_latency(self, endpoint, latency):
+        for _ in range(MIN_LATENCY_SAMPLES):
+            http_client.get_breaker(self.model, endpoint).record_success(latency)
+
+    async def test_routes_to_the_fastest_replica(self):
+        self.record_latency(self.replicas[0], 0.5)
+        self.record_latency(self.replicas[1], 0.1)
+        client = self.mock_client({self.replicas[0]: 0, self.replicas[1]: 0})
+        with patch("model.http_client.get_client", return_value=client):
+            content = await http_client.post(self.model, b"body")
+
+        self.assertEqual(content, self.replicas[1].encode())
+        self.assertEqual(self.requests, [self.replicas[1]])
+
+    async def test_deadline_error_is_not_hedged(self):
+        self.record_latency(self.replicas[0], 0.01)
+        self.record_latency(self.replicas[1], 0.02)
+
+        async def post_to_endpoint(model, endpoint, body):
+            self.requests.append(endpoint)
+            raise deadline.DeadlineExceededError("budget spent")
+
+        with patch("model.http_client.post_to_endpoint", new=post_to_endpoint):
+            with self.assertRaises(deadline.DeadlineExceededError):
+                await http_client.post(self.model, b"body")
+
+        self.assertEqual(self.requests, [self.replicas[0]])
+
+    async def test_hedged_request_wins_and_cancels_the_slow_one(self):
+        self.record_latency(self.replicas[0], 0.01)
+        self.record_latency(self.replicas[1], 0.02)
+        client = self.mock_client({self.replicas[0]: 10, self.replicas[1]: 0})
+        with patch("model.http_client.get_client", return_value=client):
+            content = await http_client.post(self.model, b"body")
+            await asyncio.sleep(0)
+
+        self.assertEqual(content, self.replicas[1].encode())
+        self.assertEqual(self.requests, self.replicas)
+        self.assertEqual(self.cancelled, [self.replicas[0]])
+
+    async def test_failed_replica_is_skipped(self):
+        for _ in range(http_client.get_breaker(self.model, self.replicas[0]).failure_threshold):
+            http_client.get_breaker(self.model, self.replicas[0]).record_failure()
+        client = self.mock_client({self.replicas[0]: 0, self.replicas[1]: 0})
+        with patch("model.http_client.get_client", return_value=client):
+            content = await http_client.post(self.model, b"body")
+            http_client.check_circuit(self.model)
+
+        self.assertEqual(content, self.replicas[1].encode())
+
+    async def test_single_endpoint_is_not_hedged(self):
+        model = self.model._replace(settings={})
+        for _ in range(MIN_LATENCY_SAMPLES):
+            http_client.get_breaker(model).record_success(0.01)
+        client = self.mock_client({self.replicas[0]: 0.1})
+        with patch("model.http_client.get_client", return_value=client):
+            content = await http_client.post(model, b"body")
+
+        self.assertEqual(content, self.replicas[0].encode())
+        self.assertEqual(self.requests, [self.replicas[0]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import time
+import asyncio
+import threading
+import unittest
+
+from storage.executor import DatastoreExecutor
+
+
+class TestDatastoreExecutor(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.executor = DatastoreExecutor(max_workers=2)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    async def test_run_function_off_the_event_loop(self):
+        result = await self.executor.run(threading.get_ident)
+        self.assertNotEqual(result, threading.get_ident())
+
+    async def test_run_coroutine_function(self):
+        def query(value):
+            time.sleep(0.01)
+            return value * 2
+
+        # Like the datastore coroutines, it blocks the thread running it
+        async def blocking_query(value):
+            return query(value)
+
+        result = await self.executor.run(blocking_query, 21)
+        self.assertEqual(result, 42)
+
+    async def test_event_loop_not_blocked(self):
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.005)
+
+        ticker = asyncio.create_task(tick())
+        await self.executor.run(time.sleep, 0.1)
+        ticker.cancel()
+        self.assertGreater(ticks, 5)
+
+    async def test_error_is_raised_and_counted(self):
+        def failing_query():
+            raise ValueError("query failed")
+
+        with self.assertRaises(ValueError):
+            await self.executor.run(failing_query)
+        self.assertEqual(self.executor.stats()["failed"], 1)
+
+    async def test_queue_wait_time_metrics(self):
+        # 4 calls on 2 workers, the last 2 wait for a free thread
+        await asyncio.gather(*[self.executor.run(time.sleep, 0.05) for _ in range(4)])
+
+        stats = self.executor.stats()
+        self.assertEqual(stats["completed"], 4)
+        self.assertEqual(stats["queued"], 0)
+        self.assertEqual(stats["running"], 0)
+        self.assertGreaterEqual(stats["wait_time"]["max"], 0.04)
+
+
+    async def test_cancelled_call_leaves_the_queue(self):
+        busy = [asyncio.ensure_future(self.executor.run(time.sleep, 0.05)) for _ in range(2)]
+        waiting = asyncio.ensure_future(self.executor.run(time.sleep, 0.05))
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.executor.stats()["queued"], 1)
+
+        waiting.cancel()
+        await asyncio.gather(*busy)
+        await asyncio.sleep(0.01)
+
+        self.assertEqual(self.executor.stats()["queued"], 0)
+        self.assertEqual(self.executor.stats()["completed"], 2)
+
+if __name__ == "__main__":
+    unittest.main()
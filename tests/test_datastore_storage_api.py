@@ -1,4 +1,6 @@
 import os
+import time
+import asyncio
 import unittest
 from app import app
 from unittest.mock import patch, MagicMock, AsyncMock
@@ -88,8 +90,16 @@ class TestSeedsGetters(unittest.IsolatedAsyncioTestCase):
         self.test_client = app.test_client()
         self.seeds = [{"seed_id": "test_seed_id", "seed_name": "test_seed_name"}]
         self.seeds_name = ["test_seed_name"]
+        # The mock connections must not stay in the pool of the other tests
+        self.pool = datastore.ConnectionPool(
+            min_size=0, max_size=2, timeout=0.05, leak_timeout=60, health_check_interval=30
+        )
+        self.patch_pool = patch('storage.datastore_storage_api.connection_pool', new=self.pool)
+        self.patch_pool.start()
     
     def tearDown(self) -> None:
+        self.patch_pool.stop()
+        self.pool.close()
         self.test_client = None
 
     async def test_get_all_seeds_successful(self):
@@ -119,23 +129,25 @@ class TestSeedsGetters(unittest.IsolatedAsyncioTestCase):
                 with self.assertRaises(datastore.SeedNotFoundError):
                     await datastore.get_all_seeds()
 
-    def test_get_all_seeds_names_successful(self):
+    async def test_get_all_seeds_names_successful(self):
         mock_cursor = MagicMock()
         mock_connection = MagicMock()
+        mock_connection.closed = 0
 
         with patch('storage.datastore_storage_api.get_connection', return_value=mock_connection), \
                 patch('storage.datastore_storage_api.get_cursor', return_value=mock_cursor):
             mock_get_all_seeds_names = MagicMock(return_value=self.seeds_name)
             
             with patch('storage.datastore_storage_api.seed_queries.get_all_seeds_names', new=mock_get_all_seeds_names):
-                seeds_name = datastore.get_all_seeds_names()
+                seeds_name = await datastore.get_all_seeds_names()
                 
                 self.assertEqual(seeds_name, self.seeds_name)
                 mock_get_all_seeds_names.assert_called_once_with(mock_cursor)
 
-    def test_get_all_seeds_names_error(self):
+    async def test_get_all_seeds_names_error(self):
         mock_cursor = MagicMock()
         mock_connection = MagicMock()
+        mock_connection.closed = 0
 
         with patch('storage.datastore_storage_api.get_connection', return_value=mock_connection), \
                 patch('storage.datastore_storage_api.get_cursor', return_value=mock_cursor):
@@ -144,7 +156,7 @@ class TestSeedsGetters(unittest.IsolatedAsyncioTestCase):
             with patch('storage.datastore_storage_api.seed_queries.get_all_seeds_names', new=mock_get_all_seeds_names):
                 
                 with self.assertRaises(datastore.SeedNotFoundError):
-                    datastore.get_all_seeds_names()
+                    await datastore.get_all_seeds_names()
 
 class TestUser(unittest.IsolatedAsyncioTestCase):
     def setUp(self) -> None:
@@ -155,85 +167,94 @@ class TestUser(unittest.IsolatedAsyncioTestCase):
         self.email = "example@gmail.com"
         self.user_id = "a427278e-28df-428f-8937-ddeeef44e72f"
         self.connection_string = os.getenv("NACHET_AZURE_STORAGE_CONNECTION_STRING")
+        self.pool = datastore.ConnectionPool(
+            min_size=0, max_size=2, timeout=0.05, leak_timeout=60, health_check_interval=30
+        )
     
     def tearDown(self) -> None:
         self.test_client = None
     
-    def test_get_user_id_successful(self):
+    async def test_get_user_id_successful(self):
         mock_is_user_registered = MagicMock(return_value=True)
         mock_get_user_id = MagicMock(return_value=self.user_id)
 
-        with patch('storage.datastore_storage_api.get_connection') as mock_get_connection, \
+        with patch('storage.datastore_storage_api.connection_pool', new=self.pool), \
+             patch('storage.datastore_storage_api.get_connection') as mock_get_connection, \
              patch('storage.datastore_storage_api.get_cursor') as mock_get_cursor, \
              patch('storage.datastore_storage_api.user_datastore.is_user_registered', new=mock_is_user_registered), \
-             patch('storage.datastore_storage_api.user_datastore.get_user_id', new=mock_get_user_id), \
-             patch('storage.datastore_storage_api.end_query') as mock_end_query :
+             patch('storage.datastore_storage_api.user_datastore.get_user_id', new=mock_get_user_id):
              
             mock_connection = mock_get_connection.return_value
+            mock_connection.closed = 0
             mock_cursor = mock_get_cursor.return_value
 
-            self.assertEqual(str(datastore.get_user_id(self.email)), self.user_id)
+            self.assertEqual(str(await datastore.get_user_id(self.email)), self.user_id)
+            # The connection goes back to the pool and is reused
+            await datastore.get_user_id(self.email)
 
             mock_get_connection.assert_called_once()
-            mock_get_cursor.assert_called_once_with(mock_connection)
-            mock_end_query.assert_called_once_with(mock_connection, mock_cursor)
+            mock_connection.commit.assert_called()
+            self.assertEqual(self.pool.stats()["in_use"], 0)
             
-            mock_is_user_registered.assert_called_once_with(mock_cursor, self.email)
-            mock_get_user_id.assert_called_once_with(mock_cursor, self.email)
+            mock_is_user_registered.assert_called_with(mock_cursor, self.email)
+            mock_get_user_id.assert_called_with(mock_cursor, self.email)
 
-    def test_get_user_id_error_user_not_found(self):
+    async def test_get_user_id_error_user_not_found(self):
         email = "not-existing-user-email"
         mock_is_user_registered = MagicMock(return_value=False)
         
-        with patch('storage.datastore_storage_api.get_connection') as mock_get_connection, \
+        with patch('storage.datastore_storage_api.connection_pool', new=self.pool), \
+             patch('storage.datastore_storage_api.get_connection') as mock_get_connection, \
              patch('storage.datastore_storage_api.get_cursor') as mock_get_cursor, \
-             patch('storage.datastore_storage_api.user_datastore.is_user_registered', new=mock_is_user_registered), \
-             patch('storage.datastore_storage_api.end_query') as mock_end_query :
+             patch('storage.datastore_storage_api.user_datastore.is_user_registered', new=mock_is_user_registered):
             
-            mock_connection = mock_get_connection.return_value
+            mock_get_connection.return_value.closed = 0
             mock_cursor = mock_get_cursor.return_value
 
             with self.assertRaises(datastore.DatastoreError):
-                datastore.get_user_id(email)
+                await datastore.get_user_id(email)
             
             mock_get_connection.assert_called_once()
-            mock_get_cursor.assert_called_once_with(mock_connection)
-            mock_end_query.assert_called_once_with(mock_connection, mock_cursor)
+            self.assertEqual(self.pool.stats()["in_use"], 0)
             
             mock_is_user_registered.assert_called_once_with(mock_cursor, email)
 
     async def test_create_user_successful(self):
         mock_new_user = AsyncMock(return_value=datastore.datastore.User(self.email, self.user_id))
 
-        with patch('storage.datastore_storage_api.get_connection') as mock_get_connection, \
+        with patch('storage.datastore_storage_api.connection_pool', new=self.pool), \
+             patch('storage.datastore_storage_api.get_connection') as mock_get_connection, \
              patch('storage.datastore_storage_api.get_cursor') as mock_get_cursor, \
-             patch('storage.datastore_storage_api.datastore.new_user', new=mock_new_user), \
-             patch('storage.datastore_storage_api.end_query') as mock_end_query:
+             patch('storage.datastore_storage_api.datastore.new_user', new=mock_new_user):
 
             mock_connection = mock_get_connection.return_value
+            mock_connection.closed = 0
             mock_cursor = mock_get_cursor.return_value
 
             await datastore.create_user(self.email, self.connection_string)
             
             mock_get_connection.assert_called_once()
             mock_get_cursor.assert_called_once_with(mock_connection)
-            mock_end_query.assert_called_once_with(mock_connection, mock_cursor)
+            mock_connection.commit.assert_called_once()
 
             mock_new_user.assert_awaited_once_with(mock_cursor, self.email, self.connection_string)
 
     async def test_create_user_error(self):
         mock_new_user = AsyncMock(side_effect=Exception('User creation error'))
 
-        with patch('storage.datastore_storage_api.get_connection') as mock_get_connection, \
+        with patch('storage.datastore_storage_api.connection_pool', new=self.pool), \
+             patch('storage.datastore_storage_api.get_connection') as mock_get_connection, \
              patch('storage.datastore_storage_api.get_cursor') as mock_get_cursor, \
              patch('storage.datastore_storage_api.datastore.new_user', new=mock_new_user) :
 
             mock_connection = mock_get_connection.return_value
+            mock_connection.closed = 0
             with self.assertRaises(datastore.DatastoreError):
                 await datastore.create_user(self.email, self.connection_string)
             
             mock_get_connection.assert_called_once()
             mock_get_cursor.assert_called_once_with(mock_connection)
+            mock_connection.rollback.assert_called_once()
 
 class TestPicture(unittest.IsolatedAsyncioTestCase):
     def setUp(self) -> None:
@@ -543,3 +564,126 @@ class TestGetPictureBlob(unittest.IsolatedAsyncioTestCase):
             mock_get_picture_blob.side_effect = Exception('Failed to retrieve directories information')
             with self.assertRaises(datastore.DatastoreError):
                 await datastore.get_picture_blob(self.mock_cursor, self.test_user_id, self.mock_container_client, self.test_picture_id)
+
+class TestConnectionPool(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.pool = datastore.ConnectionPool(
+            min_size=0, max_size=2, timeout=0.05, leak_timeout=60, health_check_interval=30
+        )
+
+    def mock_connection(self):
+        mock_connection = MagicMock()
+        mock_connection.closed = 0
+        return mock_connection
+
+    async def test_acquire_reuses_released_connection(self):
+        mock_connection = self.mock_connection()
+        with patch('storage.datastore_storage_api.get_connection', return_value=mock_connection) as mock_get_connection:
+            connection = await self.pool.acquire()
+            self.pool.release(connection)
+            self.assertIs(await self.pool.acquire(), mock_connection)
+            mock_get_connection.assert_called_once()
+
+    async def test_acquire_discards_closed_connection(self):
+        closed_connection = MagicMock()
+        new_connection = self.mock_connection()
+        with patch('storage.datastore_storage_api.get_connection', side_effect=[closed_connection, new_connection]):
+            connection = await self.pool.acquire()
+            self.pool.release(connection)
+            self.assertIs(await self.pool.acquire(), new_connection)
+            closed_connection.close.assert_called_once()
+
+    async def test_acquire_timeout(self):
+        with patch('storage.datastore_storage_api.get_connection', side_effect=lambda: self.mock_connection()):
+            await self.pool.acquire()
+            await self.pool.acquire()
+            with self.assertRaises(datastore.PoolTimeoutError):
+                await self.pool.acquire()
+
+    async def test_leak_warning(self):
+        self.pool.leak_timeout = 0
+        with patch('storage.datastore_storage_api.get_connection', side_effect=lambda: self.mock_connection()):
+            await self.pool.acquire()
+            with self.assertWarns(datastore.ConnectionLeakWarning):
+                self.pool.check_leaks()
+
+    async def test_cancelled_acquire_returns_connection(self):
+        mock_connection = self.mock_connection()
+
+        def slow_connection():
+            time.sleep(0.05)
+            return mock_connection
+
+        with patch('storage.datastore_storage_api.get_connection', side_effect=slow_connection):
+            acquire = asyncio.ensure_future(self.pool.acquire())
+            await asyncio.sleep(0.01)
+            acquire.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await acquire
+            await asyncio.sleep(0.1)
+
+            self.assertEqual(self.pool.stats(), {"idle": 1, "in_use": 0, "max_size": 2})
+            self.assertIs(await self.pool.acquire(), mock_connection)
+            await self.pool.acquire()
+
+    async def test_pooled_cursor_commit_and_rollback(self):
+        mock_connection = self.mock_connection()
+        mock_cursor = MagicMock()
+        with patch('storage.datastore_storage_api.connection_pool', new=self.pool), \
+             patch('storage.datastore_storage_api.get_connection', return_value=mock_connection), \
+             patch('storage.datastore_storage_api.get_cursor', return_value=mock_cursor):
+            async with datastore.pooled_cursor() as cursor:
+                self.assertIs(cursor, mock_cursor)
+            mock_connection.commit.assert_called_once()
+
+            with self.assertRaises(datastore.DatastoreError):
+                async with datastore.pooled_cursor():
+                    raise datastore.DatastoreError("query failed")
+            mock_connection.rollback.assert_called_once()
+            self.assertEqual(self.pool.stats()["in_use"], 0)
+
+class TestContainerClientCache(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.cache = datastore.ContainerClientCache(max_size=2, exists_ttl=60)
+        self.mock_container_client = MagicMock()
+        self.connection_string = "test_connection_string"
+
+    async def test_mount_cached(self):
+        with patch('storage.datastore_storage_api.azure_storage.mount_container', new_callable=AsyncMock) as mock_mount_container:
+            mock_mount_container.return_value = self.mock_container_client
+            first = await self.cache.mount(self.connection_string, "user_1")
+            second = await self.cache.mount(self.connection_string, "user_1")
+
+            self.assertIs(first, self.mock_container_client)
+            self.assertIs(second, self.mock_container_client)
+            mock_mount_container.assert_awaited_once_with(self.connection_string, "user_1", create_container=True)
+            self.mock_container_client.exists.assert_not_called()
+
+    async def test_mount_checks_existence_after_ttl(self):
+        self.cache.exists_ttl = 0
+        self.mock_container_client.exists.return_value = True
+        with patch('storage.datastore_storage_api.azure_storage.mount_container', new_callable=AsyncMock) as mock_mount_container:
+            mock_mount_container.return_value = self.mock_container_client
+            await self.cache.mount(self.connection_string, "user_1")
+            await self.cache.mount(self.connection_string, "user_1")
+
+            mock_mount_container.assert_awaited_once()
+            self.mock_container_client.exists.assert_called_once()
+
+    async def test_mount_again_when_container_deleted(self):
+        self.cache.exists_ttl = 0
+        self.mock_container_client.exists.return_value = False
+        with patch('storage.datastore_storage_api.azure_storage.mount_container', new_callable=AsyncMock) as mock_mount_container:
+            mock_mount_container.return_value = self.mock_container_client
+            await self.cache.mount(self.connection_string, "user_1")
+            await self.cache.mount(self.connection_string, "user_1")
+
+            self.assertEqual(mock_mount_container.await_count, 2)
+
+    async def test_least_recently_used_user_evicted(self):
+        with patch('storage.datastore_storage_api.azure_storage.mount_container', new_callable=AsyncMock) as mock_mount_container:
+            for user_id in ["user_1", "user_2", "user_3", "user_1"]:
+                await self.cache.mount(self.connection_string, user_id)
+
+            self.assertEqual(mock_mount_container.await_count, 4)
+            self.assertEqual(self.cache.stats()["evictions"], 2)
@@ -0,0 +1,73 @@
+import asyncio
+import unittest
+import httpx
+
+from unittest.mock import patch
+
+from model import deadline, http_client
+from tests.helpers import make_model
+
+
+class TestDeadline(unittest.TestCase):
+    def test_request_budget(self):
+        with patch("model.deadline.DEFAULT_BUDGET", 0):
+            self.assertIsNone(deadline.request_budget())
+            self.assertEqual(deadline.request_budget("5"), 5)
+        with patch("model.deadline.DEFAULT_BUDGET", 10):
+            self.assertEqual(deadline.request_budget(), 10)
+            self.assertEqual(deadline.request_budget("5"), 5)
+            self.assertEqual(deadline.request_budget("60"), 10)
+            with self.assertRaises(ValueError):
+                deadline.request_budget("0")
+
+    def test_bound(self):
+        async def bounded():
+            self.assertEqual(deadline.bound(30), 30)
+            deadline.start(5)
+            self.assertLessEqual(deadline.bound(30), 5)
+            self.assertLessEqual(deadline.bound(None), 5)
+            self.assertEqual(deadline.bound(1), 1)
+            self.assertFalse(deadline.expired())
+
+        asyncio.run(bounded())
+
+
+class TestHttpClientDeadline(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.model = make_model("deadline_model", endpoint="http://localhost:8080/deadline")
+        http_client._breakers.clear()
+        self.requests = 0
+
+    async def asyncTearDown(self):
+        http_client._breakers.clear()
+        await http_client.close_clients()
+
+    async def test_spent_budget_does_not_call_the_model(self):
+        def handler(request):
+            self.requests += 1
+            return httpx.Response(200)
+
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        deadline.start(0)
+        with patch("model.http_client.get_client", return_value=client):
+            with self.assertRaises(deadline.DeadlineExceededError):
+                await http_client.post(self.model, b"body")
+
+        self.assertEqual(self.requests, 0)
+
+    async def test_timeout_at_the_deadline_is_not_an_endpoint_failure(self):
+        def handler(request):
+            raise httpx.ReadTimeout("timeout", request=request)
+
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        deadline.start(1)
+        with patch("model.http_client.get_client", return_value=client):
+            with self.assertRaises(deadline.DeadlineExceededError):
+                await http_client.post(self.model, b"body")
+
+        stats = http_client.get_breaker(self.model).stats()
+        self.assertEqual(stats["failures"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -12,5 +12,16 @@ class TestQuartHealth(unittest.TestCase):
         )
         self.assertEqual(response.status_code, 200)
 
+    def test_metrics(self):
+        test = app.test_client()
+
+        response = asyncio.run(
+            test.get('/metrics')
+        )
+        result_json = asyncio.run(response.get_json())
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("wait_time", result_json["datastore_executor"])
+        self.assertIn("in_use", result_json["connection_pool"])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,157 @@
+import io
+import os
+import base64
+import asyncio
+import unittest
+
+from PIL import Image
+from unittest.mock import patch
+
+from model import image_slicing
+from model.image import SourceImage
+from model.seed_detector import process_image_slicing
+
+
+def encode(image: Image.Image, format: str) -> bytes:
+    buffered = io.BytesIO()
+    image.save(buffered, format)
+    return buffered.getvalue()
+
+
+class TestImageSlicing(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        image_slicing.shutdown()
+
+    def setUp(self):
+        image = Image.new("RGB", (120, 80), "blue")
+        image.paste((255, 0, 0), (0, 0, 60, 40))
+        self.image_bytes = encode(image, "PNG")
+        self.boxes = [
+            {"box": {"topX": 0.0, "topY": 0.0, "bottomX": 0.5, "bottomY": 0.5}},
+            {"box": {"topX": 0.5, "topY": 0.5, "bottomX": 1.0, "bottomY": 1.0}},
+            {"box": {"topX": 0.25, "topY": 0.25, "bottomX": 0.75, "bottomY": 0.75}},
+        ]
+
+    def expected_crops(self, image_bytes: bytes, encoding=image_slicing.SOURCE_ENCODING) -> list:
+        return process_image_slicing(SourceImage(image_bytes), [{"boxes": self.boxes}], encoding)
+
+    def test_pool_crops_match_the_inline_crops(self):
+        crops = asyncio.run(image_slicing.slice_image(SourceImage(self.image_bytes), self.boxes))
+
+        self.assertEqual(crops, self.expected_crops(self.image_bytes))
+
+    def test_palette_image(self):
+        image_bytes = encode(Image.open(io.BytesIO(self.image_bytes)).convert("P"), "PNG")
+
+        crops = asyncio.run(image_slicing.slice_image(SourceImage(image_bytes), self.boxes))
+
+        self.assertEqual(crops, self.expected_crops(image_bytes))
+
+    def test_crops_returned_as_they_complete(self):
+        async def collect():
+            return [
+                i async for i, _ in image_slicing.iter_crops(SourceImage(self.image_bytes), self.boxes)
+            ]
+
+        self.assertCountEqual(asyncio.run(collect()), [0, 1, 2])
+
+    def test_shared_memory_released(self):
+        before = set(os.listdir("/dev/shm")) if os.path.isdir("/dev/shm") else set()
+
+        asyncio.run(image_slicing.slice_image(SourceImage(self.image_bytes), self.boxes))
+
+        after = set(os.listdir("/dev/shm")) if os.path.isdir("/dev/shm") else set()
+        self.assertEqual(after - before, set())
+
+    def test_without_processes(self):
+        with patch("model.image_slicing.SLICING_PROCESSES", 0), \
+                patch("model.image_slicing.get_pool") as mock_get_pool:
+            crops = asyncio.run(image_slicing.slice_image(SourceImage(self.image_bytes), self.boxes))
+
+        self.assertEqual(crops, self.expected_crops(self.image_bytes))
+        mock_get_pool.assert_not_called()
+
+    def test_no_boxes(self):
+        crops = asyncio.run(image_slicing.slice_image(SourceImage(self.image_bytes), []))
+
+        self.assertEqual(crops, [])
+
+    def test_crop_encoding(self):
+        encoding = image_slicing.crop_encoding(
+            {"crop_size": 32, "crop_resample": "Bilinear", "crop_format": "jpeg", "crop_quality": 80}
+        )
+
+        self.assertEqual(encoding.size, (32, 32))
+        self.assertEqual(encoding.resample, Image.Resampling.BILINEAR)
+        self.assertEqual(encoding.format, "JPEG")
+        self.assertEqual(encoding.quality, 80)
+        self.assertEqual(image_slicing.crop_encoding({}), image_slicing.SOURCE_ENCODING)
+
+    def test_crop_encoding_invalid(self):
+        for settings in (
+            {"crop_size": [32]},
+            {"crop_size": 0},
+            {"crop_resample": "sharp"},
+            {"crop_format": "GIF"},
+            {"crop_format": "RAW"},
+            {"crop_quality": 100},
+        ):
+            with self.assertRaises(ValueError, msg=settings):
+                image_slicing.crop_encoding(settings)
+
+    def test_jpeg_crops_resized(self):
+        encoding = image_slicing.crop_encoding({"crop_size": [24, 16], "crop_format": "JPEG"})
+
+        crops = asyncio.run(
+            image_slicing.slice_image(SourceImage(self.image_bytes), self.boxes, encoding)
+        )
+
+        self.assertEqual(crops, self.expected_crops(self.image_bytes, encoding))
+        crop = Image.open(io.BytesIO(base64.b64decode(crops[0])))
+        self.assertEqual(crop.format, "JPEG")
+        self.assertEqual(crop.size, (24, 16))
+
+    def test_raw_crops(self):
+        encoding = image_slicing.crop_encoding({"crop_size": 8, "crop_format": "RAW"})
+
+        crops = asyncio.run(
+            image_slicing.slice_image(SourceImage(self.image_bytes), self.boxes, encoding)
+        )
+
+        pixels = base64.b64decode(crops[0])
+        self.assertEqual(len(pixels), 8 * 8 * 3)
+        self.assertEqual(pixels[:3], bytes((255, 0, 0)))
+
+    def test_crop_stream(self):
+        async def consume():
+            stream = image_slicing.CropStream(SourceImage(self.image_bytes), self.boxes)
+            streamed = [i async for i, _ in stream.as_completed()]
+            return len(stream), streamed, await stream.result()
+
+        length, streamed, crops = asyncio.run(consume())
+
+        self.assertEqual(length, 3)
+        self.assertCountEqual(streamed, [0, 1, 2])
+        self.assertEqual(crops, self.expected_crops(self.image_bytes))
+
+    def test_crop_stream_invalid_box(self):
+        async def create():
+            image_slicing.CropStream(SourceImage(self.image_bytes), [{"label": "no box"}])
+
+        with self.assertRaises(KeyError):
+            asyncio.run(create())
+
+    def test_crop_stream_error(self):
+        async def consume():
+            stream = image_slicing.CropStream(SourceImage(self.image_bytes), self.boxes)
+            return await image_slicing.resolve_crops(stream)
+
+        with patch("model.image_slicing.SLICING_PROCESSES", 0), \
+                patch("model.image_slicing.encode_crop", side_effect=OSError("broken image")):
+            with self.assertRaises(image_slicing.ImageSlicingError):
+                asyncio.run(consume())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,7 @@
 import unittest
 import asyncio
 
-from app import app, json, base64, Image, io
+from app import app, json, base64, Image, io, CACHE
 from unittest.mock import patch, Mock
 
 
@@ -32,6 +32,7 @@ class TestImageValidation(unittest.TestCase):
 
         self.assertEqual(response.status_code, 200)
         self.assertIsInstance(data[0], str)
+        self.assertIn(data[0], CACHE["validators"])
 
     def test_invalid_header(self):
         data = base64.b64encode(self.img_byte_array.getvalue()).decode('utf-8')
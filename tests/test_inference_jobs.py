@@ -0,0 +1,102 @@
+import asyncio
+import unittest
+
+from model.jobs import JobQueue, JobQueueFullError, DONE, FAILED, QUEUED
+
+
+class TestJobQueue(unittest.IsolatedAsyncioTestCase):
+    async def asyncTearDown(self):
+        await self.jobs.stop()
+
+    async def wait_for_job(self, job_id):
+        for _ in range(100):
+            job = self.jobs.get(job_id)
+            if job["status"] in (DONE, FAILED):
+                return job
+            await asyncio.sleep(0.01)
+        self.fail("The job did not finish")
+
+    async def test_job_result_is_polled(self):
+        self.jobs = JobQueue(workers=2, queue_size=4)
+
+        async def run(value):
+            await asyncio.sleep(0.01)
+            return {"value": value}, 200, {}
+
+        job = self.jobs.submit(run, 1)
+        self.assertEqual(job["status"], QUEUED)
+
+        job = await self.wait_for_job(job["job_id"])
+        self.assertEqual(job["status"], DONE)
+        self.assertEqual(job["status_code"], 200)
+        self.assertEqual(job["result"], {"value": 1})
+        self.assertEqual(self.jobs.stats()["done"], 1)
+
+    async def test_failed_job(self):
+        self.jobs = JobQueue(workers=1, queue_size=4)
+
+        async def fail():
+            raise ValueError("error")
+
+        async def bad_request():
+            return ["API Error"], 400, {}
+
+        failed = self.jobs.submit(fail)
+        rejected = self.jobs.submit(bad_request)
+
+        self.assertEqual((await self.wait_for_job(failed["job_id"]))["status_code"], 500)
+        job = await self.wait_for_job(rejected["job_id"])
+        self.assertEqual(job["status"], FAILED)
+        self.assertEqual(job["result"], ["API Error"])
+
+    async def test_full_queue_is_rejected(self):
+        self.jobs = JobQueue(workers=1, queue_size=1)
+        release = asyncio.Event()
+
+        async def wait():
+            await release.wait()
+            return [], 200, {}
+
+        self.jobs.submit(wait)
+        await asyncio.sleep(0)
+        self.jobs.submit(wait)
+        with self.assertRaises(JobQueueFullError) as context:
+            self.jobs.submit(wait)
+        self.assertGreaterEqual(context.exception.retry_after, 1)
+        self.assertEqual(self.jobs.stats()["rejected"], 1)
+        release.set()
+
+    async def test_progress_is_reported(self):
+        self.jobs = JobQueue(workers=1, queue_size=1)
+        release = asyncio.Event()
+
+        async def run(progress):
+            progress["done"] += 1
+            await release.wait()
+            return [], 200, {}
+
+        progress = {"total": 2, "done": 0}
+        job = self.jobs.submit(run, progress, progress=progress)
+        await asyncio.sleep(0.01)
+
+        self.assertEqual(self.jobs.get(job["job_id"])["progress"], {"total": 2, "done": 1})
+        release.set()
+        job = await self.wait_for_job(job["job_id"])
+        self.assertEqual(job["progress"]["done"], 1)
+
+    async def test_results_expire(self):
+        self.jobs = JobQueue(workers=1, queue_size=1, retention_seconds=0.05)
+
+        async def run():
+            return [], 200, {}
+
+        job = self.jobs.submit(run)
+        await self.wait_for_job(job["job_id"])
+        await asyncio.sleep(0.1)
+
+        self.assertIsNone(self.jobs.get(job["job_id"]))
+        self.assertIsNone(self.jobs.get("unknown"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,7 +5,8 @@ import base64
 import asyncio
 import warnings
 
-from app import app, ImageWarning
+from app import app, ImageWarning, INFERENCE_JOBS, within_budget
+from model import deadline
 from unittest.mock import patch, MagicMock, Mock
 
 class TestInferenceRequest(unittest.TestCase):
@@ -214,6 +215,81 @@ class TestInferenceRequest(unittest.TestCase):
         self.assertEqual(result_json[0], expected)
         self.assertEqual(response.status_code, 400)
 
+    def test_inference_request_binary_missing_argument(self):
+        # Build expected response
+        expected = ("API Error during classification : missing request arguments: either folder_name, container_name, imageDims or image is missing")
+
+        with open(os.path.join(os.path.dirname(__file__), 'img/1310_1.png'), 'rb') as image_file:
+            image_bytes = image_file.read()
+
+        # Test the answers from inference_request, the image is sent as the raw
+        # body and the arguments in the query string
+        response = asyncio.run(
+            self.test.post(
+                '/inf',
+                headers={
+                    "Content-Type": "image/png",
+                    "Access-Control-Allow-Origin": "*",
+                },
+                query_string={
+                    "folder_name": self.folder_name,
+                    "container_name": self.container_name,
+                    "model_name": self.pipeline.get("pipeline_name")
+                },
+                data=image_bytes,
+            )
+        )
+        result_json = json.loads(asyncio.run(response.get_data()))
+
+        self.assertEqual(result_json[0], expected)
+        self.assertEqual(response.status_code, 400)
+
+    def test_inference_request_multipart_invalid_image_dims(self):
+        # Build expected response
+        expected = ("API Error during classification : invalid value for imageDims: 720x540")
+
+        response = asyncio.run(
+            self.test.post(
+                '/inf',
+                form={
+                    "imageDims": "720x540",
+                    "folder_name": self.folder_name,
+                    "container_name": self.container_name,
+                    "model_name": self.pipeline.get("pipeline_name")
+                },
+            )
+        )
+        result_json = json.loads(asyncio.run(response.get_data()))
+
+        self.assertEqual(result_json[0], expected)
+        self.assertEqual(response.status_code, 400)
+
+    def test_inference_request_unknown_validator(self):
+        # Build expected response
+        expected = ("API Error during classification : no validated image found for validator unknown_validator, the image must be sent again")
+
+        # Test the answers from inference_request
+        response = asyncio.run(
+            self.test.post(
+                '/inf',
+                headers={
+                    "Content-Type": "application/json",
+                    "Access-Control-Allow-Origin": "*",
+                },
+                json={
+                    "validator": "unknown_validator",
+                    "imageDims": [720,540],
+                    "folder_name": self.folder_name,
+                    "container_name": self.container_name,
+                    "model_name": self.pipeline.get("pipeline_name")
+                }
+            )
+        )
+        result_json = json.loads(asyncio.run(response.get_data()))
+
+        self.assertEqual(result_json[0], expected)
+        self.assertEqual(response.status_code, 400)
+
     # TODO test validation error when frontend return validators
     def test_inference_request_validation_warning(self):
         # Build expected response
@@ -239,5 +315,132 @@ class TestInferenceRequest(unittest.TestCase):
         self.assertTrue(issubclass(w[-1].category, ImageWarning))
         self.assertTrue("this picture was not validate" in str(w[-1].message))
 
+    @patch("app.run_inference")
+    def test_inference_job(self, mock_run_inference):
+        result = {"boxes": [], "totalBoxes": 0}
+        mock_run_inference.return_value = (result, 200, {})
+
+        async def submit_and_poll():
+            response = await self.test.post(
+                '/inf-jobs',
+                headers={"Content-Type": "application/json"},
+                json={
+                    "image": self.image_header + self.image_src,
+                    "imageDims": [720,540],
+                    "folder_name": self.folder_name,
+                    "container_name": self.container_name,
+                    "model_name": self.pipeline.get("pipeline_name")
+                }
+            )
+            self.assertEqual(response.status_code, 202)
+            job = await response.get_json()
+            self.assertEqual(response.headers["Location"], f"/inf-jobs/{job['job_id']}")
+
+            for _ in range(100):
+                response = await self.test.get(f"/inf-jobs/{job['job_id']}")
+                job = await response.get_json()
+                if job["status"] == "done":
+                    break
+                await asyncio.sleep(0.01)
+            await INFERENCE_JOBS.stop()
+            return job
+
+        job = asyncio.run(submit_and_poll())
+
+        self.assertEqual(job["status"], "done")
+        self.assertEqual(job["result"], result)
+        self.assertEqual(job["status_code"], 200)
+
+        response = asyncio.run(self.test.get("/inf-jobs/unknown"))
+        self.assertEqual(response.status_code, 404)
+
+    @patch("app.run_inference")
+    @patch("app.datastore.get_picture_blob")
+    @patch("app.datastore.get_directories")
+    @patch("app.datastore.pooled_cursor")
+    @patch("app.datastore.mount_container")
+    def test_batch_inference(self, mock_container, mock_cursor, mock_directories, mock_blob, mock_run_inference):
+        with open(os.path.join(os.path.dirname(__file__), 'img/1310_1.png'), 'rb') as image_file:
+            image_bytes = image_file.read()
+        mock_directories.return_value = [{
+            "folder_name": self.folder_name,
+            "picture_set_id": "set-1",
+            "nb_pictures": 3,
+            "pictures": [{"picture_id": f"picture-{i}"} for i in range(3)],
+        }]
+        mock_blob.return_value = image_bytes
+        responses = {
+            "picture-0": [([{"boxes": []}], 200, {})],
+            "picture-1": [(["API Error"], 400, {})],
+            # A picture rejected by the inference queue is tried again
+            "picture-2": [
+                (["Too many inference requests"], 503, {"Retry-After": "0"}),
+                ([{"boxes": []}], 200, {}),
+            ],
+        }
+        mock_run_inference.side_effect = lambda data, blob, picture_id: responses[picture_id].pop(0)
+
+        async def submit_and_poll():
+            response = await self.test.post(
+                '/batch-inference',
+                headers={"Content-Type": "application/json"},
+                json={
+                    "container_name": self.container_name,
+                    "session_id": "set-1",
+                    "model_name": self.pipeline.get("pipeline_name")
+                }
+            )
+            self.assertEqual(response.status_code, 202)
+            job = await response.get_json()
+
+            for _ in range(100):
+                response = await self.test.get(f"/inf-jobs/{job['job_id']}")
+                job = await response.get_json()
+                if job["status"] == "done":
+                    break
+                await asyncio.sleep(0.01)
+            await INFERENCE_JOBS.stop()
+            return job
+
+        job = asyncio.run(submit_and_poll())
+
+        self.assertEqual(job["status"], "done")
+        self.assertEqual(job["progress"], {"total": 3, "done": 2, "failed": 1})
+        self.assertEqual(
+            [result["picture_id"] for result in job["result"]["results"]],
+            ["picture-0", "picture-1", "picture-2"],
+        )
+        data, blob = mock_run_inference.call_args.args
+        self.assertEqual(blob, image_bytes)
+        self.assertEqual(data["folder_name"], self.folder_name)
+        self.assertEqual(len(data["imageDims"]), 2)
+        self.assertEqual(mock_run_inference.call_count, 4)
+        self.assertEqual(responses["picture-2"], [])
+
+        response = asyncio.run(self.test.post(
+            '/batch-inference',
+            headers={"Content-Type": "application/json"},
+            json={"container_name": self.container_name, "session_id": "set-1"}
+        ))
+        self.assertEqual(response.status_code, 400)
+
+    def test_datastore_call_within_budget(self):
+        async def save(delay):
+            await asyncio.sleep(delay)
+            saved.append(delay)
+            return delay
+
+        async def run():
+            deadline.start(0.05)
+            self.assertEqual(await within_budget(save(0)), 0)
+            with self.assertRaises(deadline.DeadlineExceededError):
+                await within_budget(save(0.1))
+            # The call is not cancelled and completes in the background
+            await asyncio.sleep(0.1)
+
+        saved = []
+        asyncio.run(run())
+        self.assertEqual(saved, [0, 0.1])
+
 if __name__ == '__main__':
     unittest.main()
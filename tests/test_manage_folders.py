@@ -5,7 +5,7 @@ import json
 import base64
 from unittest.mock import patch, MagicMock
 from app import app
-from storage.datastore_storage_api import DatastoreError
+from storage.datastore_storage_api import DatastoreError, container_clients
 
 class TestMissingEnvError(Exception):
     pass
@@ -46,6 +46,8 @@ class TestCreateFolder(unittest.TestCase):
         self.mock_connect_db = self.patch_connect_db.start()
         self.mock_cursor = self.patch_cursor.start()
         self.mock_mount_container = self.patch_mount_container.start()
+        # Start every test without the container clients mounted by the others
+        container_clients.clear()
         self.mock_create_picture_set = self.patch_create_picture_set.start()
         self.mock_end_query = self.patch_end_query.start()
 
@@ -84,7 +86,8 @@ class TestCreateFolder(unittest.TestCase):
         self.mock_connect_db.assert_called_once_with(NACHET_DB_URL, NACHET_SCHEMA)
         self.mock_cursor.assert_called_once_with(self.mock_connection)
         self.mock_create_picture_set.assert_called_once_with(self.mock_cur, self.mock_container_client, self.container_name, 0, self.folder_name)
-        self.mock_end_query.assert_called_once_with(self.mock_connection, self.mock_cur)
+        self.mock_connection.commit.assert_called_once()
+        self.mock_cur.close.assert_called_once()
      
     def test_create_directory_missing_argument_error(self):
         """
@@ -166,6 +169,8 @@ class TestGetFolders(unittest.TestCase):
         self.mock_connect_db = self.patch_connect_db.start()
         self.mock_cursor = self.patch_cursor.start()
         self.mock_get_directories = self.patch_get_directories.start()
+        # Start every test without the container clients mounted by the others
+        container_clients.clear()
         self.mock_end_query = self.patch_end_query.start()
 
     def tearDown(self) -> None:
@@ -199,7 +204,8 @@ class TestGetFolders(unittest.TestCase):
         self.mock_connect_db.assert_called_once_with(NACHET_DB_URL, NACHET_SCHEMA)
         self.mock_cursor.assert_called_once_with(self.mock_connection)
         self.mock_get_directories.assert_called_once_with(self.mock_cur, self.container_name)
-        self.mock_end_query.assert_called_once_with(self.mock_connection, self.mock_cur)
+        self.mock_connection.commit.assert_called_once()
+        self.mock_cur.close.assert_called_once()
     
     def test_get_directories_missing_argument_error(self):
         """
@@ -294,6 +300,8 @@ class TestGetPicture(unittest.TestCase):
         self.mock_connect_db = self.patch_connect_db.start()
         self.mock_cursor = self.patch_cursor.start()
         self.mock_mount_container = self.patch_mount_container.start()
+        # Start every test without the container clients mounted by the others
+        container_clients.clear()
         self.mock_get_inference = self.patch_get_inference.start()
         self.mock_get_picture_blob = self.patch_get_picture_blob.start()
         self.mock_end_query = self.patch_end_query.start()
@@ -335,7 +343,8 @@ class TestGetPicture(unittest.TestCase):
         self.mock_cursor.assert_called_once_with(self.mock_connection)
         self.mock_get_inference.assert_called_once_with(self.mock_cur, self.container_name, self.picture_id)
         self.mock_get_picture_blob.assert_called_once_with(self.mock_cur, self.container_name, self.mock_container_client, self.picture_id)
-        self.mock_end_query.assert_called_once_with(self.mock_connection, self.mock_cur)
+        self.mock_connection.commit.assert_called_once()
+        self.mock_cur.close.assert_called_once()
         
 
 class TestDeleteFolder(unittest.TestCase):
@@ -368,6 +377,8 @@ class TestDeleteFolder(unittest.TestCase):
         self.mock_connect_db = self.patch_connect_db.start()
         self.mock_cursor = self.patch_cursor.start()
         self.mock_mount_container = self.patch_mount_container.start()
+        # Start every test without the container clients mounted by the others
+        container_clients.clear()
         self.mock_delete_directory_request = self.patch_delete_directory_request.start()
         self.mock_delete_directory_permanently = self.patch_delete_directory_permanently.start()
         self.mock_delete_with_archive = self.patch_delete_with_archive.start()
@@ -409,7 +420,8 @@ class TestDeleteFolder(unittest.TestCase):
         self.mock_connect_db.assert_called_once_with(NACHET_DB_URL, NACHET_SCHEMA)
         self.mock_cursor.assert_called_once_with(self.mock_connection)
         self.mock_delete_directory_request.assert_called_once_with(self.mock_cur, self.container_name, self.folder_uuid)
-        self.mock_end_query.assert_called_once_with(self.mock_connection, self.mock_cur)
+        self.mock_connection.commit.assert_called_once()
+        self.mock_cur.close.assert_called_once()
         
     def test_delete_permanently_successful(self):
         """
@@ -435,7 +447,8 @@ class TestDeleteFolder(unittest.TestCase):
         self.mock_connect_db.assert_called_once_with(NACHET_DB_URL, NACHET_SCHEMA)
         self.mock_cursor.assert_called_once_with(self.mock_connection)
         self.mock_delete_directory_permanently.assert_called_once_with(self.mock_cur, self.container_name, self.folder_uuid, self.mock_container_client)
-        self.mock_end_query.assert_called_once_with(self.mock_connection, self.mock_cur)
+        self.mock_connection.commit.assert_called_once()
+        self.mock_cur.close.assert_called_once()
 
     def test_delete_with_archive_successful(self):
         """
@@ -461,7 +474,8 @@ class TestDeleteFolder(unittest.TestCase):
         self.mock_connect_db.assert_called_once_with(NACHET_DB_URL, NACHET_SCHEMA)
         self.mock_cursor.assert_called_once_with(self.mock_connection)
         self.mock_delete_with_archive.assert_called_once_with(self.mock_cur, self.container_name, self.folder_uuid, self.mock_container_client)
-        self.mock_end_query.assert_called_once_with(self.mock_connection, self.mock_cur)
+        self.mock_connection.commit.assert_called_once()
+        self.mock_cur.close.assert_called_once()
 
 
 if __name__ == '__main__':
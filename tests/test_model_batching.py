@@ -0,0 +1,89 @@
+import json
+import asyncio
+import unittest
+
+from unittest.mock import patch
+
+from model import deadline, http_client
+from model.batching import BatchError, MicroBatcher, encode_batch
+from tests.helpers import make_model
+
+
+class TestMicroBatcher(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.model = make_model("test_model", settings={"batch_size": 3, "batch_wait_ms": 20})
+        self.batches = []
+
+    async def asyncTearDown(self):
+        await http_client.close_clients()
+
+    async def mock_post(self, model, body):
+        data = json.loads(body)["input_data"]["data"]
+        self.batches.append(data)
+        await asyncio.sleep(0.01)
+        return json.dumps([[{"label": crop.upper()}] for crop in data]).encode()
+
+    async def test_encode_batch(self):
+        data = json.loads(encode_batch([b"crop0", b"crop1"]))
+
+        self.assertEqual(data["input_data"]["index"], [0, 1])
+        self.assertEqual(data["input_data"]["data"], ["crop0", "crop1"])
+
+    async def test_concurrent_requests_batched(self):
+        with patch("model.http_client.post", new=self.mock_post):
+            first, second = await asyncio.gather(
+                http_client.post_many(self.model, [b"a0", b"a1"]),
+                http_client.post_many(self.model, [b"b0", b"b1"]),
+            )
+
+        self.assertEqual(sorted(len(batch) for batch in self.batches), [1, 3])
+        self.assertEqual([json.loads(r)[0]["label"] for r in first], ["A0", "A1"])
+        self.assertEqual([json.loads(r)[0]["label"] for r in second], ["B0", "B1"])
+
+    async def test_partial_batch_sent_after_max_wait(self):
+        with patch("model.http_client.post", new=self.mock_post):
+            result = await asyncio.wait_for(http_client.post_input(self.model, b"c0"), 1)
+
+        self.assertEqual(self.batches, [["c0"]])
+        self.assertEqual(json.loads(result), [{"label": "C0"}])
+
+    async def test_error_sent_to_every_input(self):
+        async def mock_post(model, body):
+            return json.dumps([[{"label": "only one"}]]).encode()
+
+        batcher = MicroBatcher(self.model, mock_post, 2, 0.01, 1)
+        results = await asyncio.gather(
+            batcher.submit(b"d0"), batcher.submit(b"d1"), return_exceptions=True
+        )
+
+        self.assertTrue(all(isinstance(result, BatchError) for result in results))
+        self.assertEqual(batcher.stats()["failed"], 1)
+
+    async def test_cancelled_input_not_sent(self):
+        with patch("model.http_client.post", new=self.mock_post):
+            cancelled = asyncio.ensure_future(http_client.post_input(self.model, b"e0"))
+            await asyncio.sleep(0)
+            cancelled.cancel()
+            result = await http_client.post_input(self.model, b"e1")
+
+        self.assertEqual(self.batches, [["e1"]])
+        self.assertEqual(json.loads(result), [{"label": "E1"}])
+
+    async def test_input_dropped_when_budget_spent(self):
+        batcher = MicroBatcher(self.model, self.mock_post, 3, 10, 1)
+
+        deadline.start(0.02)
+        with self.assertRaises(deadline.DeadlineExceededError):
+            await batcher.submit(b"f0")
+
+        self.assertEqual(batcher.stats()["pending"], 0)
+        self.assertEqual(self.batches, [])
+
+    async def test_batching_disabled_by_default(self):
+        model = self.model._replace(settings={})
+
+        self.assertIsNone(http_client.get_batcher(model))
+
+
+if __name__ == "__main__":
+    unittest.main()
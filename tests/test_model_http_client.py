@@ -0,0 +1,112 @@
+import json
+import asyncio
+import unittest
+import httpx
+
+from unittest.mock import Mock, patch
+
+from model import http_client, image_slicing
+from model.swin import request_inference_from_swin
+from tests.helpers import make_model
+
+
+class TestModelHttpClient(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.model = make_model("test_model", settings={"max_concurrency": 2})
+        self.requests = []
+
+    async def asyncTearDown(self):
+        http_client._breakers.clear()
+        await http_client.close_clients()
+
+    def mock_client(self, handler):
+        def record(request):
+            self.requests.append(request)
+            return handler(request)
+
+        return httpx.AsyncClient(transport=httpx.MockTransport(record))
+
+    async def test_post_successful(self):
+        client = self.mock_client(lambda request: httpx.Response(200, content=b"ok"))
+        with patch("model.http_client.get_client", return_value=client):
+            result = await http_client.post(self.model, b"body")
+
+        self.assertEqual(result, b"ok")
+        self.assertEqual(self.requests[0].content, b"body")
+        self.assertEqual(self.requests[0].headers["Authorization"], "Bearer test_api_key")
+        self.assertEqual(self.requests[0].headers["azureml-model-deployment"], "test_model")
+
+    async def test_post_error_status(self):
+        client = self.mock_client(lambda request: httpx.Response(500))
+        with patch("model.http_client.get_client", return_value=client):
+            with self.assertRaises(http_client.ModelEndpointError):
+                await http_client.post(self.model, b"body")
+
+    async def test_get_client_reused_per_origin(self):
+        client = http_client.get_client("http://localhost:8080/score")
+        self.assertIs(http_client.get_client("http://localhost:8080/other"), client)
+        self.assertIsNot(http_client.get_client("http://localhost:8081/score"), client)
+
+    async def test_post_many_keeps_order_and_concurrency_cap(self):
+        in_flight = 0
+        max_in_flight = 0
+
+        async def mock_post(model, body):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            # Answer the first bodies last
+            await asyncio.sleep(0.01 * (5 - int(body)))
+            in_flight -= 1
+            return body
+
+        bodies = [str(i).encode() for i in range(5)]
+        with patch("model.http_client.post", new=mock_post):
+            results = await http_client.post_many(self.model, bodies)
+
+        self.assertEqual(results, bodies)
+        self.assertEqual(max_in_flight, 2)
+
+    async def test_post_many_crop_stream(self):
+        crops = [b"crop0", b"crop1", b"crop2"]
+
+        async def mock_iter_crops(image, coordinates, encoding):
+            # The crops complete out of order
+            for i in (2, 0, 1):
+                yield i, crops[i]
+
+        async def mock_post(model, body):
+            return body.upper()
+
+        with patch("model.image_slicing._iter_crops", new=mock_iter_crops), \
+                patch("model.image_slicing.crop_coordinates", return_value=[None] * 3), \
+                patch("model.http_client.post", new=mock_post):
+            stream = image_slicing.CropStream(Mock(), [{}] * 3)
+            results = await http_client.post_many(self.model, stream)
+
+        self.assertEqual(results, [b"CROP0", b"CROP1", b"CROP2"])
+
+    async def test_post_many_error(self):
+        client = self.mock_client(lambda request: httpx.Response(503))
+        with patch("model.http_client.get_client", return_value=client):
+            with self.assertRaises(http_client.ModelEndpointError):
+                await http_client.post_many(self.model, [b"1", b"2", b"3"])
+
+    async def test_swin_uses_shared_client(self):
+        answer = [{"label": "1 Ambrosia artemisiifolia", "score": 0.9}]
+        client = self.mock_client(
+            lambda request: httpx.Response(200, content=json.dumps(answer).encode())
+        )
+        previous_result = {
+            "result_json": [{"boxes": [{"label": "", "score": 0}] * 3}],
+            "images": [b"crop1", b"crop2", b"crop3"],
+        }
+        with patch("model.http_client.get_client", return_value=client):
+            result = await request_inference_from_swin(self.model, previous_result)
+
+        self.assertEqual(result[0]["boxes"][0]["label"], "Ambrosia artemisiifolia")
+        self.assertEqual(len(self.requests), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
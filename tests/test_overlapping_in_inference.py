@@ -1,3 +1,5 @@
+import copy
+import random
 import unittest
 import asyncio
 
@@ -58,6 +60,53 @@ class TestInferenceProcessFunction(unittest.TestCase):
         self.assertFalse(result[0]["boxes"][0]["overlapping"])
         self.assertFalse(result[0]["boxes"][1]["overlapping"])
 
+    def test_process_inference_overlap_moved_box(self):
+        # The first box takes the coordinates of the second one and then
+        # overlaps the third one with its new coordinates
+        boxes = [
+            {"box": {"topX": 0.1, "topY": 0.1, "bottomX": 0.5, "bottomY": 0.5}, "score": 0.5, "label": "box1"},
+            {"box": {"topX": 0.3, "topY": 0.3, "bottomX": 0.7, "bottomY": 0.7}, "score": 0.9, "label": "box2"},
+            {"box": {"topX": 0.35, "topY": 0.35, "bottomX": 0.75, "bottomY": 0.75}, "score": 0.1, "label": "box3"},
+        ]
+        result = asyncio.run(
+            process_inference_results(data=[{"boxes": boxes}], imageDims=[100, 100], area_ratio=0.2))
+
+        self.assertEqual([box["overlapping"] for box in result[0]["boxes"]], [True, False, True])
+        self.assertEqual([box["overlappingIndices"] for box in result[0]["boxes"]], [[2, 3], [3], []])
+        for box in result[0]["boxes"]:
+            self.assertEqual(box["box"], {"topX": 30, "topY": 30, "bottomX": 70, "bottomY": 70})
+
+    def test_process_inference_overlap_grid_index(self):
+        # The grid index must give the same result as the overlap matrix
+        generator = random.Random(42)
+        boxes = []
+        for i in range(300):
+            x, y = generator.random(), generator.random()
+            size = generator.choice([0.0, 0.02, 0.05, 0.6])
+            boxes.append({
+                "box": {"topX": x, "topY": y, "bottomX": x + size, "bottomY": y + generator.random() * 0.05},
+                "score": generator.choice([0.1, 0.5, generator.random()]),
+                "label": f"box{i}",
+            })
+
+        matrix_result = asyncio.run(process_inference_results(
+            [{"boxes": copy.deepcopy(boxes)}], [1000, 1000], 0.3, index_threshold=len(boxes)))
+        grid_result = asyncio.run(process_inference_results(
+            [{"boxes": copy.deepcopy(boxes)}], [1000, 1000], 0.3, index_threshold=0))
+
+        self.assertTrue(any(box["overlapping"] for box in matrix_result[0]["boxes"]))
+        for box, expected in zip(grid_result[0]["boxes"], matrix_result[0]["boxes"]):
+            self.assertEqual(box["box"], expected["box"])
+            self.assertEqual(box["overlapping"], expected["overlapping"])
+            self.assertEqual(box["overlappingIndices"], expected["overlappingIndices"])
+
+    def test_process_inference_no_boxes(self):
+        result = asyncio.run(
+            process_inference_results(data=[{"boxes": []}], imageDims=[100, 100]))
+
+        self.assertEqual(result[0]["totalBoxes"], 0)
+        self.assertEqual(result[0]["labelOccurrence"], {})
+
     def test_generate_color_hex(self):
         boxes = [{"box": self.box1, "score": 10, "label": f"box{i}"} for i in range(2)]
         boxes.extend([{"box": self.box2, "score": 10, "label": f"box{i}"} for i in range(2)])
@@ -0,0 +1,186 @@
+import json
+import asyncio
+import unittest
+
+from unittest.mock import patch
+
+from model import deadline
+from model.pipeline import PipelineGraph, PipelineGraphError
+from model.torch_swin import request_inference_from_torch_swin
+from tests.helpers import make_model
+
+
+async def append_name(model, previous_result):
+    return f"{previous_result}>{model.name}"
+
+
+class TestPipelineGraph(unittest.IsolatedAsyncioTestCase):
+    async def test_sequential_by_default(self):
+        graph = PipelineGraph(
+            (make_model("detector", append_name), make_model("classifier", append_name))
+        )
+
+        run = await graph.run("image")
+
+        self.assertEqual(run.result, "image>detector>classifier")
+        self.assertEqual(set(run.timings), {"detector", "classifier"})
+        self.assertEqual(graph.stats()["detector"]["calls"], 1)
+
+    async def test_independent_models_run_concurrently(self):
+        started = []
+        both_started = asyncio.Event()
+
+        async def wait_for_other(model, previous_result):
+            started.append(model.name)
+            if len(started) == 2:
+                both_started.set()
+            await asyncio.wait_for(both_started.wait(), 1)
+            return f"{previous_result}>{model.name}"
+
+        async def combine(model, previous_result):
+            return previous_result
+
+        graph = PipelineGraph.from_definition(
+            (
+                make_model("detector", append_name),
+                make_model("classifier_a", wait_for_other),
+                make_model("classifier_b", wait_for_other),
+                make_model("combine", combine),
+            ),
+            {
+                "dependencies": {
+                    "classifier_a": "detector",
+                    "classifier_b": "detector",
+                    "combine": ["classifier_a", "classifier_b"],
+                }
+            },
+        )
+
+        run = await graph.run("image")
+
+        self.assertEqual(
+            run.result,
+            {
+                "classifier_a": "image>detector>classifier_a",
+                "classifier_b": "image>detector>classifier_b",
+            },
+        )
+
+    async def test_dependents_get_their_own_boxes(self):
+        async def detect(model, previous_result):
+            return {
+                "images": [b"crop"],
+                "result_json": [{"boxes": [{"box": {"topX": 0, "topY": 0, "bottomX": 1, "bottomY": 1}}]}],
+            }
+
+        async def post_many(model, images):
+            label = model.name.split("_")[1]
+            return [json.dumps([{"label": label, "score": 0.9}]).encode("utf8")]
+
+        graph = PipelineGraph.from_definition(
+            (
+                make_model("detector", detect),
+                make_model("classifier_a", request_inference_from_torch_swin),
+                make_model("classifier_b", request_inference_from_torch_swin),
+            ),
+            {
+                "dependencies": {"classifier_a": "detector", "classifier_b": "detector"},
+                "output": "classifier_a",
+            },
+        )
+
+        with patch("model.torch_swin.http_client.post_many", post_many):
+            run = await graph.run("image")
+
+        self.assertEqual(run.results["classifier_a"][0]["boxes"][0]["label"], "a")
+        self.assertEqual(run.results["classifier_b"][0]["boxes"][0]["label"], "b")
+        self.assertIsNot(run.results["classifier_a"], run.results["classifier_b"])
+
+    async def test_single_consumer_result_not_copied(self):
+        detection = {"images": [b"crop"], "result_json": [{"boxes": []}]}
+
+        async def detect(model, previous_result):
+            return detection
+
+        async def classify(model, previous_result):
+            return previous_result
+
+        graph = PipelineGraph((make_model("detector", detect), make_model("classifier", classify)))
+
+        run = await graph.run("image")
+
+        self.assertIs(run.result, detection)
+
+    async def test_output_model(self):
+        graph = PipelineGraph.from_definition(
+            (make_model("detector", append_name), make_model("quality", append_name)),
+            {"dependencies": {"quality": "image"}, "output": "detector"},
+        )
+
+        run = await graph.run("image")
+
+        self.assertEqual(run.result, "image>detector")
+        self.assertEqual(run.results["quality"], "image>quality")
+
+    async def test_invalid_graphs(self):
+        models = (make_model("a", append_name), make_model("b", append_name))
+        for dependencies, output in (
+            ({"a": "b"}, None),
+            ({"a": "missing"}, None),
+            ({"missing": "a"}, None),
+            ({}, "missing"),
+        ):
+            with self.assertRaises(PipelineGraphError):
+                PipelineGraph(models, dependencies, output)
+
+    async def test_error_cancels_other_models(self):
+        cancelled = asyncio.Event()
+
+        async def fail(model, previous_result):
+            await asyncio.sleep(0)
+            raise ValueError("model error")
+
+        async def slow(model, previous_result):
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        graph = PipelineGraph(
+            (make_model("fail", fail), make_model("slow", slow)), {"slow": "image"}
+        )
+
+        with self.assertRaises(ValueError):
+            await graph.run("image")
+        await asyncio.sleep(0)
+        self.assertTrue(cancelled.is_set())
+
+    async def test_deadline_returns_partial_result(self):
+        async def slow(model, previous_result):
+            await asyncio.sleep(10)
+
+        graph = PipelineGraph(
+            (make_model("detector", append_name), make_model("classifier", slow))
+        )
+
+        deadline.start(0.05)
+        run = await graph.run("image")
+
+        self.assertTrue(run.partial)
+        self.assertEqual(run.result, "image>detector")
+        self.assertNotIn("classifier", run.results)
+
+    async def test_deadline_before_any_result(self):
+        async def slow(model, previous_result):
+            await asyncio.sleep(10)
+
+        graph = PipelineGraph((make_model("detector", slow),))
+
+        deadline.start(0.01)
+        with self.assertRaises(deadline.DeadlineExceededError):
+            await graph.run("image")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import io
+import json
+import asyncio
+import unittest
+
+from PIL import Image
+from unittest.mock import patch
+
+from model import image_slicing
+from model.image import SourceImage
+from model.seed_detector import (
+    SeedDetectorModelAPIError,
+    chunk_images,
+    request_inference_from_seed_detector,
+    request_inference_from_seed_detector_many,
+)
+from tests.helpers import make_model
+
+
+class TestSeedDetector(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        image_slicing.shutdown()
+
+    def setUp(self):
+        self.model = make_model("seed-detector", settings={"max_images_per_request": 2})
+        self.images = []
+        for color in ("red", "green", "blue"):
+            buffered = io.BytesIO()
+            Image.new("RGB", (40, 20), color).save(buffered, "PNG")
+            self.images.append(SourceImage(buffered.getvalue()))
+        self.requests = []
+
+    async def mock_post(self, model, body):
+        data = json.loads(body)["input_data"]["data"]
+        self.requests.append(data)
+        # One box per image, as wide as the index of the image in the request
+        results = [
+            {"boxes": [{"box": {"topX": 0.0, "topY": 0.0, "bottomX": (i + 1) / 4, "bottomY": 1.0}}]}
+            for i in range(len(data))
+        ]
+        return json.dumps(results if len(data) > 1 else results[0]).encode()
+
+    def test_chunk_images(self):
+        self.assertEqual(chunk_images(self.images, 2, 10 ** 6), [[0, 1], [2]])
+        self.assertEqual(chunk_images(self.images, 8, 1), [[0], [1], [2]])
+        self.assertEqual(chunk_images([], 8, 10 ** 6), [])
+
+    def test_many_images_chunked_and_split(self):
+        async def detect():
+            inferences = await request_inference_from_seed_detector_many(self.model, self.images)
+            return [
+                (inference["result_json"], await inference["images"].result())
+                for inference in inferences
+            ]
+
+        with patch("model.http_client.post", new=self.mock_post):
+            results = asyncio.run(detect())
+
+        self.assertEqual([len(data) for data in self.requests], [2, 1])
+        self.assertEqual(self.requests[0], [self.images[0].base64, self.images[1].base64])
+        self.assertEqual(
+            [result_json[0]["boxes"][0]["box"]["bottomX"] for result_json, _ in results],
+            [0.25, 0.5, 0.25],
+        )
+        self.assertTrue(all(len(crops) == 1 for _, crops in results))
+
+    def test_single_image(self):
+        async def detect():
+            inference = await request_inference_from_seed_detector(self.model, self.images[0])
+            return inference["result_json"], await inference["images"].result()
+
+        with patch("model.http_client.post", new=self.mock_post):
+            result_json, crops = asyncio.run(detect())
+
+        self.assertEqual(len(result_json[0]["boxes"]), 1)
+        self.assertEqual(len(crops), 1)
+
+    def test_wrong_number_of_results(self):
+        async def mock_post(model, body):
+            return json.dumps([{"boxes": []}]).encode()
+
+        with patch("model.http_client.post", new=mock_post):
+            with self.assertRaises(SeedDetectorModelAPIError):
+                asyncio.run(request_inference_from_seed_detector_many(self.model, self.images[:2]))
+
+
+if __name__ == "__main__":
+    unittest.main()
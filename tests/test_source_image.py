@@ -0,0 +1,69 @@
+import io
+import base64
+import unittest
+
+from PIL import Image
+from unittest.mock import patch
+
+from model.image import SourceImage
+from model.seed_detector import process_image_slicing
+
+
+class TestSourceImage(unittest.TestCase):
+    def setUp(self):
+        buffered = io.BytesIO()
+        Image.new("RGB", (100, 50), "blue").save(buffered, "PNG")
+        self.image_bytes = buffered.getvalue()
+        self.image_base64 = base64.b64encode(self.image_bytes).decode("ascii")
+        self.result_json = [
+            {
+                "boxes": [
+                    {"box": {"topX": 0.0, "topY": 0.0, "bottomX": 0.5, "bottomY": 0.5}},
+                    {"box": {"topX": 0.5, "topY": 0.5, "bottomX": 1.0, "bottomY": 1.0}},
+                ]
+            }
+        ]
+
+    def test_from_base64_keeps_the_encoded_image(self):
+        source_image = SourceImage.from_base64(self.image_base64)
+
+        self.assertEqual(source_image.data, self.image_bytes)
+        self.assertIs(source_image.base64, self.image_base64)
+
+    def test_base64_encoded_once(self):
+        source_image = SourceImage(self.image_bytes)
+
+        with patch("model.image.base64.b64encode", wraps=base64.b64encode) as mock_b64encode:
+            self.assertEqual(source_image.base64, self.image_base64)
+            self.assertEqual(source_image.base64, self.image_base64)
+            mock_b64encode.assert_called_once()
+
+    def test_opened_once(self):
+        source_image = SourceImage(self.image_bytes)
+
+        self.assertIs(source_image.open(), source_image.open())
+        self.assertEqual(source_image.open().size, (100, 50))
+
+    def test_empty_image(self):
+        self.assertFalse(SourceImage.from_base64(""))
+
+    def test_process_image_slicing(self):
+        source_image = SourceImage(self.image_bytes)
+
+        with patch("model.image.Image.open", wraps=Image.open) as mock_open:
+            cropped_images = process_image_slicing(source_image, self.result_json)
+            mock_open.assert_called_once()
+
+        self.assertEqual(len(cropped_images), 2)
+        crop = Image.open(io.BytesIO(base64.b64decode(cropped_images[1])))
+        self.assertEqual(crop.size, (50, 25))
+        self.assertEqual(crop.format, "PNG")
+
+    def test_process_image_slicing_from_base64(self):
+        cropped_images = process_image_slicing(self.image_base64, self.result_json)
+
+        self.assertEqual(len(cropped_images), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
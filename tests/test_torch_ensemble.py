@@ -0,0 +1,81 @@
+import json
+import unittest
+
+from unittest.mock import patch
+
+from model.torch_ensemble import (
+    SwinModelAPIError,
+    request_inference_ensemble_b,
+    with_routes,
+)
+from tests.helpers import make_model
+
+
+class TestEnsembleB(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.ensemble_b = make_model("swin-15e-spp", request_inference_ensemble_b, endpoint="http://ensemble/score")
+        self.specialist = make_model("ambrosia-specialist", endpoint="http://specialist/score")
+        self.previous_result = {
+            "result_json": [
+                {
+                    "filename": "default_filename",
+                    "boxes": [
+                        {"label": "012 Ambrosia artemisiifolia", "score": 0.5},
+                        {"label": "001 Other seed", "score": 0.9},
+                        {"label": "013 Ambrosia trifida", "score": 0.4},
+                    ],
+                }
+            ],
+            "images": [b"crop0", b"crop1", b"crop2"],
+        }
+        self.requests = []
+
+    async def mock_post(self, model, body):
+        self.requests.append((model.name, body))
+        return json.dumps([{"label": f"{model.name} {body.decode()}", "score": 0.99}]).encode()
+
+    async def test_default_species_list(self):
+        with patch("model.http_client.post", new=self.mock_post):
+            result = await request_inference_ensemble_b(self.ensemble_b, self.previous_result)
+
+        boxes = result[0]["boxes"]
+        self.assertEqual(boxes[0]["label"], "swin-15e-spp crop0")
+        self.assertEqual(boxes[2]["label"], "swin-15e-spp crop2")
+        self.assertEqual(sorted(body for _, body in self.requests), [b"crop0", b"crop2"])
+
+    async def test_only_amended_boxes_copied(self):
+        original_boxes = self.previous_result["result_json"][0]["boxes"]
+        with patch("model.http_client.post", new=self.mock_post):
+            result = await request_inference_ensemble_b(self.ensemble_b, self.previous_result)
+
+        self.assertIs(result[0]["boxes"][1], original_boxes[1])
+        self.assertIsNot(result[0]["boxes"][0], original_boxes[0])
+        self.assertEqual(original_boxes[0]["label"], "012 Ambrosia artemisiifolia")
+        self.assertEqual(result[0]["filename"], "default_filename")
+
+    async def test_routes_to_specialists(self):
+        model = with_routes(
+            self.ensemble_b,
+            {"012 Ambrosia artemisiifolia": "ambrosia-specialist", "001 Other seed": None},
+            (self.ensemble_b, self.specialist),
+        )
+
+        with patch("model.http_client.post", new=self.mock_post):
+            result = await request_inference_ensemble_b(model, self.previous_result)
+
+        labels = [box["label"] for box in result[0]["boxes"]]
+        self.assertEqual(
+            labels,
+            ["ambrosia-specialist crop0", "swin-15e-spp crop1", "013 Ambrosia trifida"],
+        )
+
+    async def test_unknown_route(self):
+        with self.assertRaises(SwinModelAPIError):
+            with_routes(self.ensemble_b, {"012 Ambrosia artemisiifolia": "missing"}, (self.ensemble_b,))
+
+    async def test_routes_only_for_ensemble_b(self):
+        self.assertIs(with_routes(self.specialist, {"label": None}, (self.specialist,)), self.specialist)
+
+
+if __name__ == "__main__":
+    unittest.main()